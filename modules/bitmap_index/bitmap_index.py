@@ -5,13 +5,12 @@ import os, sys
 from dotenv import load_dotenv
 import traceback, time, codecs, json
 import psycopg2
-import hashlib
-import requests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) ## modules directory, for opi_common
+from opi_common.engine import get_cumulative_event_hash, BlockEventHasher, CumulativeHashChain, WorkStats, BlockRangeProfiler, wait_for_new_block, check_for_reorg, try_to_report_with_retries
 
 ## global variables
 in_commit = False
-block_events_str = ""
-EVENT_SEPARATOR = "|"
+block_events_hasher = None ## BlockEventHasher of the block being indexed
 INDEXER_VERSION = "opi-bitmap-full-node v0.3.0"
 DB_VERSION = 3
 
@@ -35,6 +34,13 @@ db_metaprotocol_port = int(os.getenv("DB_METAPROTOCOL_PORT") or "5432")
 db_metaprotocol_database = os.getenv("DB_METAPROTOCOL_DATABASE") or "postgres"
 db_metaprotocol_password = os.getenv("DB_METAPROTOCOL_PASSWD")
 network_type = os.getenv("NETWORK_TYPE") or "mainnet"
+profile_mode = os.getenv("PROFILE_MODE") or "" ## cprofile, sampling or empty to disable
+profile_start_height = int(os.getenv("PROFILE_START_HEIGHT") or "0")
+profile_end_height = int(os.getenv("PROFILE_END_HEIGHT") or "0")
+profile_sample_interval_ms = int(os.getenv("PROFILE_SAMPLE_INTERVAL_MS") or "10")
+profile_output_file = os.getenv("PROFILE_OUTPUT_FILE") or "bitmap_profile"
+listen_new_blocks = (os.getenv("LISTEN_NEW_BLOCKS") or "true") == "true"
+new_block_wait_timeout = int(os.getenv("NEW_BLOCK_WAIT_TIMEOUT") or "30")
 
 first_inscription_heights = {
   'mainnet': 767430,
@@ -53,6 +59,10 @@ if network_type == 'regtest':
   report_to_indexer = False
   print("Network type is regtest, reporting to indexer is disabled.")
 
+if profile_mode not in ["", "cprofile", "sampling"]:
+  print("PROFILE_MODE must be cprofile, sampling or empty")
+  sys.exit(1)
+
 ## connect to db
 conn = psycopg2.connect(
   host=db_host,
@@ -72,6 +82,10 @@ conn_metaprotocol = psycopg2.connect(
 conn_metaprotocol.autocommit = True
 cur_metaprotocol = conn_metaprotocol.cursor()
 
+## main_index notifies opi_new_block when a new block_hashes row is committed (see check_db in main_index/index.js)
+if listen_new_blocks:
+  cur_metaprotocol.execute('''LISTEN opi_new_block;''')
+
 cur_metaprotocol.execute('SELECT network_type from ord_network_type LIMIT 1;')
 if cur_metaprotocol.rowcount == 0:
   print("ord_network_type not found, main db needs to be recreated from scratch or fixed with index.js, please run index.js or main_index")
@@ -122,31 +136,27 @@ def get_event_str(bitmap_number, inscription_id):
   res += bitmap_number
   return res
 
-def get_sha256_hash(s):
-  return hashlib.sha256(s.encode('utf-8')).hexdigest()
-
+hash_chain = CumulativeHashChain(cur, 'bitmap_cumulative_event_hashes')
 def update_event_hashes(block_height):
-  global block_events_str
-  if len(block_events_str) > 0 and block_events_str[-1] == EVENT_SEPARATOR: block_events_str = block_events_str[:-1] ## remove last separator
-  block_event_hash = get_sha256_hash(block_events_str)
-  cumulative_event_hash = None
-  cur.execute('''select cumulative_event_hash from bitmap_cumulative_event_hashes where block_height = %s;''', (block_height - 1,))
-  if cur.rowcount == 0:
-    cumulative_event_hash = block_event_hash
-  else:
-    cumulative_event_hash = get_sha256_hash(cur.fetchone()[0] + block_event_hash)
+  st_tm = time.time()
+  work_stats.add_count("event_count", block_events_hasher.event_cnt)
+  block_event_hash = block_events_hasher.hexdigest()
+  last_cumulative_event_hash = hash_chain.get_last(block_height)
+  cumulative_event_hash = get_cumulative_event_hash(last_cumulative_event_hash, block_event_hash)
   cur.execute('''INSERT INTO bitmap_cumulative_event_hashes (block_height, block_event_hash, cumulative_event_hash) VALUES (%s, %s, %s);''', (block_height, block_event_hash, cumulative_event_hash))
-    
+  hash_chain.set_tip(block_height, cumulative_event_hash)
+  work_stats.add_time("hash_tm", st_tm)
 
 
 
 
 def index_block(block_height, current_block_hash):
-  global block_events_str
+  global block_events_hasher
   print("Indexing block " + str(block_height))
-  block_events_str = ""
+  block_events_hasher = BlockEventHasher()
   
   ## get text/plain inscrs from ord
+  st_tm = time.time()
   cur_metaprotocol.execute('''SELECT oc.inscription_id, oc.text_content
                               FROM ord_content oc
                               LEFT JOIN ord_number_to_id onti on oc.inscription_id = onti.inscription_id
@@ -155,6 +165,8 @@ def index_block(block_height, current_block_hash):
                                     onti.inscription_number >= 0
                               ORDER BY onti.inscription_number asc;''', (block_height,))
   inscrs = cur_metaprotocol.fetchall()
+  work_stats.add_time("fetch_tm", st_tm)
+  work_stats.add_count("inscription_count", len(inscrs))
   if len(inscrs) == 0:
     print("No new inscrs found for block " + str(block_height))
     update_event_hashes(block_height)
@@ -162,6 +174,7 @@ def index_block(block_height, current_block_hash):
     return
   print("New inscrs count: ", len(inscrs))
   
+  st_tm = time.time()
   idx = 0
   for inscr in inscrs:
     idx += 1
@@ -180,7 +193,8 @@ def index_block(block_height, current_block_hash):
       continue
     bitmap_id = cur.fetchone()[0]
     print("bitmap_number: " + str(bitmap_number) + " id: " + str(bitmap_id))
-    block_events_str += get_event_str(str(bitmap_number), str(inscr_id)) + EVENT_SEPARATOR
+    block_events_hasher.add(get_event_str(str(bitmap_number), str(inscr_id)))
+  work_stats.add_time("index_tm", st_tm)
   
   update_event_hashes(block_height)
   # end of block
@@ -190,30 +204,15 @@ def index_block(block_height, current_block_hash):
 
 
 
-def check_for_reorg():
-  cur.execute('select block_height, block_hash from bitmap_block_hashes order by block_height desc limit 1;')
-  if cur.rowcount == 0: return None ## nothing indexed yet
-  last_block = cur.fetchone()
-
-  cur_metaprotocol.execute('select block_height, block_hash from block_hashes where block_height = %s;', (last_block[0],))
-  last_block_ord = cur_metaprotocol.fetchone()
-  if last_block_ord[1] == last_block[1]: return None ## last block hashes are the same, no reorg
+## per-block work stats, stage timings are in ms, saved to bitmap_indexer_work_stats after each block
+work_stats_columns = ["inscription_count", "event_count", "fetch_tm", "index_tm", "hash_tm", "report_tm", "all_tm"]
+work_stats = WorkStats(cur, 'bitmap_indexer_work_stats', work_stats_columns)
 
-  print("REORG DETECTED!!")
-  cur.execute('select block_height, block_hash from bitmap_block_hashes order by block_height desc limit 10;')
-  hashes = cur.fetchall() ## get last 10 hashes
-  for h in hashes:
-    cur_metaprotocol.execute('select block_height, block_hash from block_hashes where block_height = %s;', (h[0],))
-    block = cur_metaprotocol.fetchone()
-    if block[1] == h[1]: ## found reorg height by a matching hash
-      print("REORG HEIGHT FOUND: " + str(h[0]))
-      return h[0]
-  
-  ## bigger than 10 block reorg is not supported by ord
-  print("CRITICAL ERROR!!")
-  sys.exit(1)
+## opt-in profiling of blocks PROFILE_START_HEIGHT - PROFILE_END_HEIGHT
+block_profiler = BlockRangeProfiler(profile_mode, profile_start_height, profile_end_height, profile_sample_interval_ms, profile_output_file)
 
 def reorg_fix(reorg_height):
+  hash_chain.reset() ## resync hash chain from db on next block
   cur.execute('begin;')
   cur.execute('delete from bitmaps where block_height > %s;', (reorg_height,)) ## delete new bitmaps
   cur.execute("SELECT setval('bitmaps_id_seq', max(id)) from bitmaps;") ## reset id sequence
@@ -254,20 +253,14 @@ except:
   print("Indexer version not found, db needs to be recreated from scratch, please run reset_init.py")
   exit(1)
 
-def try_to_report_with_retries(to_send):
-  global report_url, report_retries
-  for _ in range(0, report_retries):
-    try:
-      r = requests.post(report_url, json=to_send)
-      if r.status_code == 200:
-        print("Reported hashes to metaprotocol indexer indexer.")
-        return
-      else:
-        print("Error while reporting hashes to metaprotocol indexer indexer, status code: " + str(r.status_code))
-    except:
-      print("Error while reporting hashes to metaprotocol indexer indexer, retrying...")
-    time.sleep(1)
-  print("Error while reporting hashes to metaprotocol indexer indexer, giving up.")
+## work stats table was added later, create it on databases initialised before it
+cur.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = 'bitmap_indexer_work_stats') AS table_existence;''')
+if cur.fetchone()[0] == False:
+  print("Creating bitmap_indexer_work_stats...")
+  with open('db_init.sql', 'r') as f:
+    for statement in f.read().split(';'):
+      if 'CREATE TABLE public.bitmap_indexer_work_stats' in statement:
+        cur.execute(statement.strip() + ';')
 
 def report_hashes(block_height):
   global report_to_indexer
@@ -293,7 +286,7 @@ def report_hashes(block_height):
     "cumulative_event_hash": cumulative_event_hash
   }
   print("Sending hashes to metaprotocol indexer indexer...")
-  try_to_report_with_retries(to_send)
+  try_to_report_with_retries(report_url, report_retries, to_send)
 
 last_report_height = 0
 check_if_there_is_residue_from_last_run()
@@ -309,23 +302,29 @@ while True:
   else: current_block = row[0] + 1
   if current_block > max_block_of_metaprotocol_db:
     print("Waiting for new blocks...")
-    time.sleep(5)
+    wait_for_new_block(conn_metaprotocol, listen_new_blocks, new_block_wait_timeout)
     continue
   
   print("Processing block %s" % current_block)
   cur_metaprotocol.execute('select block_hash from block_hashes where block_height = %s;', (current_block,))
   current_block_hash = cur_metaprotocol.fetchone()[0]
-  reorg_height = check_for_reorg()
+  reorg_height = check_for_reorg(cur, cur_metaprotocol, 'bitmap_block_hashes')
   if reorg_height is not None:
     print("Rolling back to ", reorg_height)
     reorg_fix(reorg_height)
     print("Rolled back to " + str(reorg_height))
     continue
   try:
+    work_stats.reset()
+    block_profiler.start_if_needed(current_block, current_block)
     index_block(current_block, current_block_hash)
     if max_block_of_metaprotocol_db - current_block < 10 or current_block - last_report_height > 100: ## do not report if there are more than 10 blocks to index
+      st_tm = time.time()
       report_hashes(current_block)
+      work_stats.add_time("report_tm", st_tm)
       last_report_height = current_block
+    work_stats.save(current_block, current_block)
+    block_profiler.stop_if_needed(current_block)
   except:
     traceback.print_exc()
     if in_commit: ## rollback commit if any
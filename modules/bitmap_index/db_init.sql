@@ -26,6 +26,21 @@ CREATE TABLE public.bitmap_cumulative_event_hashes (
 );
 CREATE UNIQUE INDEX bitmap_cumulative_event_hashes_block_height_idx ON public.bitmap_cumulative_event_hashes USING btree (block_height);
 
+CREATE TABLE public.bitmap_indexer_work_stats (
+	id bigserial NOT NULL,
+	min_block_height int4 NOT NULL,
+	max_block_height int4 NOT NULL,
+	inscription_count int4 NOT NULL DEFAULT 0,
+	event_count int4 NOT NULL DEFAULT 0,
+	fetch_tm int4 NOT NULL DEFAULT 0,
+	index_tm int4 NOT NULL DEFAULT 0,
+	hash_tm int4 NOT NULL DEFAULT 0,
+	report_tm int4 NOT NULL DEFAULT 0,
+	all_tm int4 NOT NULL DEFAULT 0,
+	ts timestamptz NOT NULL DEFAULT now(),
+	CONSTRAINT bitmap_indexer_work_stats_pk PRIMARY KEY (id)
+);
+
 CREATE TABLE public.bitmap_indexer_version (
 	id bigserial NOT NULL,
 	indexer_version text NOT NULL,
@@ -1,4 +1,5 @@
 drop table if exists bitmap_block_hashes;
 drop table if exists bitmaps;
 drop table if exists bitmap_cumulative_event_hashes;
+drop table if exists bitmap_indexer_work_stats;
 drop table if exists bitmap_indexer_version;
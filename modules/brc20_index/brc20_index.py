@@ -1,11 +1,16 @@
 # pip install python-dotenv
 # pip install psycopg2-binary
 
-import os, sys, requests
+import os, sys
 from dotenv import load_dotenv
 import traceback, time, codecs, json
+import threading, queue
 import psycopg2
-import hashlib
+import io
+import multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) ## modules directory, for opi_common
+from opi_common.numeric import is_positive_number, is_positive_number_with_dot, get_number_extended_to_18_decimals, fix_numstr_decimals
+from opi_common.engine import get_cumulative_event_hash, utf8len, BlockEventHasher, Balance, LRUCache, WorkStats, BlockRangeProfiler, ProtocolEngine
 
 if not os.path.isfile('.env'):
   print(".env file not found, please run \"python3 reset_init.py\" first")
@@ -13,12 +18,10 @@ if not os.path.isfile('.env'):
 
 ## global variables
 ticks = {}
-in_commit = False
-block_events_str = ""
-EVENT_SEPARATOR = "|"
+block_events_hasher = None ## BlockEventHasher of the block being indexed
 INDEXER_VERSION = "opi-brc20-full-node v0.4.1"
-RECOVERABLE_DB_VERSIONS = [ 4 ]
-DB_VERSION = 5
+RECOVERABLE_DB_VERSIONS = [ 4, 5 ]
+DB_VERSION = 6
 EVENT_HASH_VERSION = 2
 
 SELF_MINT_ENABLE_HEIGHT = 837090
@@ -48,6 +51,22 @@ report_retries = int(os.getenv("REPORT_RETRIES") or "10")
 report_name = os.getenv("REPORT_NAME") or "opi_brc20_indexer"
 create_extra_tables = (os.getenv("CREATE_EXTRA_TABLES") or "false") == "true"
 network_type = os.getenv("NETWORK_TYPE") or "mainnet"
+bulk_writer = os.getenv("BULK_WRITER") or "copy" ## copy or insert
+catchup_mode = (os.getenv("CATCHUP_MODE") or "true") == "true"
+catchup_max_batch_size = int(os.getenv("CATCHUP_MAX_BATCH_SIZE") or "100")
+catchup_max_transfers = int(os.getenv("CATCHUP_MAX_TRANSFERS") or "50000")
+prefetch_blocks = int(os.getenv("PREFETCH_BLOCKS") or "3")
+partition_block_count = int(os.getenv("PARTITION_BLOCK_COUNT") or "10000")
+undo_keep_blocks = int(os.getenv("UNDO_KEEP_BLOCKS") or "20")
+balance_cache_max_mb = int(os.getenv("BALANCE_CACHE_MAX_MB") or "512")
+profile_mode = os.getenv("PROFILE_MODE") or "" ## cprofile, sampling or empty to disable
+profile_start_height = int(os.getenv("PROFILE_START_HEIGHT") or "0")
+profile_end_height = int(os.getenv("PROFILE_END_HEIGHT") or "0")
+profile_sample_interval_ms = int(os.getenv("PROFILE_SAMPLE_INTERVAL_MS") or "10")
+profile_output_file = os.getenv("PROFILE_OUTPUT_FILE") or "brc20_profile"
+listen_new_blocks = (os.getenv("LISTEN_NEW_BLOCKS") or "true") == "true"
+new_block_wait_timeout = int(os.getenv("NEW_BLOCK_WAIT_TIMEOUT") or "30")
+reindex_workers = int(os.getenv("REINDEX_WORKERS") or "4")
 
 first_inscription_heights = {
   'mainnet': 767430,
@@ -69,6 +88,10 @@ if network_type == 'regtest':
   report_to_indexer = False
   print("Network type is regtest, reporting to indexer is disabled.")
 
+if profile_mode not in ["", "cprofile", "sampling"]:
+  print("PROFILE_MODE must be cprofile, sampling or empty")
+  sys.exit(1)
+
 ## connect to db
 conn = psycopg2.connect(
   host=db_host,
@@ -88,6 +111,10 @@ conn_metaprotocol = psycopg2.connect(
 conn_metaprotocol.autocommit = True
 cur_metaprotocol = conn_metaprotocol.cursor()
 
+## main_index notifies opi_new_block when a new block_hashes row is committed (see check_db in main_index/index.js)
+if listen_new_blocks:
+  cur_metaprotocol.execute('''LISTEN opi_new_block;''')
+
 ## create tables if not exists
 ## does brc20_block_hashes table exist?
 cur.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = 'brc20_block_hashes') AS table_existence;''')
@@ -98,6 +125,16 @@ if cur.fetchone()[0] == False:
     cur.execute(sql)
   conn.commit()
 
+## these tables were added later, create them on databases initialised before them
+for table_name in ['brc20_indexer_work_stats', 'brc20_block_undo']:
+  cur.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = %s) AS table_existence;''', (table_name,))
+  if cur.fetchone()[0] == False:
+    print("Creating " + table_name + "...")
+    with open('db_init.sql', 'r') as f:
+      for statement in f.read().split(';'):
+        if 'public.' + table_name + ' ' in statement: ## table and its indexes
+          cur.execute(statement.strip() + ';')
+
 if create_extra_tables:
   cur.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = 'brc20_extras_block_hashes') AS table_existence;''')
   if cur.fetchone()[0] == False:
@@ -107,6 +144,16 @@ if create_extra_tables:
       cur.execute(sql)
     conn.commit()
 
+  ## these tables were added later, create them on databases initialised before them
+  for table_name in ['brc20_extras_block_undo']:
+    cur.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = %s) AS table_existence;''', (table_name,))
+    if cur.fetchone()[0] == False:
+      print("Creating " + table_name + "...")
+      with open('db_init_extra.sql', 'r') as f:
+        for statement in f.read().split(';'):
+          if 'public.' + table_name + ' ' in statement: ## table and its indexes
+            cur.execute(statement.strip() + ';')
+
 cur_metaprotocol.execute('SELECT network_type from ord_network_type LIMIT 1;')
 if cur_metaprotocol.rowcount == 0:
   print("ord_network_type not found, main db needs to be recreated from scratch or fixed with index.js, please run index.js in main_index")
@@ -135,75 +182,6 @@ if default_max_transfer_cnt < 2:
 
 ## helper functions
 
-def utf8len(s):
-  return len(s.encode('utf-8'))
-
-def is_positive_number(s, do_strip=False):
-  try:
-    if do_strip:
-      s = s.strip()
-    try:
-      if len(s) == 0: return False
-      for ch in s:
-        if ord(ch) > ord('9') or ord(ch) < ord('0'):
-          return False
-      return True
-    except KeyboardInterrupt:
-      raise KeyboardInterrupt
-    except: return False
-  except KeyboardInterrupt:
-    raise KeyboardInterrupt
-  except: return False ## has to be a string
-
-def is_positive_number_with_dot(s, do_strip=False):
-  try:
-    if do_strip:
-      s = s.strip()
-    try:
-      dotFound = False
-      if len(s) == 0: return False
-      if s[0] == '.': return False
-      if s[-1] == '.': return False
-      for ch in s:
-        if ord(ch) > ord('9') or ord(ch) < ord('0'):
-          if ch != '.': return False
-          if dotFound: return False
-          dotFound = True
-      return True
-    except KeyboardInterrupt:
-      raise KeyboardInterrupt
-    except: return False
-  except KeyboardInterrupt:
-    raise KeyboardInterrupt
-  except: return False ## has to be a string
-
-def get_number_extended_to_18_decimals(s, decimals, do_strip=False):
-  if do_strip:
-    s = s.strip()
-  
-  if '.' in s:
-    normal_part = s.split('.')[0]
-    if len(s.split('.')[1]) > decimals or len(s.split('.')[1]) == 0: ## more decimal digit than allowed or no decimal digit after dot
-      return None
-    decimals_part = s.split('.')[1][:decimals]
-    decimals_part += '0' * (18 - len(decimals_part))
-    return int(normal_part + decimals_part)
-  else:
-    return int(s) * 10 ** 18
-
-def fix_numstr_decimals(num_str, decimals):
-  if len(num_str) <= 18:
-    num_str = '0' * (18 - len(num_str)) + num_str
-    num_str = '0.' + num_str
-    if decimals < 18:
-      num_str = num_str[:-18+decimals]
-  else:
-    num_str = num_str[:-18] + '.' + num_str[-18:]
-    if decimals < 18:
-      num_str = num_str[:-18+decimals]
-  if num_str[-1] == '.': num_str = num_str[:-1] ## remove trailing dot
-  return num_str
-
 def get_event_str(event, event_type, inscription_id):
   global ticks
   if event_type == "deploy-inscribe":
@@ -254,88 +232,110 @@ def get_event_str(event, event_type, inscription_id):
     print("EVENT TYPE ERROR!!")
     exit(1)
 
-def get_sha256_hash(s):
-  return hashlib.sha256(s.encode('utf-8')).hexdigest()
-
-
-
-
-
 ## caches
-transfer_inscribe_event_cache = {} ## single use cache for transfer inscribe events
-def get_transfer_inscribe_event(inscription_id):
-  global transfer_inscribe_event_cache, event_types
-  if inscription_id in transfer_inscribe_event_cache:
-    event = transfer_inscribe_event_cache[inscription_id]
-    del transfer_inscribe_event_cache[inscription_id]
-    return event
-  cur.execute('''select event from brc20_events where event_type = %s and inscription_id = %s;''', (event_types["transfer-inscribe"], inscription_id,))
-  return cur.fetchall()[0][0]
-
-def save_transfer_inscribe_event(inscription_id, event):
-  transfer_inscribe_event_cache[inscription_id] = event
-
-balance_cache = {}
+balance_cache = LRUCache("balance cache", balance_cache_max_mb * 1024 * 1024) ## keys are (pkscript, tick), values are Balance records
 def get_last_balance(pkscript, tick):
   global balance_cache
-  cache_key = pkscript + tick
-  if cache_key in balance_cache:
-    return balance_cache[cache_key]
+  cache_key = (sys.intern(pkscript), sys.intern(tick))
+  balance_obj = balance_cache.get(cache_key)
+  if balance_obj is not None:
+    return balance_obj
+  st_tm = time.time()
   cur.execute('''select overall_balance, available_balance from brc20_historic_balances where pkscript = %s and tick = %s order by block_height desc, id desc limit 1;''', (pkscript, tick))
   row = cur.fetchone()
-  balance_obj = None
+  work_stats.add_time("balance_fetch_tm", st_tm)
   if row is None:
-    balance_obj = {
-      "overall_balance": 0,
-      "available_balance": 0
-    }
+    balance_obj = Balance(0, 0)
   else:
-    balance_obj = {
-      "overall_balance": row[0],
-      "available_balance": row[1]
-    }
-  balance_cache[cache_key] = balance_obj
+    balance_obj = Balance(row[0], row[1])
+  balance_cache.set(cache_key, balance_obj)
   return balance_obj
 
 def check_available_balance(pkScript, tick, amount):
   last_balance = get_last_balance(pkScript, tick)
-  available_balance = last_balance["available_balance"]
+  available_balance = last_balance.available_balance
   if available_balance < amount: return False
   return True
 
 
-transfer_validity_cache = {}
+## loads latest balances of all (pkscript, tick) pairs the transfers may touch with set-based queries
+## only seeds keys missing from the cache, cached entries may have uncommitted changes
+def prefetch_balances(transfers):
+  keys = set()
+  deployed_ticks = set()
+  for transfer in transfers:
+    tx_id, inscr_id, old_satpoint, new_pkScript, new_addr, sent_as_fee, js, content_type, parent_id = transfer
+    if js is None or new_pkScript is None: continue
+    tick = js.get("tick")
+    op = js.get("op")
+    if not isinstance(tick, str): continue
+    tick = tick.lower()
+    if op == 'deploy': deployed_ticks.add(tick)
+    elif op == 'mint' or op == 'transfer':
+      if tick not in ticks and tick not in deployed_ticks: continue
+      cache_key = (sys.intern(new_pkScript), sys.intern(tick))
+      if cache_key not in balance_cache: keys.add(cache_key)
+      if op == 'transfer' and old_satpoint != '' and inscr_id in unused_transfers: ## source of transfer-transfer
+        cache_key = (unused_transfers[inscr_id][2], unused_transfers[inscr_id][0])
+        if cache_key not in balance_cache: keys.add(cache_key)
+  if len(keys) == 0: return
+  keys = list(keys)
+  sttm = time.time()
+  for i in range(0, len(keys), 10000):
+    batch_keys = keys[i:i+10000]
+    ## top-1 lookup per key on brc20_historic_balances_pkscript_tick_block_height_idx
+    cur.execute('''select k.pkscript, k.tick, hb.overall_balance, hb.available_balance
+                   from unnest(%s::text[], %s::text[]) as k(pkscript, tick)
+                   cross join lateral (select overall_balance, available_balance
+                                       from brc20_historic_balances
+                                       where pkscript = k.pkscript and tick = k.tick
+                                       order by block_height desc, id desc limit 1) hb;''', ([k[0] for k in batch_keys], [k[1] for k in batch_keys]))
+    found = {}
+    for row in cur.fetchall():
+      found[(row[0], row[1])] = row
+    for cache_key in batch_keys:
+      row = found.get(cache_key)
+      if row is None: balance_cache.set(cache_key, Balance(0, 0))
+      else: balance_cache.set(cache_key, Balance(row[2], row[3]))
+  work_stats.add_time("balance_fetch_tm", sttm)
+  print("Prefetched " + str(len(keys)) + " balances in " + str(time.time() - sttm) + " seconds")
+
+## resident index of transfer inscriptions which are inscribed but not transferred yet
+## inscription_id -> (tick, amount, source_pkScript, source_wallet, event_id, block_height)
+## changes of a block are only undone by reorg_fix or by reloading it from db after a failed block
+unused_transfers = {}
+def load_unused_transfers():
+  global unused_transfers
+  sttm = time.time()
+  cur.execute('''select i.inscription_id, i.tick, i.amount, i.source_pkscript, i.source_wallet, i.id, i.block_height
+                 from brc20_events i
+                 where i.event_type = %s
+                   and not exists (select 1 from brc20_events t where t.event_type = %s and t.inscription_id = i.inscription_id);''', (event_types["transfer-inscribe"], event_types["transfer-transfer"]))
+  unused_transfers = {}
+  for row in cur.fetchall():
+    unused_transfers[row[0]] = (sys.intern(row[1]), row[2], sys.intern(row[3]), row[4], row[5], row[6])
+  print("Unused transfers loaded (" + str(len(unused_transfers)) + ") in " + str(time.time() - sttm) + " seconds")
+
+def add_unused_transfer(inscription_id, tick, amount, source_pkScript, source_wallet, event_id, block_height):
+  unused_transfers[inscription_id] = (sys.intern(tick), amount, sys.intern(source_pkScript), source_wallet, event_id, block_height)
+
 def is_used_or_invalid(inscription_id):
-  global event_types, transfer_validity_cache
-  if inscription_id in transfer_validity_cache:
-    return transfer_validity_cache[inscription_id] != 1
-  cur.execute('''select coalesce(sum(case when event_type = %s then 1 else 0 end), 0) as inscr_cnt,
-                        coalesce(sum(case when event_type = %s then 1 else 0 end), 0) as transfer_cnt
-                        from brc20_events where inscription_id = %s;''', (event_types["transfer-inscribe"], event_types["transfer-transfer"], inscription_id,))
-  row = cur.fetchall()[0]
-  if row[0] != 1:
-    transfer_validity_cache[inscription_id] = 0 ## invalid transfer (no inscribe event)
-    return True
-  elif row[1] != 0:
-    transfer_validity_cache[inscription_id] = -1 ## used
-    return True
-  else:
-    transfer_validity_cache[inscription_id] = 1 ## valid
-    return False
-
-def set_transfer_as_used(inscription_id):
-  global transfer_validity_cache
-  transfer_validity_cache[inscription_id] = -1
-
-def set_transfer_as_valid(inscription_id):
-  global transfer_validity_cache
-  transfer_validity_cache[inscription_id] = 1
-
-def reset_caches():
-  global balance_cache, transfer_inscribe_event_cache, ticks, transfer_validity_cache
-  balance_cache = {}
-  transfer_inscribe_event_cache = {}
-  transfer_validity_cache = {}
+  return inscription_id not in unused_transfers
+
+## single use, removes the transfer from unused transfers
+def get_transfer_inscribe_event(inscription_id):
+  transfer = unused_transfers.pop(inscription_id)
+  spent_transfers_of_block.append((inscription_id,) + transfer)
+  return transfer[2], transfer[3] ## source_pkScript, source_wallet
+
+def reset_caches(reload_unused_transfers=True):
+  global balance_cache
+  balance_cache.clear()
+  if reload_unused_transfers: load_unused_transfers()
+  load_ticks()
+
+def load_ticks():
+  global ticks
   sttm = time.time()
   cur.execute('''select tick, remaining_supply, limit_per_mint, decimals, is_self_mint, deploy_inscription_id from brc20_tickers;''')
   ticks_ = cur.fetchall()
@@ -344,8 +344,13 @@ def reset_caches():
     ticks[t[0]] = [t[1], t[2], t[3], t[4], t[5]]
   print("Ticks refreshed in " + str(time.time() - sttm) + " seconds")
 
+## evicts least recently used entries over the memory budget, only call after commit
+def trim_caches():
+  balance_cache.trim()
+  print(balance_cache.stats_str())
+
 block_start_max_event_id = None
-brc20_events_insert_sql = '''insert into brc20_events (id, event_type, block_height, inscription_id, event) values '''
+brc20_events_insert_sql = '''insert into brc20_events (id, event_type, block_height, inscription_id, tick, original_tick, amount, source_pkscript, source_wallet, spent_pkscript, spent_wallet, using_tx_id, parent_id, extra) values '''
 brc20_events_insert_cache = []
 brc20_tickers_insert_sql = '''insert into brc20_tickers (tick, original_tick, max_supply, decimals, limit_per_mint, remaining_supply, block_height, is_self_mint, deploy_inscription_id) values '''
 brc20_tickers_insert_cache = []
@@ -357,7 +362,7 @@ brc20_historic_balances_insert_sql = '''insert into brc20_historic_balances (pks
 brc20_historic_balances_insert_cache = []
 
 def deploy_inscribe(block_height, inscription_id, deployer_pkScript, deployer_wallet, tick, original_tick, max_supply, decimals, limit_per_mint, is_self_mint):
-  global ticks, in_commit, block_events_str, event_types
+  global ticks, block_events_hasher, event_types
 
   event = {
     "deployer_pkScript": deployer_pkScript,
@@ -369,16 +374,17 @@ def deploy_inscribe(block_height, inscription_id, deployer_pkScript, deployer_wa
     "limit_per_mint": str(limit_per_mint),
     "is_self_mint": str(is_self_mint)
   }
-  block_events_str += get_event_str(event, "deploy-inscribe", inscription_id) + EVENT_SEPARATOR
+  block_events_hasher.add(get_event_str(event, "deploy-inscribe", inscription_id))
   event_id = block_start_max_event_id + len(brc20_events_insert_cache) + 1
-  brc20_events_insert_cache.append((event_id, event_types["deploy-inscribe"], block_height, inscription_id, json.dumps(event)))
+  brc20_events_insert_cache.append((event_id, event_types["deploy-inscribe"], block_height, inscription_id, tick, original_tick, None, deployer_pkScript, deployer_wallet, None, None, None, None,
+                                    json.dumps({ "max_supply": event["max_supply"], "decimals": event["decimals"], "limit_per_mint": event["limit_per_mint"], "is_self_mint": event["is_self_mint"] })))
   
   brc20_tickers_insert_cache.append((tick, original_tick, max_supply, decimals, limit_per_mint, max_supply, block_height, is_self_mint == "true", inscription_id))
   
   ticks[tick] = [max_supply, limit_per_mint, decimals, is_self_mint == "true", inscription_id]
 
 def mint_inscribe(block_height, inscription_id, minted_pkScript, minted_wallet, tick, original_tick, amount, parent_id):
-  global ticks, in_commit, block_events_str, event_types
+  global ticks, block_events_hasher, event_types
 
   event = {
     "minted_pkScript": minted_pkScript,
@@ -388,20 +394,20 @@ def mint_inscribe(block_height, inscription_id, minted_pkScript, minted_wallet,
     "amount": str(amount),
     "parent_id": parent_id
   }
-  block_events_str += get_event_str(event, "mint-inscribe", inscription_id) + EVENT_SEPARATOR
+  block_events_hasher.add(get_event_str(event, "mint-inscribe", inscription_id))
   event_id = block_start_max_event_id + len(brc20_events_insert_cache) + 1
-  brc20_events_insert_cache.append((event_id, event_types["mint-inscribe"], block_height, inscription_id, json.dumps(event)))
+  brc20_events_insert_cache.append((event_id, event_types["mint-inscribe"], block_height, inscription_id, tick, original_tick, amount, minted_pkScript, minted_wallet, None, None, None, parent_id, None))
   brc20_tickers_remaining_supply_update_cache[tick] = brc20_tickers_remaining_supply_update_cache.get(tick, 0) + amount
 
   last_balance = get_last_balance(minted_pkScript, tick)
-  last_balance["overall_balance"] += amount
-  last_balance["available_balance"] += amount
-  brc20_historic_balances_insert_cache.append((minted_pkScript, minted_wallet, tick, last_balance["overall_balance"], last_balance["available_balance"], block_height, event_id))
+  last_balance.overall_balance += amount
+  last_balance.available_balance += amount
+  brc20_historic_balances_insert_cache.append((minted_pkScript, minted_wallet, tick, last_balance.overall_balance, last_balance.available_balance, block_height, event_id))
   
   ticks[tick][0] -= amount
 
 def transfer_inscribe(block_height, inscription_id, source_pkScript, source_wallet, tick, original_tick, amount):
-  global in_commit, block_events_str, event_types
+  global block_events_hasher, event_types
 
   event = {
     "source_pkScript": source_pkScript,
@@ -410,23 +416,20 @@ def transfer_inscribe(block_height, inscription_id, source_pkScript, source_wall
     "original_tick": original_tick,
     "amount": str(amount)
   }
-  block_events_str += get_event_str(event, "transfer-inscribe", inscription_id) + EVENT_SEPARATOR
+  block_events_hasher.add(get_event_str(event, "transfer-inscribe", inscription_id))
   event_id = block_start_max_event_id + len(brc20_events_insert_cache) + 1
-  brc20_events_insert_cache.append((event_id, event_types["transfer-inscribe"], block_height, inscription_id, json.dumps(event)))
-  set_transfer_as_valid(inscription_id)
+  brc20_events_insert_cache.append((event_id, event_types["transfer-inscribe"], block_height, inscription_id, tick, original_tick, amount, source_pkScript, source_wallet, None, None, None, None, None))
+  add_unused_transfer(inscription_id, tick, amount, source_pkScript, source_wallet, event_id, block_height)
   
   last_balance = get_last_balance(source_pkScript, tick)
-  last_balance["available_balance"] -= amount
-  brc20_historic_balances_insert_cache.append((source_pkScript, source_wallet, tick, last_balance["overall_balance"], last_balance["available_balance"], block_height, event_id))
-  
-  save_transfer_inscribe_event(inscription_id, event)
+  last_balance.available_balance -= amount
+  brc20_historic_balances_insert_cache.append((source_pkScript, source_wallet, tick, last_balance.overall_balance, last_balance.available_balance, block_height, event_id))
 
 def transfer_transfer_normal(block_height, inscription_id, spent_pkScript, spent_wallet, tick, original_tick, amount, using_tx_id):
-  global in_commit, block_events_str, event_types
+  global block_events_hasher, event_types
 
   inscribe_event = get_transfer_inscribe_event(inscription_id)
-  source_pkScript = inscribe_event["source_pkScript"]
-  source_wallet = inscribe_event["source_wallet"]
+  source_pkScript, source_wallet = inscribe_event
   event = {
     "source_pkScript": source_pkScript,
     "source_wallet": source_wallet,
@@ -437,30 +440,28 @@ def transfer_transfer_normal(block_height, inscription_id, spent_pkScript, spent
     "amount": str(amount),
     "using_tx_id": str(using_tx_id)
   }
-  block_events_str += get_event_str(event, "transfer-transfer", inscription_id) + EVENT_SEPARATOR
+  block_events_hasher.add(get_event_str(event, "transfer-transfer", inscription_id))
   event_id = block_start_max_event_id + len(brc20_events_insert_cache) + 1
-  brc20_events_insert_cache.append((event_id, event_types["transfer-transfer"], block_height, inscription_id, json.dumps(event)))
-  set_transfer_as_used(inscription_id)
+  brc20_events_insert_cache.append((event_id, event_types["transfer-transfer"], block_height, inscription_id, tick, original_tick, amount, source_pkScript, source_wallet, spent_pkScript, spent_wallet, using_tx_id, None, None))
   
   last_balance = get_last_balance(source_pkScript, tick)
-  last_balance["overall_balance"] -= amount
-  brc20_historic_balances_insert_cache.append((source_pkScript, source_wallet, tick, last_balance["overall_balance"], last_balance["available_balance"], block_height, event_id))
+  last_balance.overall_balance -= amount
+  brc20_historic_balances_insert_cache.append((source_pkScript, source_wallet, tick, last_balance.overall_balance, last_balance.available_balance, block_height, event_id))
   
   if spent_pkScript != source_pkScript:
     last_balance = get_last_balance(spent_pkScript, tick)
-  last_balance["overall_balance"] += amount
-  last_balance["available_balance"] += amount
-  brc20_historic_balances_insert_cache.append((spent_pkScript, spent_wallet, tick, last_balance["overall_balance"], last_balance["available_balance"], block_height, -1 * event_id)) ## negated to make a unique event_id
+  last_balance.overall_balance += amount
+  last_balance.available_balance += amount
+  brc20_historic_balances_insert_cache.append((spent_pkScript, spent_wallet, tick, last_balance.overall_balance, last_balance.available_balance, block_height, -1 * event_id)) ## negated to make a unique event_id
   
   if spent_pkScript == '6a':
     brc20_tickers_burned_supply_update_cache[tick] = brc20_tickers_burned_supply_update_cache.get(tick, 0) + amount
 
 def transfer_transfer_spend_to_fee(block_height, inscription_id, tick, original_tick, amount, using_tx_id):
-  global in_commit, block_events_str, event_types
+  global block_events_hasher, event_types
 
   inscribe_event = get_transfer_inscribe_event(inscription_id)
-  source_pkScript = inscribe_event["source_pkScript"]
-  source_wallet = inscribe_event["source_wallet"]
+  source_pkScript, source_wallet = inscribe_event
   event = {
     "source_pkScript": source_pkScript,
     "source_wallet": source_wallet,
@@ -471,55 +472,192 @@ def transfer_transfer_spend_to_fee(block_height, inscription_id, tick, original_
     "amount": str(amount),
     "using_tx_id": str(using_tx_id)
   }
-  block_events_str += get_event_str(event, "transfer-transfer", inscription_id) + EVENT_SEPARATOR
+  block_events_hasher.add(get_event_str(event, "transfer-transfer", inscription_id))
   event_id = block_start_max_event_id + len(brc20_events_insert_cache) + 1
-  brc20_events_insert_cache.append((event_id, event_types["transfer-transfer"], block_height, inscription_id, json.dumps(event)))
-  set_transfer_as_used(inscription_id)
+  brc20_events_insert_cache.append((event_id, event_types["transfer-transfer"], block_height, inscription_id, tick, original_tick, amount, source_pkScript, source_wallet, None, None, using_tx_id, None, None))
   
   last_balance = get_last_balance(source_pkScript, tick)
-  last_balance["available_balance"] += amount
-  brc20_historic_balances_insert_cache.append((source_pkScript, source_wallet, tick, last_balance["overall_balance"], last_balance["available_balance"], block_height, event_id))
-
-
-def update_event_hashes(block_height):
-  global block_events_str
-  if len(block_events_str) > 0 and block_events_str[-1] == EVENT_SEPARATOR: block_events_str = block_events_str[:-1] ## remove last separator
-  block_event_hash = get_sha256_hash(block_events_str)
-  cumulative_event_hash = None
-  cur.execute('''select cumulative_event_hash from brc20_cumulative_event_hashes where block_height = %s;''', (block_height - 1,))
-  if cur.rowcount == 0:
-    cumulative_event_hash = block_event_hash
-  else:
-    cumulative_event_hash = get_sha256_hash(cur.fetchone()[0] + block_event_hash)
-  cur.execute('''INSERT INTO brc20_cumulative_event_hashes (block_height, block_event_hash, cumulative_event_hash) VALUES (%s, %s, %s);''', (block_height, block_event_hash, cumulative_event_hash))
-
-def index_block(block_height, current_block_hash):
-  global ticks, block_events_str, block_start_max_event_id, brc20_events_insert_cache, brc20_tickers_insert_cache, brc20_tickers_remaining_supply_update_cache, brc20_tickers_burned_supply_update_cache, brc20_historic_balances_insert_cache, in_commit
-  print("Indexing block " + str(block_height))
-  block_events_str = ""
-
-  if block_height < first_brc20_height:
-    print("Block height is before first brc20 height, skipping")
-    update_event_hashes(block_height)
-    cur.execute('''INSERT INTO brc20_block_hashes (block_height, block_hash) VALUES (%s, %s);''', (block_height, current_block_hash))
-    return
-  
-  cur_metaprotocol.execute('''SELECT ot.id, ot.inscription_id, ot.old_satpoint, ot.new_pkscript, ot.new_wallet, ot.sent_as_fee, oc."content", oc.content_type, onti.parent_id
-                              FROM ord_transfers ot
-                              LEFT JOIN ord_content oc ON ot.inscription_id = oc.inscription_id
-                              LEFT JOIN ord_number_to_id onti ON ot.inscription_id = onti.inscription_id
-                              WHERE ot.block_height = %s 
-                                 AND onti.cursed_for_brc20 = false
-                                 AND oc."content" is not null AND oc."content"->>'p'='brc-20'
-                              ORDER BY ot.id asc;''', (block_height,))
-  transfers = cur_metaprotocol.fetchall()
-  if len(transfers) == 0:
-    print("No transfers found for block " + str(block_height))
-    update_event_hashes(block_height)
-    cur.execute('''INSERT INTO brc20_block_hashes (block_height, block_hash) VALUES (%s, %s);''', (block_height, current_block_hash))
-    return
-  print("Transfer count: ", len(transfers))
-
+  last_balance.available_balance += amount
+  brc20_historic_balances_insert_cache.append((source_pkScript, source_wallet, tick, last_balance.overall_balance, last_balance.available_balance, block_height, event_id))
+
+
+def get_event_hashes(last_cumulative_event_hash):
+  work_stats.add_count("event_count", block_events_hasher.event_cnt)
+  block_event_hash = block_events_hasher.hexdigest()
+  cumulative_event_hash = get_cumulative_event_hash(last_cumulative_event_hash, block_event_hash)
+  return block_event_hash, cumulative_event_hash
+
+
+brc20_transfers_select_sql = '''SELECT ot.id, ot.inscription_id, ot.old_satpoint, ot.new_pkscript, ot.new_wallet, ot.sent_as_fee, oc."content", oc.content_type, onti.parent_id
+                                FROM ord_transfers ot
+                                LEFT JOIN ord_content oc ON ot.inscription_id = oc.inscription_id
+                                LEFT JOIN ord_number_to_id onti ON ot.inscription_id = onti.inscription_id
+                                WHERE ot.block_height = %s 
+                                   AND onti.cursed_for_brc20 = false
+                                   AND oc."content" is not null AND oc."content"->>'p'='brc-20'
+                                ORDER BY ot.id asc;'''
+brc20_transfers_range_select_sql = '''SELECT ot.block_height, ot.id, ot.inscription_id, ot.old_satpoint, ot.new_pkscript, ot.new_wallet, ot.sent_as_fee, oc."content", oc.content_type, onti.parent_id
+                                      FROM ord_transfers ot
+                                      LEFT JOIN ord_content oc ON ot.inscription_id = oc.inscription_id
+                                      LEFT JOIN ord_number_to_id onti ON ot.inscription_id = onti.inscription_id
+                                      WHERE ot.block_height >= %s AND ot.block_height <= %s
+                                         AND onti.cursed_for_brc20 = false
+                                         AND oc."content" is not null AND oc."content"->>'p'='brc-20'
+                                      ORDER BY ot.block_height asc, ot.id asc;'''
+## fetches transfers of the next blocks on a separate connection while the current block is being indexed
+## each block is read in a single repeatable read transaction so block_hash and transfers are consistent
+## results are tagged with a generation number, restart() invalidates everything fetched before it
+## starts paused, it is only run in block by block mode since catch-up batches fetch their whole range themselves
+class TransferPrefetcher(threading.Thread):
+  def __init__(self, depth):
+    super().__init__(daemon=True)
+    self.queue = queue.Queue(maxsize=depth)
+    self.lock = threading.Lock()
+    self.generation = 0
+    self.next_height = None
+
+  def restart(self, block_height):
+    with self.lock:
+      self.generation += 1
+      self.next_height = block_height
+    while True:
+      try: self.queue.get_nowait()
+      except queue.Empty: break
+
+  def pause(self):
+    self.restart(None)
+
+  ## starts fetching from block_height if paused, a running prefetch is kept
+  def resume(self, block_height):
+    with self.lock:
+      if self.next_height is not None: return
+    self.restart(block_height)
+
+  def get(self, block_height, block_hash):
+    while True:
+      try: generation, height, prefetched_block_hash, transfers = self.queue.get_nowait()
+      except queue.Empty:
+        with self.lock: next_height = self.next_height
+        if next_height is None or next_height < block_height or next_height > block_height + 1: break ## block is not being fetched
+        try: generation, height, prefetched_block_hash, transfers = self.queue.get(timeout=60)
+        except queue.Empty: break
+      if generation != self.generation or height < block_height: continue ## stale
+      if height == block_height and prefetched_block_hash == block_hash: return transfers
+      break
+    print("Prefetched transfers not usable for block " + str(block_height) + ", restarting prefetch")
+    self.restart(block_height + 1)
+    return None
+
+  def run(self):
+    conn_prefetch = None
+    while True:
+      try:
+        if conn_prefetch is None:
+          conn_prefetch = psycopg2.connect(
+            host=db_metaprotocol_host,
+            port=db_metaprotocol_port,
+            database=db_metaprotocol_database,
+            user=db_metaprotocol_user,
+            password=db_metaprotocol_password)
+          conn_prefetch.set_session(isolation_level='REPEATABLE READ', readonly=True)
+          cur_prefetch = conn_prefetch.cursor()
+        with self.lock:
+          generation = self.generation
+          height = self.next_height
+        if height is None:
+          time.sleep(1)
+          continue
+        cur_prefetch.execute('''select block_hash from block_hashes where block_height = %s;''', (height,))
+        row = cur_prefetch.fetchone()
+        if row is None:
+          conn_prefetch.rollback()
+          time.sleep(1) ## block not indexed by main indexer yet
+          continue
+        transfers = []
+        if height >= first_brc20_height:
+          cur_prefetch.execute(brc20_transfers_select_sql, (height,))
+          transfers = cur_prefetch.fetchall()
+        conn_prefetch.rollback() ## end of snapshot
+        with self.lock:
+          if generation != self.generation: continue
+          self.next_height = height + 1
+        while generation == self.generation:
+          try:
+            self.queue.put((generation, height, row[0], transfers), timeout=1)
+            break
+          except queue.Full: pass
+      except:
+        traceback.print_exc()
+        print("Prefetch failed, reconnecting in 5 seconds")
+        try: conn_prefetch.close()
+        except: pass
+        conn_prefetch = None
+        time.sleep(5)
+
+transfer_prefetcher = None
+def get_block_transfers(block_height, block_hash):
+  if transfer_prefetcher is not None:
+    transfers = transfer_prefetcher.get(block_height, block_hash)
+    if transfers is not None: return transfers
+  cur_metaprotocol.execute(brc20_transfers_select_sql, (block_height,))
+  return cur_metaprotocol.fetchall()
+
+brc20_cumulative_event_hashes_insert_sql = '''insert into brc20_cumulative_event_hashes (block_height, block_event_hash, cumulative_event_hash) values '''
+brc20_cumulative_event_hashes_insert_cache = []
+brc20_block_hashes_insert_sql = '''insert into brc20_block_hashes (block_height, block_hash) values '''
+brc20_block_hashes_insert_cache = []
+
+## brc20_events and brc20_historic_balances may be range partitioned on block_height (see db_init.sql)
+## partitions of PARTITION_BLOCK_COUNT blocks are created before a block range is written
+partitioned_tables = None
+created_partitions = set()
+def ensure_partitions(start_height, end_height):
+  global partitioned_tables
+  if partitioned_tables is None:
+    cur.execute('''select c.relname from pg_partitioned_table pt join pg_class c on c.oid = pt.partrelid
+                   where c.relname in ('brc20_events', 'brc20_historic_balances');''')
+    partitioned_tables = [row[0] for row in cur.fetchall()]
+  for partition_start in range(start_height - start_height % partition_block_count, end_height + 1, partition_block_count):
+    for table in partitioned_tables:
+      partition_name = table + "_p" + str(partition_start)
+      if partition_name in created_partitions: continue
+      cur.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = %s) AS table_existence;''', (partition_name,))
+      if cur.fetchone()[0] == False:
+        print("creating partition " + partition_name)
+        cur.execute('''CREATE TABLE public.''' + partition_name + ''' PARTITION OF public.''' + table + ''' FOR VALUES FROM (%s) TO (%s);''', (partition_start, partition_start + partition_block_count))
+      created_partitions.add(partition_name)
+
+## undo record of each block, reorg_fix replays them in reverse instead of re-deriving changes from the tables
+## records are built from the rows the block added to the insert caches
+brc20_block_undo_insert_sql = '''insert into brc20_block_undo (block_height, event_id_start, supply_deltas, burned_deltas, inscribed_transfers, spent_transfers, touched_balances) values '''
+brc20_block_undo_insert_cache = []
+spent_transfers_of_block = [] ## (inscription_id,) + unused_transfers entry of transfers spent in the current block
+def add_block_undo(block_height, events_start_idx, balances_start_idx):
+  global spent_transfers_of_block
+  supply_deltas = {}
+  burned_deltas = {}
+  inscribed_transfers = []
+  for row in brc20_events_insert_cache[events_start_idx:]:
+    if row[1] == event_types["mint-inscribe"]:
+      supply_deltas[row[4]] = supply_deltas.get(row[4], 0) + row[6]
+    elif row[1] == event_types["transfer-inscribe"]:
+      inscribed_transfers.append(row[3])
+    elif row[1] == event_types["transfer-transfer"] and row[9] == '6a':
+      burned_deltas[row[4]] = burned_deltas.get(row[4], 0) + row[6]
+  touched_balances = list(set([(row[0], row[2]) for row in brc20_historic_balances_insert_cache[balances_start_idx:]]))
+  brc20_block_undo_insert_cache.append((block_height, block_start_max_event_id + events_start_idx + 1, json.dumps(supply_deltas), json.dumps(burned_deltas),
+                                        json.dumps(inscribed_transfers), json.dumps(spent_transfers_of_block), json.dumps(touched_balances)))
+  spent_transfers_of_block = []
+
+## undo record of a block without events, written outside of a transaction before the block hashes
+def save_empty_block_undo(block_height):
+  cur.execute('''INSERT INTO brc20_block_undo (block_height) VALUES (%s);''', (block_height,))
+
+def prune_block_undo(block_height):
+  cur.execute('''delete from brc20_block_undo where block_height <= %s;''', (block_height - undo_keep_blocks,))
+
+def reset_insert_caches():
+  global block_start_max_event_id, brc20_events_insert_cache, brc20_tickers_insert_cache, brc20_tickers_remaining_supply_update_cache, brc20_tickers_burned_supply_update_cache, brc20_historic_balances_insert_cache, brc20_cumulative_event_hashes_insert_cache, brc20_block_hashes_insert_cache, brc20_block_undo_insert_cache, spent_transfers_of_block
   cur.execute('''select COALESCE(max(id), -1) from brc20_events;''')
   block_start_max_event_id = cur.fetchone()[0]
   brc20_events_insert_cache = []
@@ -527,7 +665,30 @@ def index_block(block_height, current_block_hash):
   brc20_tickers_remaining_supply_update_cache = {}
   brc20_tickers_burned_supply_update_cache = {}
   brc20_historic_balances_insert_cache = []
-  
+  brc20_cumulative_event_hashes_insert_cache = []
+  brc20_block_hashes_insert_cache = []
+  brc20_block_undo_insert_cache = []
+  spent_transfers_of_block = []
+
+def flush_insert_caches():
+  st_tm = time.time()
+  print("inserting events...")
+  batch_writer.insert(brc20_events_insert_sql, brc20_events_insert_cache, 1000)
+  print("inserting tickers...")
+  batch_writer.insert(brc20_tickers_insert_sql, brc20_tickers_insert_cache, 1000)
+  print("updating tickers remaining_supply...")
+  for tick in brc20_tickers_remaining_supply_update_cache:
+    cur.execute(brc20_tickers_remaining_supply_update_sql, (brc20_tickers_remaining_supply_update_cache[tick], tick))
+  print("updating tickers burned_supply...")
+  for tick in brc20_tickers_burned_supply_update_cache:
+    cur.execute(brc20_tickers_burned_supply_update_sql, (brc20_tickers_burned_supply_update_cache[tick], tick))
+  print("inserting historic balances...")
+  batch_writer.insert(brc20_historic_balances_insert_sql, brc20_historic_balances_insert_cache, 1000)
+  print("inserting undo records...")
+  batch_writer.insert(brc20_block_undo_insert_sql, brc20_block_undo_insert_cache, 1000)
+  work_stats.add_time("write_tm", st_tm)
+
+def index_transfers(block_height, transfers):
   idx = 0
   for transfer in transfers:
     idx += 1
@@ -631,81 +792,209 @@ def index_block(block_height, current_block_hash):
         if is_used_or_invalid(inscr_id): continue ## already used or invalid
         if sent_as_fee: transfer_transfer_spend_to_fee(block_height, inscr_id, tick, original_tick, amount, tx_id)
         else: transfer_transfer_normal(block_height, inscr_id, new_pkScript, new_addr, tick, original_tick, amount, tx_id)
+
+## insert caches, undo record and extra tables of a block, written by engine.commit_block in the block transaction before the hashes
+def write_block(block_height, block_hash):
+  flush_insert_caches()
+  prune_block_undo(block_height)
+  index_extra_tables_from_caches(block_height, block_hash)
+
+## blocks without brc20 transfers only write their undo record and the extra tables
+def write_empty_block(block_height, block_hash):
+  save_empty_block_undo(block_height)
+  prune_block_undo(block_height)
+  index_extra_tables_from_caches(block_height, block_hash, empty_block=True)
+
+def index_block(block_height, current_block_hash):
+  global block_events_hasher
+  if transfer_prefetcher is not None: transfer_prefetcher.resume(block_height)
+  print("Indexing block " + str(block_height))
+  block_events_hasher = engine.start_block(block_height)
+
+  if block_height < first_brc20_height:
+    print("Block height is before first brc20 height, skipping")
+    engine.commit_block(block_height, current_block_hash, write_empty_block)
+    return
   
-  cur.execute("BEGIN;")
-  in_commit = True
-  print("inserting events...")
-  execute_batch_insert(brc20_events_insert_sql, brc20_events_insert_cache, 1000)
-  print("inserting tickers...")
-  execute_batch_insert(brc20_tickers_insert_sql, brc20_tickers_insert_cache, 1000)
-  print("updating tickers remaining_supply...")
-  for tick in brc20_tickers_remaining_supply_update_cache:
-    cur.execute(brc20_tickers_remaining_supply_update_sql, (brc20_tickers_remaining_supply_update_cache[tick], tick))
-  print("updating tickers burned_supply...")
-  for tick in brc20_tickers_burned_supply_update_cache:
-    cur.execute(brc20_tickers_burned_supply_update_sql, (brc20_tickers_burned_supply_update_cache[tick], tick))
-  print("inserting historic balances...")
-  execute_batch_insert(brc20_historic_balances_insert_sql, brc20_historic_balances_insert_cache, 1000)
-  update_event_hashes(block_height)
-  # end of block
-  cur.execute('''INSERT INTO brc20_block_hashes (block_height, block_hash) VALUES (%s, %s);''', (block_height, current_block_hash))
-  print("committing...")
-  cur.execute("COMMIT;")
-  in_commit = False
-  conn.commit()
+  st_tm = time.time()
+  transfers = get_block_transfers(block_height, current_block_hash)
+  work_stats.add_time("fetch_tm", st_tm)
+  work_stats.add_count("transfer_count", len(transfers))
+  if len(transfers) == 0:
+    print("No transfers found for block " + str(block_height))
+    engine.commit_block(block_height, current_block_hash, write_empty_block)
+    return
+  print("Transfer count: ", len(transfers))
+
+  reset_insert_caches()
+  prefetch_balances(transfers)
+  st_tm = time.time()
+  index_transfers(block_height, transfers)
+  add_block_undo(block_height, 0, 0)
+  work_stats.add_time("index_tm", st_tm)
+  ensure_partitions(block_height, block_height)
+  
+  engine.commit_block(block_height, current_block_hash, write_block)
+  trim_caches()
   print("ALL DONE")
 
-def execute_batch_insert(sql_start, cache, batch_size):
-  if len(cache) > 0:
-    single_elem_cnt = len(cache[0])
-    single_insert_sql_part = '(' + ','.join(['%s' for _ in range(single_elem_cnt)]) + ')'
-    for i in range(0, len(cache), batch_size):
-      elem_cnt = min(batch_size, len(cache) - i)
-      sql = sql_start + ','.join([single_insert_sql_part for _ in range(elem_cnt)]) + ';'
-      cur.execute(sql, [elem for sublist in cache[i:i+batch_size] for elem in sublist])
-
-      
-
-def check_for_reorg():
-  cur.execute('select block_height, block_hash from brc20_block_hashes order by block_height desc limit 1;')
-  if cur.rowcount == 0: return None ## nothing indexed yet
-  last_block = cur.fetchone()
-
-  cur_metaprotocol.execute('select block_height, block_hash from block_hashes where block_height = %s;', (last_block[0],))
-  last_block_ord = cur_metaprotocol.fetchone()
-  if last_block_ord[1] == last_block[1]: return None ## last block hashes are the same, no reorg
-
-  print("REORG DETECTED!!")
-  cur.execute('select block_height, block_hash from brc20_block_hashes order by block_height desc limit 10;')
-  hashes = cur.fetchall() ## get last 10 hashes
-  for h in hashes:
-    cur_metaprotocol.execute('select block_height, block_hash from block_hashes where block_height = %s;', (h[0],))
-    block = cur_metaprotocol.fetchone()
-    if block[1] == h[1]: ## found reorg height by a matching hash
-      print("REORG HEIGHT FOUND: " + str(h[0]))
-      return h[0]
+def get_catchup_batch_size(blocks_to_tip):
+  if not catchup_mode: return 1
+  if blocks_to_tip < 10: return 1 ## index block by block near the tip, reporting and extra tables depend on it
+  return max(1, min(catchup_batch_size_limit, blocks_to_tip // 10))
+
+## catch-up mode, indexes a range of blocks with a single ord query and a single transaction
+## produces the same rows as indexing the blocks one by one with index_block
+catchup_batch_size_limit = catchup_max_batch_size
+def index_block_range(start_height, end_height):
+  global block_events_hasher, catchup_batch_size_limit
+  if transfer_prefetcher is not None: transfer_prefetcher.pause() ## the range query fetches these blocks, prefetching them would read them twice
+  print("Indexing blocks " + str(start_height) + " - " + str(end_height))
+
+  cur_metaprotocol.execute('''select block_height, block_hash from block_hashes where block_height >= %s and block_height <= %s order by block_height asc;''', (start_height, end_height))
+  block_hashes = cur_metaprotocol.fetchall()
+  if len(block_hashes) != end_height - start_height + 1:
+    raise Exception("block hashes not found for range " + str(start_height) + " - " + str(end_height))
   
-  ## bigger than 10 block reorg is not supported by ord
-  print("CRITICAL ERROR!!")
-  sys.exit(1)
+  transfers_by_height = {}
+  transfer_cnt = 0
+  st_tm = time.time()
+  if end_height >= first_brc20_height:
+    cur_metaprotocol.execute(brc20_transfers_range_select_sql, (max(start_height, first_brc20_height), end_height))
+    for transfer in cur_metaprotocol.fetchall():
+      transfers_by_height.setdefault(transfer[0], []).append(transfer[1:])
+      transfer_cnt += 1
+  work_stats.add_time("fetch_tm", st_tm)
+  work_stats.add_count("transfer_count", transfer_cnt)
+  print("Transfer count: ", transfer_cnt)
+
+  ## shrink the batch if it was too heavy, grow it back otherwise
+  if transfer_cnt > catchup_max_transfers:
+    catchup_batch_size_limit = max(1, catchup_batch_size_limit // 2)
+  else:
+    catchup_batch_size_limit = min(catchup_max_batch_size, catchup_batch_size_limit * 2)
+
+  reset_insert_caches()
+  prefetch_balances([transfer for block_height in transfers_by_height for transfer in transfers_by_height[block_height]])
+  last_cumulative_event_hash = engine.hash_chain.get_last(start_height)
+  st_tm = time.time()
+  for block_height, block_hash in block_hashes:
+    block_events_hasher = BlockEventHasher()
+    transfers = transfers_by_height.get(block_height, [])
+    events_start_idx = len(brc20_events_insert_cache)
+    balances_start_idx = len(brc20_historic_balances_insert_cache)
+    if len(transfers) > 0:
+      print("Indexing block " + str(block_height) + ", transfer count: " + str(len(transfers)))
+      index_transfers(block_height, transfers)
+    add_block_undo(block_height, events_start_idx, balances_start_idx)
+    block_event_hash, last_cumulative_event_hash = get_event_hashes(last_cumulative_event_hash)
+    brc20_cumulative_event_hashes_insert_cache.append((block_height, block_event_hash, last_cumulative_event_hash))
+    brc20_block_hashes_insert_cache.append((block_height, block_hash))
+  work_stats.add_time("index_tm", st_tm)
+  
+  ensure_partitions(start_height, end_height)
+  engine.begin()
+  flush_insert_caches()
+  prune_block_undo(end_height)
+  print("inserting hashes...")
+  st_tm = time.time()
+  batch_writer.insert(brc20_cumulative_event_hashes_insert_sql, brc20_cumulative_event_hashes_insert_cache, 1000)
+  batch_writer.insert(brc20_block_hashes_insert_sql, brc20_block_hashes_insert_cache, 1000)
+  work_stats.add_time("hash_tm", st_tm)
+  print("committing...")
+  st_tm = time.time()
+  engine.commit()
+  work_stats.add_time("commit_tm", st_tm)
+  engine.hash_chain.set_tip(end_height, last_cumulative_event_hash)
+  trim_caches()
+  print("ALL DONE")
+
+
+## per-block work stats, stage timings are in ms, saved to brc20_indexer_work_stats after each block or catch-up batch
+work_stats_columns = ["transfer_count", "event_count", "fetch_tm", "balance_fetch_tm", "index_tm", "write_tm", "hash_tm", "commit_tm", "extra_tables_tm", "report_tm", "all_tm", "balance_cache_hits", "balance_cache_misses"]
+work_stats = WorkStats(cur, 'brc20_indexer_work_stats', work_stats_columns)
+work_stats.track_cache("balance_cache", balance_cache)
+
+## opt-in profiling of blocks PROFILE_START_HEIGHT - PROFILE_END_HEIGHT
+block_profiler = BlockRangeProfiler(profile_mode, profile_start_height, profile_end_height, profile_sample_interval_ms, profile_output_file)
+
+## runs the block loop, commits and hashes, brc20 rows are written from its own insert caches (write_block) and rolled back with undo records (reorg_fix)
+engine = ProtocolEngine('brc20', conn, cur, conn_metaprotocol, cur_metaprotocol, bulk_writer, work_stats, block_profiler)
+engine.reorg_tables = ['brc20_events', 'brc20_historic_balances', 'brc20_tickers', 'brc20_block_undo'] ## only checked for residue, reorg_fix rolls them back
+batch_writer = engine.writes.writer ## writes the insert caches with COPY or multi-row INSERT
+
 
 def reorg_fix(reorg_height):
-  global event_types
+  engine.hash_chain.reset() ## resync hash chain from db on next block
+  cur.execute('''select block_height, event_id_start, supply_deltas, burned_deltas, inscribed_transfers, spent_transfers, touched_balances
+                 from brc20_block_undo where block_height > %s order by block_height desc;''', (reorg_height,))
+  undo_records = cur.fetchall()
+  cur.execute('''select coalesce(max(block_height), -1) from brc20_block_hashes;''')
+  last_block_height = cur.fetchone()[0]
+  ## undo records are usable only if every block above reorg_height has one (pruned or indexed by an older version otherwise)
+  if len(undo_records) > 0 and undo_records[-1][0] == reorg_height + 1 and undo_records[0][0] - reorg_height == len(undo_records) and undo_records[0][0] >= last_block_height:
+    reorg_fix_with_undo_records(reorg_height, undo_records)
+  else:
+    print("undo records not found for all blocks, rolling back using events")
+    reorg_fix_with_events(reorg_height)
+  if transfer_prefetcher is not None: transfer_prefetcher.pause() ## drop transfers fetched from the orphaned chain
+
+## cost is proportional to the rolled back blocks, only touched balances are dropped from the balance cache
+def reorg_fix_with_undo_records(reorg_height, undo_records):
+  supply_deltas = {}
+  burned_deltas = {}
+  event_id_start = None
+  for record in undo_records:
+    for tick in record[2]: supply_deltas[tick] = supply_deltas.get(tick, 0) + record[2][tick]
+    for tick in record[3]: burned_deltas[tick] = burned_deltas.get(tick, 0) + record[3][tick]
+    if record[1] is not None: event_id_start = record[1] ## records are in descending order
   cur.execute('begin;')
   cur.execute('delete from brc20_tickers where block_height > %s;', (reorg_height,)) ## delete new tickers
-  ## fetch mint events for reverting remaining_supply in other tickers
-  cur.execute('''select event from brc20_events where event_type = %s and block_height > %s;''', (event_types["mint-inscribe"], reorg_height,))
-  rows = cur.fetchall()
-  tick_changes = {}
-  for row in rows:
-    event = row[0]
-    tick = event["tick"]
-    amount = int(event["amount"])
-    if tick not in tick_changes:
-      tick_changes[tick] = 0
-    tick_changes[tick] += amount
-  for tick in tick_changes:
-    cur.execute('''update brc20_tickers set remaining_supply = remaining_supply + %s where tick = %s;''', (tick_changes[tick], tick))
+  cur.execute("SELECT setval('brc20_tickers_id_seq', max(id)) from brc20_tickers;") ## reset id sequence
+  if len(supply_deltas) > 0:
+    cur.execute('''update brc20_tickers t set remaining_supply = t.remaining_supply + d.amount
+                   from unnest(%s::text[], %s::numeric[]) as d(tick, amount) where t.tick = d.tick;''', (list(supply_deltas.keys()), list(supply_deltas.values())))
+  if len(burned_deltas) > 0:
+    cur.execute('''update brc20_tickers t set burned_supply = t.burned_supply - d.amount
+                   from unnest(%s::text[], %s::numeric[]) as d(tick, amount) where t.tick = d.tick;''', (list(burned_deltas.keys()), list(burned_deltas.values())))
+  cur.execute('delete from brc20_events where block_height > %s;', (reorg_height,)) ## delete new events
+  if event_id_start is not None:
+    cur.execute("SELECT setval('brc20_events_id_seq', %s, false);", (event_id_start,)) ## reset id sequence
+  for table in ['brc20_historic_balances', 'brc20_cumulative_event_hashes', 'brc20_block_hashes']: ## delete new rows and reset id sequence to the first deleted id
+    cur.execute('with d as (delete from ' + table + ' where block_height > %s returning id) select min(id) from d;', (reorg_height,))
+    min_id = cur.fetchone()[0]
+    if min_id is not None:
+      cur.execute("SELECT setval(%s, %s, false);", (table + '_id_seq', min_id))
+  cur.execute('delete from brc20_block_undo where block_height > %s;', (reorg_height,))
+  cur.execute('commit;')
+  for record in undo_records:
+    for row in record[5]:
+      add_unused_transfer(row[0], row[1], row[2], row[3], row[4], row[5], row[6])
+    for inscription_id in record[4]:
+      unused_transfers.pop(inscription_id, None)
+    for pkscript, tick in record[6]:
+      balance_cache.discard((pkscript, tick))
+  load_ticks()
+
+def reorg_fix_with_events(reorg_height):
+  cur.execute('begin;')
+  cur.execute('delete from brc20_tickers where block_height > %s;', (reorg_height,)) ## delete new tickers
+  ## revert remaining_supply in other tickers using new mint events
+  cur.execute('''update brc20_tickers t set remaining_supply = t.remaining_supply + m.amount
+                 from (select tick, sum(amount) as amount from brc20_events where event_type = %s and block_height > %s group by tick) m
+                 where t.tick = m.tick;''', (event_types["mint-inscribe"], reorg_height,))
+  ## revert burned_supply in other tickers using new transfers to OP_RETURN
+  cur.execute('''update brc20_tickers t set burned_supply = t.burned_supply - b.amount
+                 from (select tick, sum(amount) as amount from brc20_events where event_type = %s and block_height > %s and spent_pkscript = '6a' group by tick) b
+                 where t.tick = b.tick;''', (event_types["transfer-transfer"], reorg_height,))
+  ## fetch transfer changes for reverting unused transfers
+  cur.execute('''select inscription_id from brc20_events where event_type = %s and block_height > %s;''', (event_types["transfer-inscribe"], reorg_height,))
+  removed_transfers = [row[0] for row in cur.fetchall()]
+  cur.execute('''select i.inscription_id, i.tick, i.amount, i.source_pkscript, i.source_wallet, i.id, i.block_height
+                 from brc20_events t
+                 join brc20_events i on i.inscription_id = t.inscription_id and i.event_type = %s
+                 where t.event_type = %s and t.block_height > %s and i.block_height <= %s;''', (event_types["transfer-inscribe"], event_types["transfer-transfer"], reorg_height, reorg_height,))
+  restored_transfers = cur.fetchall()
   cur.execute('delete from brc20_historic_balances where block_height > %s;', (reorg_height,)) ## delete new balances
   cur.execute('delete from brc20_events where block_height > %s;', (reorg_height,)) ## delete new events
   cur.execute('delete from brc20_cumulative_event_hashes where block_height > %s;', (reorg_height,)) ## delete new bitmaps
@@ -715,37 +1004,13 @@ def reorg_fix(reorg_height):
   cur.execute("SELECT setval('brc20_events_id_seq', max(id)) from brc20_events;") ## reset id sequence
   cur.execute('delete from brc20_block_hashes where block_height > %s;', (reorg_height,)) ## delete new block hashes
   cur.execute("SELECT setval('brc20_block_hashes_id_seq', max(id)) from brc20_block_hashes;") ## reset id sequence
+  cur.execute('delete from brc20_block_undo where block_height > %s;', (reorg_height,))
   cur.execute('commit;')
-  reset_caches()
-
-def check_if_there_is_residue_from_last_run():
-  cur.execute('''select max(block_height) from brc20_block_hashes;''')
-  row = cur.fetchone()
-  current_block = None
-  if row[0] is None: current_block = first_inscription_height
-  else: current_block = row[0] + 1
-  residue_found = False
-  cur.execute('''select coalesce(max(block_height), -1) from brc20_events;''')
-  if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
-    residue_found = True
-    print("residue on brc20_events")
-  cur.execute('''select coalesce(max(block_height), -1) from brc20_historic_balances;''')
-  if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
-    residue_found = True
-    print("residue on historic balances")
-  cur.execute('''select coalesce(max(block_height), -1) from brc20_tickers;''')
-  if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
-    residue_found = True
-    print("residue on tickers")
-  cur.execute('''select coalesce(max(block_height), -1) from brc20_cumulative_event_hashes;''')
-  if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
-    residue_found = True
-    print("residue on cumulative hashes")
-  if residue_found:
-    print("There is residue from last run, rolling back to " + str(current_block - 1))
-    reorg_fix(current_block - 1)
-    print("Rolled back to " + str(current_block - 1))
-    return
+  for inscription_id in removed_transfers:
+    unused_transfers.pop(inscription_id, None)
+  for row in restored_transfers:
+    add_unused_transfer(row[0], row[1], row[2], row[3], row[4], row[5], row[6])
+  reset_caches(reload_unused_transfers=False)
 
 def check_if_there_is_residue_on_extra_tables_from_last_run():
   cur.execute('''select max(block_height) from brc20_extras_block_hashes;''')
@@ -762,6 +1027,10 @@ def check_if_there_is_residue_on_extra_tables_from_last_run():
   if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
     residue_found = True
     print("residue on brc20_current_balances")
+  cur.execute('''select coalesce(max(block_height), -1) from brc20_extras_block_undo;''')
+  if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
+    residue_found = True
+    print("residue on brc20_extras_block_undo")
   if residue_found:
     print("There is residue on extra tables from last run, rolling back to " + str(current_block - 1))
     reorg_on_extra_tables(current_block - 1)
@@ -785,13 +1054,39 @@ for t in ticks_:
   ticks[t[0]] = [t[1], t[2], t[3], t[4], t[5]]
 print("Ticks refreshed in " + str(time.time() - sttm) + " seconds")
 
+## block event hashes of a range of blocks, runs in a worker process of reindex_cumulative_hashes with its own connection
+## events are streamed with a server-side cursor, ticks and event_types_rev are inherited from the parent process
+def get_block_event_hashes_of_range(block_range):
+  start_height, end_height = block_range
+  conn_worker = psycopg2.connect(
+    host=db_host,
+    port=db_port,
+    database=db_database,
+    user=db_user,
+    password=db_password)
+  cur_worker = conn_worker.cursor(name='reindex_events')
+  cur_worker.itersize = 10000
+  cur_worker.execute('''select block_height, event, event_type, inscription_id from brc20_events_json
+                        where block_height >= %s and block_height <= %s
+                        order by block_height asc, id asc;''', (start_height, end_height))
+  hashers = {}
+  for row in cur_worker:
+    if row[0] not in hashers: hashers[row[0]] = BlockEventHasher()
+    hashers[row[0]].add(get_event_str(row[1], event_types_rev[row[2]], row[3]))
+  cur_worker.close()
+  conn_worker.close()
+  return [(block_height, (hashers.get(block_height) or BlockEventHasher()).hexdigest()) for block_height in range(start_height, end_height + 1)]
+
+## block event hashes are computed in parallel over block ranges, only the cumulative hash chain is sequential
 def reindex_cumulative_hashes():
   global event_types_rev, ticks
-  cur.execute('''delete from brc20_cumulative_event_hashes;''')
   cur.execute('''select min(block_height), max(block_height) from brc20_block_hashes;''')
   row = cur.fetchone()
   min_block = row[0]
   max_block = row[1]
+  if min_block is None:
+    cur.execute('''delete from brc20_cumulative_event_hashes;''')
+    return
 
   sttm = time.time()
   cur.execute('''select tick, remaining_supply, limit_per_mint, decimals, is_self_mint, deploy_inscription_id from brc20_tickers;''')
@@ -801,24 +1096,67 @@ def reindex_cumulative_hashes():
     ticks[t[0]] = [t[1], t[2], t[3], t[4], t[5]]
   print("Ticks refreshed in " + str(time.time() - sttm) + " seconds")
 
-  print("Reindexing cumulative hashes from " + str(min_block) + " to " + str(max_block))
-  for block_height in range(min_block, max_block + 1):
-    print("Reindexing block " + str(block_height))
-    block_events_str = ""
-    cur.execute('''select event, event_type, inscription_id from brc20_events where block_height = %s order by id asc;''', (block_height,))
-    rows = cur.fetchall()
-    for row in rows:
-      event = row[0]
-      event_type = event_types_rev[row[1]]
-      inscription_id = row[2]
-      block_events_str += get_event_str(event, event_type, inscription_id) + EVENT_SEPARATOR
-    update_event_hashes(block_height)
+  print("Reindexing cumulative hashes from " + str(min_block) + " to " + str(max_block) + " with " + str(reindex_workers) + " workers")
+  block_ranges = [(start_height, min(start_height + 999, max_block)) for start_height in range(min_block, max_block + 1, 1000)]
+  hash_rows = []
+  last_cumulative_event_hash = None
+  with multiprocessing.get_context('fork').Pool(reindex_workers) as pool: ## fork, workers need the module state and must not re-run the module
+    for block_hashes in pool.imap(get_block_event_hashes_of_range, block_ranges): ## in order of block ranges
+      for block_height, block_event_hash in block_hashes:
+        last_cumulative_event_hash = get_cumulative_event_hash(last_cumulative_event_hash, block_event_hash)
+        hash_rows.append((block_height, block_event_hash, last_cumulative_event_hash))
+      print("Reindexed up to block " + str(hash_rows[-1][0]))
+
+  copy_buf = io.StringIO()
+  for hash_row in hash_rows:
+    copy_buf.write('%d\t%s\t%s\n' % hash_row)
+  copy_buf.seek(0)
+  cur.execute('BEGIN;')
+  cur.execute('''delete from brc20_cumulative_event_hashes;''')
+  cur.copy_expert('''COPY brc20_cumulative_event_hashes (block_height, block_event_hash, cumulative_event_hash) FROM STDIN''', copy_buf)
+  cur.execute('COMMIT;')
+
+## view definition is taken from db_init.sql to keep a single source
+def get_events_json_view_sql():
+  with open('db_init.sql', 'r') as f:
+    for statement in f.read().split(';'):
+      if 'CREATE VIEW public.brc20_events_json' in statement:
+        return statement.strip() + ';'
+  raise Exception("brc20_events_json view not found in db_init.sql")
 
 def fix_db_from_version(version):
   if version == 4:
     print("Fixing db from version 4")
     ## change type of original_tick in brc20_tickers to text
     cur.execute('''alter table brc20_tickers alter column original_tick type text;''')
+    fix_db_from_version(5)
+  elif version == 5:
+    print("Fixing db from version 5")
+    ## move event fields from jsonb to typed columns, this rewrites brc20_events and may take a while
+    ## back-filled in id ranges with a commit after each range, an interrupted run continues with the rows which are not filled yet
+    cur.execute('''alter table brc20_events add column if not exists tick text, add column if not exists original_tick text, add column if not exists amount numeric(40),
+                     add column if not exists source_pkscript text, add column if not exists source_wallet text, add column if not exists spent_pkscript text, add column if not exists spent_wallet text,
+                     add column if not exists using_tx_id int8, add column if not exists parent_id text, add column if not exists extra jsonb;''')
+    cur.execute('''select coalesce(min(id), 0), coalesce(max(id), -1) from brc20_events;''')
+    min_id, max_id = cur.fetchone()
+    chunk_size = 100000
+    st_tm = time.time()
+    for chunk_start in range(min_id, max_id + 1, chunk_size):
+      cur.execute('begin;')
+      cur.execute('''update brc20_events set tick = "event"->>'tick', original_tick = "event"->>'original_tick', amount = ("event"->>'amount')::numeric(40),
+                       source_pkscript = coalesce("event"->>'deployer_pkScript', "event"->>'minted_pkScript', "event"->>'source_pkScript'),
+                       source_wallet = coalesce("event"->>'deployer_wallet', "event"->>'minted_wallet', "event"->>'source_wallet'),
+                       spent_pkscript = "event"->>'spent_pkScript', spent_wallet = "event"->>'spent_wallet',
+                       using_tx_id = ("event"->>'using_tx_id')::int8, parent_id = "event"->>'parent_id',
+                       extra = case when event_type = %s then "event" - 'deployer_pkScript' - 'deployer_wallet' - 'tick' - 'original_tick' else null end
+                     where id >= %s and id < %s and tick is null;''', (event_types["deploy-inscribe"], chunk_start, chunk_start + chunk_size))
+      cur.execute('commit;')
+      print("back-filled events up to id " + str(min(chunk_start + chunk_size - 1, max_id)) + " / " + str(max_id) + " in " + str(round(time.time() - st_tm, 1)) + " seconds")
+    cur.execute('begin;')
+    cur.execute('''alter table brc20_events alter column tick set not null, alter column original_tick set not null, drop column "event";''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS brc20_events_tick_idx ON public.brc20_events USING btree (tick);''')
+    cur.execute(get_events_json_view_sql())
+    cur.execute('commit;')
   else:
     print("Unknown db version, cannot fix db.")
     exit(1)
@@ -841,51 +1179,67 @@ else:
       cur.execute('update brc20_indexer_version set indexer_version = %s, db_version = %s;', (INDEXER_VERSION, DB_VERSION,))
       print("Fixed.")
 
-def try_to_report_with_retries(to_send):
-  global report_url, report_retries
-  for _ in range(0, report_retries):
-    try:
-      r = requests.post(report_url, json=to_send)
-      if r.status_code == 200:
-        print("Reported hashes to metaprotocol indexer indexer.")
-        return
-      else:
-        print("Error while reporting hashes to metaprotocol indexer indexer, status code: " + str(r.status_code))
-    except KeyboardInterrupt:
-      raise KeyboardInterrupt
-    except:
-      print("Error while reporting hashes to metaprotocol indexer indexer, retrying...")
-    time.sleep(1)
-  print("Error while reporting hashes to metaprotocol indexer indexer, giving up.")
-
-def report_hashes(block_height):
-  global report_to_indexer
-  if not report_to_indexer:
-    print("Reporting to metaprotocol indexer is disabled.")
-    return
-  cur.execute('''select block_event_hash, cumulative_event_hash from brc20_cumulative_event_hashes where block_height = %s;''', (block_height,))
-  row = cur.fetchone()
-  block_event_hash = row[0]
-  cumulative_event_hash = row[1]
-  cur.execute('''select block_hash from brc20_block_hashes where block_height = %s;''', (block_height,))
-  block_hash = cur.fetchone()[0]
-  to_send = {
-    "name": report_name,
-    "type": "brc20",
-    "node_type": "full_node",
-    "network_type": network_type,
-    "version": INDEXER_VERSION,
-    "db_version": DB_VERSION,
-    "event_hash_version": EVENT_HASH_VERSION,
-    "block_height": block_height,
-    "block_hash": block_hash,
-    "block_event_hash": block_event_hash,
-    "cumulative_event_hash": cumulative_event_hash
-  }
-  print("Sending hashes to metaprotocol indexer indexer...")
-  try_to_report_with_retries(to_send)
+load_unused_transfers()
 
+
+engine.configure_reporting(report_to_indexer, report_url, report_retries, {
+  "name": report_name,
+  "type": "brc20",
+  "node_type": "full_node",
+  "network_type": network_type,
+  "version": INDEXER_VERSION,
+  "db_version": DB_VERSION,
+  "event_hash_version": EVENT_HASH_VERSION
+})
+
+## uses the prior state recorded by index_extra_tables if every rolled back block has a record, otherwise rebuilds from brc20_historic_balances and brc20_events
+## main tables are rolled back first, so events of the rolled back blocks are not available here
 def reorg_on_extra_tables(reorg_height):
+  cur.execute('''select block_height, prior_balances, spent_inscrs from brc20_extras_block_undo where block_height > %s order by block_height desc;''', (reorg_height,))
+  undo_records = cur.fetchall()
+  cur.execute('''select coalesce(max(block_height), %s) from brc20_extras_block_hashes;''', (reorg_height,))
+  last_height = max([cur.fetchone()[0]] + [record[0] for record in undo_records])
+  if set([record[0] for record in undo_records]) == set(range(reorg_height + 1, last_height + 1)):
+    print("rolling back extra tables using " + str(len(undo_records)) + " undo records")
+    reorg_on_extra_tables_with_undo_records(reorg_height, undo_records)
+  else:
+    print("undo records not found for all blocks, rolling back extra tables using historic balances")
+    reorg_on_extra_tables_with_history(reorg_height)
+
+def reorg_on_extra_tables_with_undo_records(reorg_height, undo_records):
+  prior_balances = {}
+  spent_inscrs = []
+  for record in undo_records: ## records are in descending order, earliest prior balance of a key wins
+    for row in record[1]:
+      prior_balances[(row[0], row[1])] = row
+    for row in record[2]:
+      if row[6] <= reorg_height: spent_inscrs.append(row)
+  absent_keys = [row for row in prior_balances.values() if len(row) == 2]
+  restored_balances = [row for row in prior_balances.values() if len(row) != 2]
+  cur.execute('begin;')
+  if len(absent_keys) > 0:
+    cur.execute('''delete from brc20_current_balances cb
+                   using unnest(%s::text[], %s::text[]) as k(pkscript, tick)
+                   where cb.pkscript = k.pkscript and cb.tick = k.tick;''', ([row[0] for row in absent_keys], [row[1] for row in absent_keys]))
+  if len(restored_balances) > 0:
+    cur.execute('''INSERT INTO brc20_current_balances (pkscript, tick, wallet, overall_balance, available_balance, block_height)
+                   select * from unnest(%s::text[], %s::text[], %s::text[], %s::numeric[], %s::numeric[], %s::int4[])
+                   ON CONFLICT (pkscript, tick)
+                   DO UPDATE SET wallet = EXCLUDED.wallet
+                              , overall_balance = EXCLUDED.overall_balance
+                              , available_balance = EXCLUDED.available_balance
+                              , block_height = EXCLUDED.block_height;''', tuple([row[i] for row in restored_balances] for i in range(6)))
+  cur.execute('delete from brc20_unused_tx_inscrs where block_height > %s;', (reorg_height,)) ## delete new transfer inscriptions
+  if len(spent_inscrs) > 0:
+    cur.execute('''INSERT INTO brc20_unused_tx_inscrs (inscription_id, tick, amount, current_holder_pkscript, current_holder_wallet, event_id, block_height)
+                   select * from unnest(%s::text[], %s::text[], %s::numeric[], %s::text[], %s::text[], %s::int8[], %s::int4[])
+                   ON CONFLICT (inscription_id) DO NOTHING;''', tuple([row[i] for row in spent_inscrs] for i in range(7)))
+  cur.execute('delete from brc20_extras_block_hashes where block_height > %s;', (reorg_height,)) ## delete new block hashes
+  cur.execute("SELECT setval('brc20_extras_block_hashes_id_seq', max(id)) from brc20_extras_block_hashes;") ## reset id sequence
+  cur.execute('delete from brc20_extras_block_undo where block_height > %s;', (reorg_height,))
+  cur.execute('commit;')
+
+def reorg_on_extra_tables_with_history(reorg_height):
   cur.execute('begin;')
   cur.execute('delete from brc20_current_balances where block_height > %s RETURNING pkscript, tick;', (reorg_height,)) ## delete new balances
   rows = cur.fetchall()
@@ -905,105 +1259,142 @@ def reorg_on_extra_tables(reorg_height):
   
   cur.execute('truncate table brc20_unused_tx_inscrs restart identity;')
   cur.execute('''with tempp as (
-                  select inscription_id, event, id, block_height
+                  select inscription_id, tick, amount, source_pkscript, source_wallet, id, block_height
                   from brc20_events
                   where event_type = %s and block_height <= %s
                 ), tempp2 as (
-                  select inscription_id, event
+                  select inscription_id
                   from brc20_events
                   where event_type = %s and block_height <= %s
                 )
-                select t.event, t.id, t.block_height, t.inscription_id
+                select t.tick, t.amount, t.source_pkscript, t.source_wallet, t.id, t.block_height, t.inscription_id
                 from tempp t
                 left join tempp2 t2 on t.inscription_id = t2.inscription_id
                 where t2.inscription_id is null;''', (event_types['transfer-inscribe'], reorg_height, event_types['transfer-transfer'], reorg_height))
   rows = cur.fetchall()
   for row in rows:
-    new_event = row[0]
-    event_id = row[1]
-    block_height = row[2]
-    inscription_id = row[3]
+    tick, amount, source_pkscript, source_wallet, event_id, block_height, inscription_id = row
     cur.execute('''INSERT INTO brc20_unused_tx_inscrs (inscription_id, tick, amount, current_holder_pkscript, current_holder_wallet, event_id, block_height)
                     VALUES (%s, %s, %s, %s, %s, %s, %s)''', 
-                    (inscription_id, new_event["tick"], int(new_event["amount"]), new_event["source_pkScript"], new_event["source_wallet"], event_id, block_height))
+                    (inscription_id, tick, amount, source_pkscript, source_wallet, event_id, block_height))
 
   cur.execute('delete from brc20_extras_block_hashes where block_height > %s;', (reorg_height,)) ## delete new block hashes
   cur.execute("SELECT setval('brc20_extras_block_hashes_id_seq', max(id)) from brc20_extras_block_hashes;") ## reset id sequence
+  cur.execute('delete from brc20_extras_block_undo where block_height > %s;', (reorg_height,))
   cur.execute('commit;')
 
+## secondary indexes are dropped before the initial load and created from db_init_extra.sql afterwards
+def drop_extra_table_indexes(table_name):
+  cur.execute('''select indexname from pg_indexes where schemaname = 'public' and tablename = %s and indexname != %s;''', (table_name, table_name + '_pk'))
+  for row in cur.fetchall():
+    cur.execute('drop index ' + row[0] + ';')
+
+def create_extra_table_indexes(table_name):
+  with open('db_init_extra.sql', 'r') as f:
+    for statement in f.read().split(';'):
+      statement = statement.strip()
+      if statement.startswith('CREATE') and ' INDEX ' in statement and ' ON public.' + table_name + ' ' in statement:
+        cur.execute(statement + ';')
+
 def initial_index_of_extra_tables():
   cur.execute('begin;')
   print("resetting brc20_unused_tx_inscrs")
   cur.execute('truncate table brc20_unused_tx_inscrs restart identity;')
-  print("selecting unused txes")
-  cur.execute('''with tempp as (
-                  select inscription_id, event, id, block_height
-                  from brc20_events
-                  where event_type = %s
-                ), tempp2 as (
-                  select inscription_id, event
-                  from brc20_events
-                  where event_type = %s
-                )
-                select t.event, t.id, t.block_height, t.inscription_id
-                from tempp t
-                left join tempp2 t2 on t.inscription_id = t2.inscription_id
-                where t2.inscription_id is null;''', (event_types['transfer-inscribe'], event_types['transfer-transfer']))
-  rows = cur.fetchall()
+  drop_extra_table_indexes('brc20_unused_tx_inscrs')
   print("inserting unused txes")
-  idx = 0
-  for row in rows:
-    idx += 1
-    if idx % 200 == 0: print(idx, '/', len(rows))
-    new_event = row[0]
-    event_id = row[1]
-    block_height = row[2]
-    inscription_id = row[3]
-    cur.execute('''INSERT INTO brc20_unused_tx_inscrs (inscription_id, tick, amount, current_holder_pkscript, current_holder_wallet, event_id, block_height)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)''', 
-                    (inscription_id, new_event["tick"], int(new_event["amount"]), new_event["source_pkScript"], new_event["source_wallet"], event_id, block_height))
+  st_tm = time.time()
+  cur.execute('''INSERT INTO brc20_unused_tx_inscrs (inscription_id, tick, amount, current_holder_pkscript, current_holder_wallet, event_id, block_height)
+                 select i.inscription_id, i.tick, i.amount, i.source_pkscript, i.source_wallet, i.id, i.block_height
+                 from brc20_events i
+                 where i.event_type = %s
+                   and not exists (select 1 from brc20_events t where t.event_type = %s and t.inscription_id = i.inscription_id)
+                 order by i.id asc;''', (event_types['transfer-inscribe'], event_types['transfer-transfer']))
+  print("inserted " + str(cur.rowcount) + " unused txes in " + str(time.time() - st_tm) + " seconds")
+  create_extra_table_indexes('brc20_unused_tx_inscrs')
   
   print("resetting brc20_current_balances")
   cur.execute('truncate table brc20_current_balances restart identity;')
-  print("selecting current balances")
-  cur.execute('''with tempp as (
-                    select max(id) as id
-                    from brc20_historic_balances
-                    group by pkscript, tick
-                  )
-                  select bhb.pkscript, bhb.tick, bhb.overall_balance, bhb.available_balance, bhb.wallet, bhb.block_height
-                  from tempp t
-                  left join brc20_historic_balances bhb on bhb.id = t.id
-                  order by bhb.pkscript asc, bhb.tick asc;''')
-  rows = cur.fetchall()
+  drop_extra_table_indexes('brc20_current_balances')
   print("inserting current balances")
-  idx = 0
-  for r in rows:
-    idx += 1
-    if idx % 200 == 0: print(idx, '/', len(rows))
-    pkscript = r[0]
-    tick = r[1]
-    overall_balance = r[2]
-    available_balance = r[3]
-    wallet = r[4]
-    block_height = r[5]
-    cur.execute('''insert into brc20_current_balances (pkscript, wallet, tick, overall_balance, available_balance, block_height)
-                   values (%s, %s, %s, %s, %s, %s);''', (pkscript, wallet, tick, overall_balance, available_balance, block_height))
+  st_tm = time.time()
+  cur.execute('''INSERT INTO brc20_current_balances (pkscript, wallet, tick, overall_balance, available_balance, block_height)
+                 select pkscript, wallet, tick, overall_balance, available_balance, block_height
+                 from (select distinct on (pkscript, tick) pkscript, wallet, tick, overall_balance, available_balance, block_height
+                       from brc20_historic_balances
+                       order by pkscript asc, tick asc, id desc) t
+                 order by pkscript asc, tick asc;''')
+  print("inserted " + str(cur.rowcount) + " current balances in " + str(time.time() - st_tm) + " seconds")
+  create_extra_table_indexes('brc20_current_balances')
   
   print("resetting brc20_extras_block_hashes")
   cur.execute('truncate table brc20_extras_block_hashes restart identity;')
+  cur.execute('truncate table brc20_extras_block_undo restart identity;')
   print("inserting brc20_extras_block_hashes")
-  cur.execute('''select block_height, block_hash from brc20_block_hashes order by block_height asc;''')
-  rows = cur.fetchall()
-  idx = 0
-  for row in rows:
-    idx += 1
-    if idx % 200 == 0: print(idx, '/', len(rows))
-    block_height = row[0]
-    block_hash = row[1]
-    cur.execute('''INSERT INTO brc20_extras_block_hashes (block_height, block_hash) VALUES (%s, %s);''', (block_height, block_hash))
+  cur.execute('''INSERT INTO brc20_extras_block_hashes (block_height, block_hash)
+                 select block_height, block_hash from brc20_block_hashes order by block_height asc;''')
 
   cur.execute('commit;')
+  cur.execute('analyze brc20_unused_tx_inscrs;')
+  cur.execute('analyze brc20_current_balances;')
+
+## applies the balance changes and transfer events of a block to the extra tables with one statement per table
+## balance_changes are (pkscript, wallet, tick, overall_balance, available_balance) and events are (tick, amount, source_pkscript, source_wallet, event_id, event_type, inscription_id) in event order
+def apply_extra_tables_changes(block_height, block_hash, balance_changes, events):
+  balance_changes_map = {}
+  for balance_change in balance_changes:
+    balance_changes_map[(balance_change[0], balance_change[2])] = balance_change
+  new_inscrs = {}
+  spent_inscription_ids = []
+  for row in events:
+    tick, amount, source_pkscript, source_wallet, event_id, event_type_id, inscription_id = row
+    event_type = event_types_rev[event_type_id]
+    if event_type == 'transfer-inscribe':
+      if inscription_id not in new_inscrs: new_inscrs[inscription_id] = (inscription_id, tick, amount, source_pkscript, source_wallet, event_id, block_height)
+    elif event_type == 'transfer-transfer':
+      new_inscrs.pop(inscription_id, None) ## inscribed and spent in the same block
+      spent_inscription_ids.append(inscription_id)
+    else:
+      print("Unknown event type: " + event_type)
+      sys.exit(1)
+
+  ## record the rows this block is going to change before changing them, used by reorg_on_extra_tables
+  cur.execute('''INSERT INTO brc20_extras_block_undo (block_height, prior_balances, spent_inscrs)
+                 select %s,
+                   (select coalesce(jsonb_agg(case when cb.id is null then jsonb_build_array(k.pkscript, k.tick)
+                                                   else jsonb_build_array(cb.pkscript, cb.tick, cb.wallet, cb.overall_balance::text, cb.available_balance::text, cb.block_height) end), '[]'::jsonb)
+                    from unnest(%s::text[], %s::text[]) as k(pkscript, tick)
+                    left join brc20_current_balances cb on cb.pkscript = k.pkscript and cb.tick = k.tick),
+                   (select coalesce(jsonb_agg(jsonb_build_array(u.inscription_id, u.tick, u.amount::text, u.current_holder_pkscript, u.current_holder_wallet, u.event_id, u.block_height)), '[]'::jsonb)
+                    from brc20_unused_tx_inscrs u
+                    where u.inscription_id = any(%s::text[]));''',
+                 (block_height, [key[0] for key in balance_changes_map], [key[1] for key in balance_changes_map], spent_inscription_ids))
+  cur.execute('''delete from brc20_extras_block_undo where block_height <= %s;''', (block_height - undo_keep_blocks,))
+
+  if len(balance_changes_map) == 0:
+    print("No balance_changes found for block " + str(block_height))
+  else:
+    print("Balance_change count: ", len(balance_changes_map))
+    new_balances = list(balance_changes_map.values())
+    cur.execute('''INSERT INTO brc20_current_balances (pkscript, wallet, tick, overall_balance, available_balance, block_height)
+                   select pkscript, wallet, tick, overall_balance, available_balance, %s
+                   from unnest(%s::text[], %s::text[], %s::text[], %s::numeric[], %s::numeric[]) as b(pkscript, wallet, tick, overall_balance, available_balance)
+                   ON CONFLICT (pkscript, tick) 
+                   DO UPDATE SET overall_balance = EXCLUDED.overall_balance
+                              , available_balance = EXCLUDED.available_balance
+                              , block_height = EXCLUDED.block_height;''', (block_height,) + tuple([row[i] for row in new_balances] for i in range(5)))
+  
+  if len(events) == 0:
+    print("No events found for block " + str(block_height))
+  else:
+    print("Events count: ", len(events))
+    if len(new_inscrs) > 0:
+      cur.execute('''INSERT INTO brc20_unused_tx_inscrs (inscription_id, tick, amount, current_holder_pkscript, current_holder_wallet, event_id, block_height)
+                     select * from unnest(%s::text[], %s::text[], %s::numeric[], %s::text[], %s::text[], %s::int8[], %s::int4[])
+                     ON CONFLICT (inscription_id) DO NOTHING;''', tuple([row[i] for row in new_inscrs.values()] for i in range(7)))
+    if len(spent_inscription_ids) > 0:
+      cur.execute('''DELETE FROM brc20_unused_tx_inscrs WHERE inscription_id = any(%s::text[]);''', (spent_inscription_ids,))
+
+  cur.execute('''INSERT INTO brc20_extras_block_hashes (block_height, block_hash) VALUES (%s, %s);''', (block_height, block_hash))
 
 def index_extra_tables(block_height, block_hash):
   ebh_current_height = 0
@@ -1023,56 +1414,32 @@ def index_extra_tables(block_height, block_hash):
                  where block_height = %s 
                  order by id asc;''', (block_height,))
   balance_changes = cur.fetchall()
-  if len(balance_changes) == 0:
-    print("No balance_changes found for block " + str(block_height))
-  else:
-    balance_changes_map = {}
-    for balance_change in balance_changes:
-      pkscript = balance_change[0]
-      tick = balance_change[2]
-      key = pkscript + '_' + tick
-      balance_changes_map[key] = balance_change
-    print("Balance_change count: ", len(balance_changes_map))
-    idx = 0
-    for key in balance_changes_map:
-      new_balance = balance_changes_map[key]
-      idx += 1
-      if idx % 200 == 0: print(idx, '/', len(balance_changes_map))
-      cur.execute('''INSERT INTO brc20_current_balances (pkscript, wallet, tick, overall_balance, available_balance, block_height) VALUES (%s, %s, %s, %s, %s, %s)
-                     ON CONFLICT (pkscript, tick) 
-                     DO UPDATE SET overall_balance = EXCLUDED.overall_balance
-                                , available_balance = EXCLUDED.available_balance
-                                , block_height = EXCLUDED.block_height;''', new_balance + (block_height,))
-    
-  cur.execute('''select event, id, event_type, inscription_id 
+
+  cur.execute('''select tick, amount, source_pkscript, source_wallet, id, event_type, inscription_id 
                  from brc20_events where block_height = %s and (event_type = %s or event_type = %s) 
                  order by id asc;''', (block_height, event_types['transfer-inscribe'], event_types['transfer-transfer'],))
   events = cur.fetchall()
-  if len(events) == 0:
-    print("No events found for block " + str(block_height))
-  else:
-    print("Events count: ", len(events))
-    idx = 0
-    for row in events:
-      new_event = row[0]
-      event_id = row[1]
-      new_event["event_type"] = event_types_rev[row[2]]
-      new_event["inscription_id"] = row[3]
-      idx += 1
-      if idx % 200 == 0: print(idx, '/', len(events))
-      if new_event["event_type"] == 'transfer-inscribe':
-        cur.execute('''INSERT INTO brc20_unused_tx_inscrs (inscription_id, tick, amount, current_holder_pkscript, current_holder_wallet, event_id, block_height)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT (inscription_id) DO NOTHING''', 
-                        (new_event["inscription_id"], new_event["tick"], int(new_event["amount"]), new_event["source_pkScript"], new_event["source_wallet"], event_id, block_height))
-      elif new_event["event_type"] == 'transfer-transfer':
-        cur.execute('''DELETE FROM brc20_unused_tx_inscrs WHERE inscription_id = %s;''', (new_event["inscription_id"],))
-      else:
-        print("Unknown event type: " + new_event["event_type"])
-        sys.exit(1)
 
-  cur.execute('''INSERT INTO brc20_extras_block_hashes (block_height, block_hash) VALUES (%s, %s);''', (block_height, block_hash))
+  apply_extra_tables_changes(block_height, block_hash, balance_changes, events)
   return True
 
+## updates the extra tables from the insert caches of the block being indexed, in the same transaction as the main tables
+## only used when the extra tables are at the previous block, check_extra_tables catches up from the database otherwise
+def index_extra_tables_from_caches(block_height, block_hash, empty_block=False):
+  if not create_extra_tables: return
+  cur.execute('select coalesce(max(block_height), -1) from brc20_extras_block_hashes;')
+  if cur.fetchone()[0] != block_height - 1: return
+  st_tm = time.time()
+  print("updating extra tables for block: " + str(block_height))
+  balance_changes = []
+  events = []
+  if not empty_block: ## insert caches are not reset for blocks without transfers
+    balance_changes = [row[:5] for row in brc20_historic_balances_insert_cache]
+    events = [(row[4], row[6], row[7], row[8], row[0], row[1], row[3]) for row in brc20_events_insert_cache
+              if row[1] == event_types['transfer-inscribe'] or row[1] == event_types['transfer-transfer']]
+  apply_extra_tables_changes(block_height, block_hash, balance_changes, events)
+  work_stats.add_time("extra_tables_tm", st_tm)
+
 def check_extra_tables():
   global first_inscription_height
   try:
@@ -1125,59 +1492,31 @@ def check_extra_tables():
     traceback.print_exc()
     return
 
-check_if_there_is_residue_from_last_run()
+engine.check_residue(first_inscription_height, reorg_fix)
 if create_extra_tables:
   check_if_there_is_residue_on_extra_tables_from_last_run()
   print("checking extra tables")
   check_extra_tables()
 
-last_report_height = 0
-while True:
-  check_if_there_is_residue_from_last_run()
+if prefetch_blocks > 0:
+  transfer_prefetcher = TransferPrefetcher(prefetch_blocks)
+  transfer_prefetcher.start()
+
+def before_block():
   if create_extra_tables:
     check_if_there_is_residue_on_extra_tables_from_last_run()
-  ## check if a new block is indexed
-  cur_metaprotocol.execute('''SELECT coalesce(max(block_height), -1) as max_height from block_hashes;''')
-  max_block_of_metaprotocol_db = cur_metaprotocol.fetchone()[0]
-  cur.execute('''select max(block_height) from brc20_block_hashes;''')
-  row = cur.fetchone()
-  current_block = None
-  if row[0] is None: current_block = first_inscription_height
-  else: current_block = row[0] + 1
-  if current_block > max_block_of_metaprotocol_db:
-    print("Waiting for new blocks...")
-    time.sleep(5)
-    continue
-  
-  print("Processing block %s" % current_block)
-  cur_metaprotocol.execute('select block_hash from block_hashes where block_height = %s;', (current_block,))
-  current_block_hash = cur_metaprotocol.fetchone()[0]
-  reorg_height = check_for_reorg()
-  if reorg_height is not None:
-    print("Rolling back to ", reorg_height)
-    reorg_fix(reorg_height)
-    print("Rolled back to " + str(reorg_height))
-    continue
-  try:
-    index_block(current_block, current_block_hash)
-    if create_extra_tables and max_block_of_metaprotocol_db - current_block < 10: ## only update extra tables at the end of sync
-      print("checking extra tables")
-      check_extra_tables()
-    if max_block_of_metaprotocol_db - current_block < 10 or current_block - last_report_height > 100: ## do not report if there are more than 10 blocks to index
-      report_hashes(current_block)
-      last_report_height = current_block
-  except KeyboardInterrupt:
-    traceback.print_exc()
-    if in_commit: ## rollback commit if any
-      print("rolling back")
-      cur.execute('''ROLLBACK;''')
-      in_commit = False
-    print("Exiting...")
-    sys.exit(1)
-  except:
-    traceback.print_exc()
-    if in_commit: ## rollback commit if any
-      print("rolling back")
-      cur.execute('''ROLLBACK;''')
-      in_commit = False
-    time.sleep(10)
+
+def after_block(block_height, max_block_of_metaprotocol_db):
+  if create_extra_tables and max_block_of_metaprotocol_db - block_height < 10: ## only update extra tables at the end of sync
+    print("checking extra tables")
+    st_tm = time.time()
+    check_extra_tables()
+    work_stats.add_time("extra_tables_tm", st_tm)
+
+## in-memory state and prefetched transfers may contain changes of the failed block(s)
+def reset_after_failed_block():
+  if transfer_prefetcher is not None: transfer_prefetcher.pause()
+  reset_caches()
+
+engine.run(first_inscription_height, index_block, reorg_fix, reset_after_failed_block, listen_new_blocks, new_block_wait_timeout, before_block, after_block,
+           get_catchup_batch_size, index_block_range)
@@ -15,9 +15,9 @@ CREATE TABLE public.brc20_historic_balances (
 	available_balance numeric(40) NOT NULL,
 	block_height int4 NOT NULL,
 	event_id int8 NOT NULL,
-	CONSTRAINT brc20_historic_balances_pk PRIMARY KEY (id)
-);
-CREATE UNIQUE INDEX brc20_historic_balances_event_id_idx ON public.brc20_historic_balances USING btree (event_id);
+	CONSTRAINT brc20_historic_balances_pk PRIMARY KEY (id, block_height)
+) PARTITION BY RANGE (block_height); -- partitions are created by the indexer
+CREATE UNIQUE INDEX brc20_historic_balances_event_id_idx ON public.brc20_historic_balances USING btree (event_id, block_height);
 CREATE INDEX brc20_historic_balances_block_height_idx ON public.brc20_historic_balances USING btree (block_height);
 CREATE INDEX brc20_historic_balances_pkscript_idx ON public.brc20_historic_balances USING btree (pkscript);
 CREATE INDEX brc20_historic_balances_pkscript_tick_block_height_idx ON public.brc20_historic_balances USING btree (pkscript, tick, block_height);
@@ -29,13 +29,35 @@ CREATE TABLE public.brc20_events (
 	event_type int4 NOT NULL,
 	block_height int4 NOT NULL,
 	inscription_id text NOT NULL,
-	"event" jsonb NOT NULL,
-	CONSTRAINT events_pk PRIMARY KEY (id)
-);
-CREATE UNIQUE INDEX brc20_events_event_type_inscription_id_idx ON public.brc20_events USING btree (event_type, inscription_id);
+	tick text NOT NULL,
+	original_tick text NOT NULL,
+	amount numeric(40) NULL,
+	source_pkscript text NULL, -- deployer, minter or transfer source
+	source_wallet text NULL,
+	spent_pkscript text NULL,
+	spent_wallet text NULL,
+	using_tx_id int8 NULL,
+	parent_id text NULL,
+	extra jsonb NULL, -- deploy parameters
+	CONSTRAINT events_pk PRIMARY KEY (id, block_height)
+) PARTITION BY RANGE (block_height); -- partitions are created by the indexer
+-- unique indexes of partitioned tables must contain block_height, uniqueness of (event_type, inscription_id) is kept by the indexer
+CREATE INDEX brc20_events_event_type_inscription_id_idx ON public.brc20_events USING btree (event_type, inscription_id);
 CREATE INDEX brc20_events_block_height_idx ON public.brc20_events USING btree (block_height);
 CREATE INDEX brc20_events_event_type_idx ON public.brc20_events USING btree (event_type);
 CREATE INDEX brc20_events_inscription_id_idx ON public.brc20_events USING btree (inscription_id);
+CREATE INDEX brc20_events_tick_idx ON public.brc20_events USING btree (tick);
+
+-- events in the json format of previous db versions
+CREATE VIEW public.brc20_events_json AS
+SELECT id, event_type, block_height, inscription_id,
+	CASE event_type
+		WHEN 0 THEN jsonb_build_object('deployer_pkScript', source_pkscript, 'deployer_wallet', source_wallet, 'tick', tick, 'original_tick', original_tick) || coalesce(extra, '{}'::jsonb)
+		WHEN 1 THEN jsonb_build_object('minted_pkScript', source_pkscript, 'minted_wallet', source_wallet, 'tick', tick, 'original_tick', original_tick, 'amount', amount::text, 'parent_id', parent_id)
+		WHEN 2 THEN jsonb_build_object('source_pkScript', source_pkscript, 'source_wallet', source_wallet, 'tick', tick, 'original_tick', original_tick, 'amount', amount::text)
+		ELSE jsonb_build_object('source_pkScript', source_pkscript, 'source_wallet', source_wallet, 'spent_pkScript', spent_pkscript, 'spent_wallet', spent_wallet, 'tick', tick, 'original_tick', original_tick, 'amount', amount::text, 'using_tx_id', using_tx_id::text)
+	END AS "event"
+FROM public.brc20_events;
 
 CREATE TABLE public.brc20_tickers (
 	id bigserial NOT NULL,
@@ -63,6 +85,19 @@ CREATE TABLE public.brc20_cumulative_event_hashes (
 );
 CREATE UNIQUE INDEX brc20_cumulative_event_hashes_block_height_idx ON public.brc20_cumulative_event_hashes USING btree (block_height);
 
+CREATE TABLE public.brc20_block_undo (
+	id bigserial NOT NULL,
+	block_height int4 NOT NULL,
+	event_id_start int8 NULL, -- first brc20_events id of the block
+	supply_deltas jsonb NOT NULL DEFAULT '{}', -- tick -> minted amount
+	burned_deltas jsonb NOT NULL DEFAULT '{}', -- tick -> burned amount
+	inscribed_transfers jsonb NOT NULL DEFAULT '[]', -- inscription ids of new transfer inscriptions
+	spent_transfers jsonb NOT NULL DEFAULT '[]', -- spent transfer inscriptions as [inscription_id, tick, amount, source_pkscript, source_wallet, event_id, block_height]
+	touched_balances jsonb NOT NULL DEFAULT '[]', -- [pkscript, tick] pairs with new historic balances
+	CONSTRAINT brc20_block_undo_pk PRIMARY KEY (id)
+);
+CREATE UNIQUE INDEX brc20_block_undo_block_height_idx ON public.brc20_block_undo USING btree (block_height);
+
 CREATE TABLE public.brc20_event_types (
 	id bigserial NOT NULL,
 	event_type_name text NOT NULL,
@@ -74,6 +109,27 @@ INSERT INTO public.brc20_event_types (event_type_name, event_type_id) VALUES ('m
 INSERT INTO public.brc20_event_types (event_type_name, event_type_id) VALUES ('transfer-inscribe', 2);
 INSERT INTO public.brc20_event_types (event_type_name, event_type_id) VALUES ('transfer-transfer', 3);
 
+CREATE TABLE public.brc20_indexer_work_stats (
+	id bigserial NOT NULL,
+	min_block_height int4 NOT NULL,
+	max_block_height int4 NOT NULL,
+	transfer_count int4 NOT NULL DEFAULT 0,
+	event_count int4 NOT NULL DEFAULT 0,
+	fetch_tm int4 NOT NULL DEFAULT 0,
+	balance_fetch_tm int4 NOT NULL DEFAULT 0,
+	index_tm int4 NOT NULL DEFAULT 0,
+	write_tm int4 NOT NULL DEFAULT 0,
+	hash_tm int4 NOT NULL DEFAULT 0,
+	commit_tm int4 NOT NULL DEFAULT 0,
+	extra_tables_tm int4 NOT NULL DEFAULT 0,
+	report_tm int4 NOT NULL DEFAULT 0,
+	all_tm int4 NOT NULL DEFAULT 0,
+	balance_cache_hits int8 NOT NULL DEFAULT 0,
+	balance_cache_misses int8 NOT NULL DEFAULT 0,
+	ts timestamptz NOT NULL DEFAULT now(),
+	CONSTRAINT brc20_indexer_work_stats_pk PRIMARY KEY (id)
+);
+
 CREATE TABLE public.brc20_indexer_version (
 	id bigserial NOT NULL,
 	indexer_version text NOT NULL,
@@ -81,4 +137,4 @@ CREATE TABLE public.brc20_indexer_version (
 	event_hash_version int4 NOT NULL,
 	CONSTRAINT brc20_indexer_version_pk PRIMARY KEY (id)
 );
-INSERT INTO public.brc20_indexer_version (indexer_version, db_version, event_hash_version) VALUES ('opi-brc20-full-node v0.4.1', 5, 2);
+INSERT INTO public.brc20_indexer_version (indexer_version, db_version, event_hash_version) VALUES ('opi-brc20-full-node v0.4.1', 6, 2);
@@ -36,4 +36,13 @@ CREATE TABLE public.brc20_extras_block_hashes (
 	block_hash text NOT NULL,
 	CONSTRAINT brc20_extras_block_hashes_pk PRIMARY KEY (id)
 );
-CREATE UNIQUE INDEX brc20_extras_block_hashes_block_height_idx ON public.brc20_extras_block_hashes USING btree (block_height);
\ No newline at end of file
+CREATE UNIQUE INDEX brc20_extras_block_hashes_block_height_idx ON public.brc20_extras_block_hashes USING btree (block_height);
+
+CREATE TABLE public.brc20_extras_block_undo (
+	id bigserial NOT NULL,
+	block_height int4 NOT NULL,
+	prior_balances jsonb NOT NULL DEFAULT '[]', -- brc20_current_balances rows as [pkscript, tick, wallet, overall_balance, available_balance, block_height] before the block, [pkscript, tick] if there was no row
+	spent_inscrs jsonb NOT NULL DEFAULT '[]', -- brc20_unused_tx_inscrs rows as [inscription_id, tick, amount, current_holder_pkscript, current_holder_wallet, event_id, block_height] deleted by the block
+	CONSTRAINT brc20_extras_block_undo_pk PRIMARY KEY (id)
+);
+CREATE UNIQUE INDEX brc20_extras_block_undo_block_height_idx ON public.brc20_extras_block_undo USING btree (block_height);
\ No newline at end of file
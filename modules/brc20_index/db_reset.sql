@@ -1,7 +1,10 @@
 drop table if exists brc20_block_hashes;
 drop table if exists brc20_historic_balances;
+drop view if exists brc20_events_json;
 drop table if exists brc20_events;
 drop table if exists brc20_event_types;
 drop table if exists brc20_tickers;
 drop table if exists brc20_cumulative_event_hashes;
+drop table if exists brc20_block_undo;
+drop table if exists brc20_indexer_work_stats;
 drop table if exists brc20_indexer_version;
@@ -1,3 +1,4 @@
 drop table if exists brc20_current_balances;
 drop table if exists brc20_unused_tx_inscrs;
-drop table if exists brc20_extras_block_hashes;
\ No newline at end of file
+drop table if exists brc20_extras_block_hashes;
+drop table if exists brc20_extras_block_undo;
\ No newline at end of file
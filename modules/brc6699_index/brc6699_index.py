@@ -1,11 +1,15 @@
 # pip install python-dotenv
 # pip install psycopg2-binary
 
-import os, sys, requests
+import os, sys
 from dotenv import load_dotenv
 import traceback, time, codecs, json
 import psycopg2
-import hashlib
+import io
+import multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) ## modules directory, for opi_common
+from opi_common.numeric import is_positive_number, is_positive_number_with_dot, fix_numstr_decimals
+from opi_common.engine import get_cumulative_event_hash, utf8len, BlockEventHasher, Balance, LRUCache, WorkStats, BlockRangeProfiler, ProtocolEngine
 
 if not os.path.isfile('.env'):
   print(".env file not found, please run \"python3 reset_init.py\" first")
@@ -13,9 +17,7 @@ if not os.path.isfile('.env'):
 
 ## global variables
 ticks = {}
-in_commit = False
-block_events_str = ""
-EVENT_SEPARATOR = "|"
+block_events_hasher = None ## BlockEventHasher of the block being indexed
 INDEXER_VERSION = "opi-brc6699-full-node v0.3.0"
 CAN_BE_FIXED_DB_VERSIONS = [  ]
 DB_VERSION = 3
@@ -46,6 +48,17 @@ report_retries = int(os.getenv("REPORT_RETRIES") or "10")
 report_name = os.getenv("REPORT_NAME") or "opi_brc6699_indexer"
 create_extra_tables = (os.getenv("CREATE_EXTRA_TABLES") or "false") == "true"
 network_type = os.getenv("NETWORK_TYPE") or "mainnet"
+balance_cache_max_mb = int(os.getenv("BALANCE_CACHE_MAX_MB") or "512")
+transfer_cache_max_mb = int(os.getenv("TRANSFER_CACHE_MAX_MB") or "128")
+bulk_writer = os.getenv("BULK_WRITER") or "copy" ## copy or insert
+profile_mode = os.getenv("PROFILE_MODE") or "" ## cprofile, sampling or empty to disable
+profile_start_height = int(os.getenv("PROFILE_START_HEIGHT") or "0")
+profile_end_height = int(os.getenv("PROFILE_END_HEIGHT") or "0")
+profile_sample_interval_ms = int(os.getenv("PROFILE_SAMPLE_INTERVAL_MS") or "10")
+profile_output_file = os.getenv("PROFILE_OUTPUT_FILE") or "brc6699_profile"
+listen_new_blocks = (os.getenv("LISTEN_NEW_BLOCKS") or "true") == "true"
+new_block_wait_timeout = int(os.getenv("NEW_BLOCK_WAIT_TIMEOUT") or "30")
+reindex_workers = int(os.getenv("REINDEX_WORKERS") or "4")
 
 first_inscription_heights = {
   'mainnet': 834477,
@@ -59,6 +72,10 @@ if network_type == 'regtest':
   report_to_indexer = False
   print("Network type is regtest, reporting to indexer is disabled.")
 
+if profile_mode not in ["", "cprofile", "sampling"]:
+  print("PROFILE_MODE must be cprofile, sampling or empty")
+  sys.exit(1)
+
 ## connect to db
 conn = psycopg2.connect(
   host=db_host,
@@ -78,6 +95,10 @@ conn_metaprotocol = psycopg2.connect(
 conn_metaprotocol.autocommit = True
 cur_metaprotocol = conn_metaprotocol.cursor()
 
+## main_index notifies opi_new_block when a new block_hashes row is committed (see check_db in main_index/index.js)
+if listen_new_blocks:
+  cur_metaprotocol.execute('''LISTEN opi_new_block;''')
+
 ## create tables if not exists
 ## does brc6699_block_hashes table exist?
 cur.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = 'brc6699_block_hashes') AS table_existence;''')
@@ -88,6 +109,18 @@ if cur.fetchone()[0] == False:
     cur.execute(sql)
   conn.commit()
 
+## work stats table was added later, create it on databases initialised before it
+cur.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = 'brc6699_indexer_work_stats') AS table_existence;''')
+if cur.fetchone()[0] == False:
+  print("Creating brc6699_indexer_work_stats...")
+  with open('db_init.sql', 'r') as f:
+    for statement in f.read().split(';'):
+      if 'CREATE TABLE public.brc6699_indexer_work_stats' in statement:
+        cur.execute(statement.strip() + ';')
+
+## write_tm and commit_tm were added when block writes moved to opi_common.engine
+cur.execute('''alter table brc6699_indexer_work_stats add column if not exists write_tm int4 NOT NULL DEFAULT 0, add column if not exists commit_tm int4 NOT NULL DEFAULT 0;''')
+
 if create_extra_tables:
   cur.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = 'brc6699_extras_block_hashes') AS table_existence;''')
   if cur.fetchone()[0] == False:
@@ -109,40 +142,6 @@ if network_type_db != network_type:
 
 ## helper functions
 
-def utf8len(s):
-  return len(s.encode('utf-8'))
-
-def is_positive_number(s, do_strip=False):
-  try:
-    if do_strip:
-      s = s.strip()
-    try:
-      if len(s) == 0: return False
-      for ch in s:
-        if ord(ch) > ord('9') or ord(ch) < ord('0'):
-          return False
-      return True
-    except: return False
-  except: return False ## has to be a string
-
-def is_positive_number_with_dot(s, do_strip=False):
-  try:
-    if do_strip:
-      s = s.strip()
-    try:
-      dotFound = False
-      if len(s) == 0: return False
-      if s[0] == '.': return False
-      if s[-1] == '.': return False
-      for ch in s:
-        if ord(ch) > ord('9') or ord(ch) < ord('0'):
-          if ch != '.': return False
-          if dotFound: return False
-          dotFound = True
-      return True
-    except: return False
-  except: return False ## has to be a string
-
 def is_positive_number_with_slash(s, do_strip=False):
   try:
     if do_strip:
@@ -182,20 +181,6 @@ def get_number_extended_to_1_decimals(s, decimals, do_strip=False):
     return int(s) * 10 ** 1
 
 
-def get_number_extended_to_18_decimals(s, decimals, do_strip=False):
-  if do_strip:
-    s = s.strip()
-  
-  if '.' in s:
-    normal_part = s.split('.')[0]
-    if len(s.split('.')[1]) > decimals or len(s.split('.')[1]) == 0: ## more decimal digit than allowed or no decimal digit after dot
-      return None
-    decimals_part = s.split('.')[1][:decimals]
-    decimals_part += '0' * (18 - len(decimals_part))
-    return int(normal_part + decimals_part)
-  else:
-    return int(s) * 10 ** 18
-
 def get_inscription_address_by_id(inscription_id):
   cur.execute('''select new_wallet from ord_number_to_id where inscription_id = %s limit 1;''', (inscription_id,))
   row = cur.fetchone()
@@ -220,12 +205,21 @@ def get_inscription_address_by_id(inscription_id):
   # except:
   #   return None
 
-def is_minted_or_invalid(inscription_id):
+## bulk version of get_inscription_address_by_id, missing inscriptions map to ''
+def get_inscription_addresses_by_ids(inscription_ids):
+  addresses = dict.fromkeys(inscription_ids, '')
+  if len(addresses) == 0: return addresses
+  cur.execute('''select inscription_id, new_wallet from ord_number_to_id where inscription_id = any(%s);''', (list(addresses),))
+  for row in cur.fetchall():
+    addresses[row[0]] = row[1]
+  return addresses
+
+## returns the subset of inscription_ids which already have a mint event
+def get_minted_inscription_ids(inscription_ids):
   global event_types
-  cur.execute('''select coalesce(sum(case when event_type = %s then 1 else 0 end), 0) as mint_cnt
-                        from brc6699_events where inscription_id = %s;''', (event_types["mint-inscribe"],  inscription_id,))
-  row = cur.fetchall()[0]
-  return row[0] == 1
+  if len(inscription_ids) == 0: return set()
+  cur.execute('''select distinct inscription_id from brc6699_events where event_type = %s and inscription_id = any(%s);''', (event_types["mint-inscribe"], list(inscription_ids),))
+  return set(row[0] for row in cur.fetchall())
 
 def is_used_or_invalid(inscription_id):
   global event_types
@@ -235,19 +229,6 @@ def is_used_or_invalid(inscription_id):
   row = cur.fetchall()[0]
   return (row[0] != 1) or (row[1] != 0)
 
-def fix_numstr_decimals(num_str, decimals):
-  if len(num_str) <= 18:
-    num_str = '0' * (18 - len(num_str)) + num_str
-    num_str = '0.' + num_str
-    if decimals < 18:
-      num_str = num_str[:-18+decimals]
-  else:
-    num_str = num_str[:-18] + '.' + num_str[-18:]
-    if decimals < 18:
-      num_str = num_str[:-18+decimals]
-  if num_str[-1] == '.': num_str = num_str[:-1] ## remove trailing dot
-  return num_str
-
 def get_event_str(event, event_type, inscription_id):
   global ticks
   if event_type == "deploy-inscribe":
@@ -292,64 +273,73 @@ def get_event_str(event, event_type, inscription_id):
     print("EVENT TYPE ERROR!!")
     exit(1)
 
-def get_sha256_hash(s):
-  return hashlib.sha256(s.encode('utf-8')).hexdigest()
-
-
-
-
-
 ## caches
-transfer_inscribe_event_cache = {} ## single use cache for transfer inscribe events
+transfer_inscribe_event_cache = LRUCache("transfer inscribe cache", transfer_cache_max_mb * 1024 * 1024) ## single use cache for transfer inscribe events, values are (source_pkScript, source_wallet)
 def get_transfer_inscribe_event(inscription_id):
   global transfer_inscribe_event_cache, event_types
-  if inscription_id in transfer_inscribe_event_cache:
-    event = transfer_inscribe_event_cache[inscription_id]
-    del transfer_inscribe_event_cache[inscription_id]
+  event = transfer_inscribe_event_cache.pop(inscription_id)
+  if event is not None:
     return event
-  cur.execute('''select event from brc6699_events where event_type = %s and inscription_id = %s;''', (event_types["transfer-inscribe"], inscription_id,))
-  return cur.fetchall()[0][0]
+  cur.execute('''select event->>'source_pkScript', event->>'source_wallet' from brc6699_events where event_type = %s and inscription_id = %s;''', (event_types["transfer-inscribe"], inscription_id,))
+  return cur.fetchall()[0]
 
 def save_transfer_inscribe_event(inscription_id, event):
-  transfer_inscribe_event_cache[inscription_id] = event
+  transfer_inscribe_event_cache.set(inscription_id, (sys.intern(event["source_pkScript"]), event["source_wallet"]))
 
-balance_cache = {}
+balance_cache = LRUCache("balance cache", balance_cache_max_mb * 1024 * 1024) ## keys are (pkscript, tick), values are Balance records
 def get_last_balance(pkscript, tick):
   global balance_cache
-  cache_key = pkscript + tick
-  if cache_key in balance_cache:
-    return balance_cache[cache_key]
+  cache_key = (sys.intern(pkscript), sys.intern(tick))
+  balance_obj = balance_cache.get(cache_key)
+  if balance_obj is not None:
+    return balance_obj
+  st_tm = time.time()
   cur.execute('''select overall_balance, available_balance from brc6699_historic_balances where pkscript = %s and tick = %s order by block_height desc, id desc limit 1;''', (pkscript, tick))
   row = cur.fetchone()
-  balance_obj = None
+  work_stats.add_time("balance_fetch_tm", st_tm)
   if row is None:
-    balance_obj = {
-      "overall_balance": 0,
-      "available_balance": 0
-    }
+    balance_obj = Balance(0, 0)
   else:
-    balance_obj = {
-      "overall_balance": row[0],
-      "available_balance": row[1]
-    }
-  balance_cache[cache_key] = balance_obj
+    balance_obj = Balance(row[0], row[1])
+  balance_cache.set(cache_key, balance_obj)
   return balance_obj
 
 def check_available_balance(pkScript, tick, amount):
   last_balance = get_last_balance(pkScript, tick)
-  available_balance = last_balance["available_balance"]
+  available_balance = last_balance.available_balance
   if available_balance < amount: return False
   return True
 
+## tickers, loaded at startup and after a reorg, updated on deploy and mint
+## ticks: tick -> [remaining_supply, limit_mint_count, decimals]
+## delegate_ticks: deploy inscription_id -> [tick, height, remaining_supply, limit_mint_count, limit_mint_block], used by delegated mints
+delegate_ticks = {}
+def load_ticks():
+  global ticks, delegate_ticks
+  sttm = time.time()
+  cur.execute('''select tick, remaining_supply, limit_mint_count, decimals, inscription_id, height, limit_mint_block from brc6699_tickers;''')
+  ticks = {}
+  delegate_ticks = {}
+  for t in cur.fetchall():
+    ticks[t[0]] = [t[1], t[2], t[3]]
+    delegate_ticks[t[4]] = [t[0], t[5], t[1], t[2], t[6]]
+  print("Ticks loaded (" + str(len(ticks)) + ") in " + str(time.time() - sttm) + " seconds")
+
 def reset_caches():
   global balance_cache, transfer_inscribe_event_cache
-  balance_cache = {}
-  transfer_inscribe_event_cache = {}
+  balance_cache.clear()
+  transfer_inscribe_event_cache.clear()
+  load_ticks()
+
+## evicts least recently used entries over the memory budget, only call after commit
+def trim_caches():
+  for cache in [balance_cache, transfer_inscribe_event_cache]:
+    cache.trim()
+    print(cache.stats_str())
 
+## rows are buffered in engine.writes and written in a single transaction at the end of the block (tables are registered below)
 def deploy_inscribe(block_height, inscription_id, delegate_id, deployer_pkScript, deployer_wallet, tick, max_supply, decimals, limit_mint_count, limit_mint_block, height_limit):
-  global ticks, in_commit, block_events_str, event_types
-  cur.execute("BEGIN;")
-  in_commit = True
+  global ticks, block_events_hasher, event_types
 
   event = {
     "deployer_pkScript": deployer_pkScript,
@@ -361,22 +351,17 @@ def deploy_inscribe(block_height, inscription_id, delegate_id, deployer_pkScript
     "limit_mint_count": str(limit_mint_count),
     "limit_mint_block": str(limit_mint_block)
   }
-  block_events_str += get_event_str(event, "deploy-inscribe", inscription_id) + EVENT_SEPARATOR
-  cur.execute('''insert into brc6699_events (tick, event_type, block_height, inscription_id, event)
-    values (%s, %s, %s, %s, %s);''', (tick, event_types["deploy-inscribe"], block_height, inscription_id, json.dumps(event)))
+  block_events_hasher.add(get_event_str(event, "deploy-inscribe", inscription_id))
+  engine.writes.insert('brc6699_events', (tick, event_types["deploy-inscribe"], block_height, inscription_id, json.dumps(event)))
   
   print("=====", tick, max_supply, decimals, limit_mint_count, limit_mint_block, max_supply, block_height)
-  cur.execute('''insert into brc6699_tickers (tick, delegate_id,inscription_id, height, max_supply, decimals, limit_mint_count, limit_mint_block, remaining_supply, block_height)
-    values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);''', (tick, delegate_id,inscription_id, height_limit, max_supply, decimals, limit_mint_count, limit_mint_block, max_supply, block_height))
+  engine.writes.insert('brc6699_tickers', (tick, delegate_id, inscription_id, height_limit, max_supply, decimals, limit_mint_count, limit_mint_block, max_supply, block_height))
   
-  cur.execute("COMMIT;")
-  in_commit = False
   ticks[tick] = [max_supply, limit_mint_count, decimals, limit_mint_block]
+  delegate_ticks[inscription_id] = [tick, height_limit, max_supply, limit_mint_count, limit_mint_block] ## same values as load_ticks reads back
 
 def mint_inscribe(block_height, inscription_id, minted_pkScript, minted_wallet, tick, amount):
-  global ticks, in_commit, block_events_str, event_types
-  cur.execute("BEGIN;")
-  in_commit = True
+  global ticks, block_events_hasher, event_types
 
   event = {
     "minted_pkScript": minted_pkScript,
@@ -384,31 +369,22 @@ def mint_inscribe(block_height, inscription_id, minted_pkScript, minted_wallet,
     "tick": tick,
     "amount": str(amount)
   }
-  block_events_str += get_event_str(event, "mint-inscribe", inscription_id) + EVENT_SEPARATOR
-  cur.execute('''insert into brc6699_events (tick, event_type, block_height, inscription_id, event)
-    values (%s, %s, %s, %s, %s) returning id;''', (tick, event_types["mint-inscribe"], block_height, inscription_id, json.dumps(event)))
-  event_id = cur.fetchone()[0]
-  cur.execute('''update brc6699_tickers set remaining_supply = remaining_supply - %s where tick = %s and max_supply is not null;''', (amount, tick))
+  block_events_hasher.add(get_event_str(event, "mint-inscribe", inscription_id))
+  event_id = engine.writes.insert('brc6699_events', (tick, event_types["mint-inscribe"], block_height, inscription_id, json.dumps(event)))
+  engine.writes.update('brc6699_tickers_remaining_supply', (tick,), amount)
 
   last_balance = get_last_balance(minted_pkScript, tick)
-  last_balance["overall_balance"] += amount
-  last_balance["available_balance"] += amount
-  cur.execute('''insert into brc6699_historic_balances (pkscript, wallet, tick, overall_balance, available_balance, block_height, event_id) 
-                values (%s, %s, %s, %s, %s, %s, %s);''', 
-                (minted_pkScript, minted_wallet, tick, last_balance["overall_balance"], last_balance["available_balance"], block_height, event_id))
+  last_balance.overall_balance += amount
+  last_balance.available_balance += amount
+  engine.writes.insert('brc6699_historic_balances', (minted_pkScript, minted_wallet, tick, last_balance.overall_balance, last_balance.available_balance, block_height, event_id))
 
   #创建brc6699_collection
-  cur.execute('''insert into brc6699_collections (tick, inscription_id, pkscript, wallet, block_height)
-    values (%s, %s, %s, %s, %s);''', (tick, inscription_id, minted_pkScript, minted_wallet, block_height))
+  engine.writes.insert('brc6699_collections', (tick, inscription_id, minted_pkScript, minted_wallet, block_height))
   
-  cur.execute("COMMIT;")
-  in_commit = False
   ticks[tick][0] -= amount
 
 def transfer_inscribe(block_height, inscription_id, source_pkScript, source_wallet, tick, amount):
-  global in_commit, block_events_str, event_types
-  cur.execute("BEGIN;")
-  in_commit = True
+  global block_events_hasher, event_types
 
   event = {
     "source_pkScript": source_pkScript,
@@ -416,29 +392,20 @@ def transfer_inscribe(block_height, inscription_id, source_pkScript, source_wall
     "tick": tick,
     "amount": str(amount)
   }
-  block_events_str += get_event_str(event, "transfer-inscribe", inscription_id) + EVENT_SEPARATOR
-  cur.execute('''insert into brc6699_events (tick, event_type, block_height, inscription_id, event)
-    values (%s, %s, %s, %s, %s) returning id;''', (tick, event_types["transfer-inscribe"], block_height, inscription_id, json.dumps(event)))
-  event_id = cur.fetchone()[0]
+  block_events_hasher.add(get_event_str(event, "transfer-inscribe", inscription_id))
+  event_id = engine.writes.insert('brc6699_events', (tick, event_types["transfer-inscribe"], block_height, inscription_id, json.dumps(event)))
   
   last_balance = get_last_balance(source_pkScript, tick)
-  last_balance["available_balance"] -= amount
-  cur.execute('''insert into brc6699_historic_balances (pkscript, wallet, tick, overall_balance, available_balance, block_height, event_id)
-                values (%s, %s, %s, %s, %s, %s, %s);''', 
-                (source_pkScript, source_wallet, tick, last_balance["overall_balance"], last_balance["available_balance"], block_height, event_id))
+  last_balance.available_balance -= amount
+  engine.writes.insert('brc6699_historic_balances', (source_pkScript, source_wallet, tick, last_balance.overall_balance, last_balance.available_balance, block_height, event_id))
   
-  cur.execute("COMMIT;")
-  in_commit = False
   save_transfer_inscribe_event(inscription_id, event)
 
 def transfer_transfer_normal(block_height, inscription_id, spent_pkScript, spent_wallet, tick, amount, using_tx_id):
-  global in_commit, block_events_str, event_types
-  cur.execute("BEGIN;")
-  in_commit = True
+  global block_events_hasher, event_types
 
   inscribe_event = get_transfer_inscribe_event(inscription_id)
-  source_pkScript = inscribe_event["source_pkScript"]
-  source_wallet = inscribe_event["source_wallet"]
+  source_pkScript, source_wallet = inscribe_event
   event = {
     "source_pkScript": source_pkScript,
     "source_wallet": source_wallet,
@@ -448,36 +415,24 @@ def transfer_transfer_normal(block_height, inscription_id, spent_pkScript, spent
     "amount": str(amount),
     "using_tx_id": str(using_tx_id)
   }
-  block_events_str += get_event_str(event, "transfer-transfer", inscription_id) + EVENT_SEPARATOR
-  cur.execute('''insert into brc6699_events (tick, event_type, block_height, inscription_id, event)
-    values (%s, %s, %s, %s, %s) returning id;''', (tick, event_types["transfer-transfer"], block_height, inscription_id, json.dumps(event)))
-  event_id = cur.fetchone()[0]
+  block_events_hasher.add(get_event_str(event, "transfer-transfer", inscription_id))
+  event_id = engine.writes.insert('brc6699_events', (tick, event_types["transfer-transfer"], block_height, inscription_id, json.dumps(event)))
   
   last_balance = get_last_balance(source_pkScript, tick)
-  last_balance["overall_balance"] -= amount
-  cur.execute('''insert into brc6699_historic_balances (pkscript, wallet, tick, overall_balance, available_balance, block_height, event_id)
-                values (%s, %s, %s, %s, %s, %s, %s);''', 
-                (source_pkScript, source_wallet, tick, last_balance["overall_balance"], last_balance["available_balance"], block_height, event_id))
+  last_balance.overall_balance -= amount
+  engine.writes.insert('brc6699_historic_balances', (source_pkScript, source_wallet, tick, last_balance.overall_balance, last_balance.available_balance, block_height, event_id))
   
   if spent_pkScript != source_pkScript:
     last_balance = get_last_balance(spent_pkScript, tick)
-  last_balance["overall_balance"] += amount
-  last_balance["available_balance"] += amount
-  cur.execute('''insert into brc6699_historic_balances (pkscript, wallet, tick, overall_balance, available_balance, block_height, event_id) 
-                values (%s, %s, %s, %s, %s, %s, %s);''', 
-                (spent_pkScript, spent_wallet, tick, last_balance["overall_balance"], last_balance["available_balance"], block_height, -1 * event_id)) ## negated to make a unique event_id
-  
-  cur.execute("COMMIT;")
-  in_commit = False
+  last_balance.overall_balance += amount
+  last_balance.available_balance += amount
+  engine.writes.insert('brc6699_historic_balances', (spent_pkScript, spent_wallet, tick, last_balance.overall_balance, last_balance.available_balance, block_height, -1 * event_id)) ## negated to make a unique event_id
 
 def transfer_transfer_spend_to_fee(block_height, inscription_id, tick, amount, using_tx_id):
-  global in_commit, block_events_str, event_types
-  cur.execute("BEGIN;")
-  in_commit = True
+  global block_events_hasher, event_types
 
   inscribe_event = get_transfer_inscribe_event(inscription_id)
-  source_pkScript = inscribe_event["source_pkScript"]
-  source_wallet = inscribe_event["source_wallet"]
+  source_pkScript, source_wallet = inscribe_event
   event = {
     "source_pkScript": source_pkScript,
     "source_wallet": source_wallet,
@@ -487,39 +442,20 @@ def transfer_transfer_spend_to_fee(block_height, inscription_id, tick, amount, u
     "amount": str(amount),
     "using_tx_id": str(using_tx_id)
   }
-  block_events_str += get_event_str(event, "transfer-transfer", inscription_id) + EVENT_SEPARATOR
-  cur.execute('''insert into brc6699_events (tick, event_type, block_height, inscription_id, event)
-    values (%s, %s, %s, %s, %s) returning id;''', (tick, event_types["transfer-transfer"], block_height, inscription_id, json.dumps(event)))
-  event_id = cur.fetchone()[0]
+  block_events_hasher.add(get_event_str(event, "transfer-transfer", inscription_id))
+  event_id = engine.writes.insert('brc6699_events', (tick, event_types["transfer-transfer"], block_height, inscription_id, json.dumps(event)))
   
   last_balance = get_last_balance(source_pkScript, tick)
-  last_balance["available_balance"] += amount
-  cur.execute('''insert into brc6699_historic_balances (pkscript, wallet, tick, overall_balance, available_balance, block_height, event_id) 
-                values (%s, %s, %s, %s, %s, %s, %s);''', 
-                (source_pkScript, source_wallet, tick, last_balance["overall_balance"], last_balance["available_balance"], block_height, event_id))
-  
-  cur.execute("COMMIT;")
-  in_commit = False
-
-
-def update_event_hashes(block_height):
-  global block_events_str
-  if len(block_events_str) > 0 and block_events_str[-1] == EVENT_SEPARATOR: block_events_str = block_events_str[:-1] ## remove last separator
-  block_event_hash = get_sha256_hash(block_events_str)
-  cumulative_event_hash = None
-  cur.execute('''select cumulative_event_hash from brc6699_cumulative_event_hashes where block_height = %s;''', (block_height - 1,))
-  if cur.rowcount == 0:
-    cumulative_event_hash = block_event_hash
-  else:
-    cumulative_event_hash = get_sha256_hash(cur.fetchone()[0] + block_event_hash)
-  cur.execute('''INSERT INTO brc6699_cumulative_event_hashes (block_height, block_event_hash, cumulative_event_hash) VALUES (%s, %s, %s);''', (block_height, block_event_hash, cumulative_event_hash))
-    
+  last_balance.available_balance += amount
+  engine.writes.insert('brc6699_historic_balances', (source_pkScript, source_wallet, tick, last_balance.overall_balance, last_balance.available_balance, block_height, event_id))
+
 
 def index_block(block_height, current_block_hash):
-  global ticks, block_events_str
+  global ticks, block_events_hasher
   print("Indexing block " + str(block_height))
-  block_events_str = ""
+  block_events_hasher = engine.start_block(block_height)
   
+  st_tm = time.time()
   cur_metaprotocol.execute('''SELECT ot.inscription_id, ot.old_satpoint, ot.new_pkscript, ot.new_wallet, ot.sent_as_fee, oc."content", oc.content_type, oc.delegate_id
                               FROM ord_transfers ot
                               LEFT JOIN ord_content oc ON ot.inscription_id = oc.inscription_id
@@ -537,21 +473,22 @@ def index_block(block_height, current_block_hash):
                               WHERE ot.block_height = %s  AND oc.delegate_id is not null
                               ORDER BY ot.id asc;''', (block_height,))
   mint_transfers = cur_metaprotocol.fetchall()
+  work_stats.add_time("fetch_tm", st_tm)
+  work_stats.add_count("transfer_count", len(mint_transfers) + len(transfers))
   if len(mint_transfers) == 0 and len(transfers) == 0:
     print("No transfers found for block " + str(block_height))
-    update_event_hashes(block_height)
-    cur.execute('''INSERT INTO brc6699_block_hashes (block_height, block_hash) VALUES (%s, %s);''', (block_height, current_block_hash))
+    engine.commit_block(block_height, current_block_hash)
     return
   print("Transfer count: ", len(mint_transfers)+len(transfers))
 
-  ## refresh ticks
-  sttm = time.time()
-  cur.execute('''select tick, remaining_supply,  limit_mint_count, decimals, limit_mint_block from brc6699_tickers;''')
-  ticks_ = cur.fetchall()
-  ticks = {}
-  for t in ticks_:
-    ticks[t[0]] = [t[1], t[2], t[3]]
-  print("Ticks refreshed in " + str(time.time() - sttm) + " seconds")
+  st_tm = time.time()
+  ## deployer check of all deploys in the block with a single query
+  deploy_delegate_ids = set()
+  for transfer in transfers:
+    js, old_satpoint = transfer[5], transfer[1]
+    if isinstance(js, dict) and js.get("op") == 'deploy' and old_satpoint == '' and isinstance(js.get("id"), str):
+      deploy_delegate_ids.add(js["id"])
+  deploy_addresses = get_inscription_addresses_by_ids(deploy_delegate_ids)
   
   idx = 0
   for transfer in transfers:
@@ -583,7 +520,8 @@ def index_block(block_height, current_block_hash):
       if "id" not in js: continue ## invalid inscription
       deploy_delegate_id = js["id"]
       #check deploy own inscription
-      ins_address = get_inscription_address_by_id(deploy_delegate_id)
+      if deploy_delegate_id in deploy_addresses: ins_address = deploy_addresses[deploy_delegate_id]
+      else: ins_address = get_inscription_address_by_id(deploy_delegate_id)
       # print("========,", ins_address, new_addr)
       if ins_address is None: continue
       if ins_address != new_addr: continue
@@ -621,7 +559,9 @@ def index_block(block_height, current_block_hash):
       # height
       height_limit = None
       if "height" in js:
-        height_limit = js["height"]
+        try: height_limit = int(js["height"])
+        except: continue ## invalid height
+        if height_limit < -2**31 or height_limit > 2**31-1: continue ## invalid height, stored as int4
       print(block_height, inscr_id, new_pkScript, new_addr, tick, max_supply, decimals, limit_mint_count, limit_mint_block, height_limit)
       deploy_inscribe(block_height, inscr_id, deploy_delegate_id, new_pkScript, new_addr, tick, max_supply, decimals, limit_mint_count, limit_mint_block, height_limit)
     
@@ -645,6 +585,8 @@ def index_block(block_height, current_block_hash):
     #     else: transfer_transfer_normal(block_height, inscr_id, new_pkScript, new_addr, tick, amount, tx_id)
 
   brc6699_minted_count_map = {}
+  ## already minted check of all candidate inscriptions with a single query, mints of this block are added as they happen
+  minted_inscription_ids = get_minted_inscription_ids(set(transfer[0] for transfer in mint_transfers))
   for transfer in mint_transfers:
     idx += 1
     if idx % 100 == 0:
@@ -653,15 +595,14 @@ def index_block(block_height, current_block_hash):
     inscr_id, old_satpoint, new_pkScript, new_addr, sent_as_fee, js, content_type, delegate_id = transfer
     print("==========",transfer)
     
-    if is_minted_or_invalid(inscr_id): continue ## already used or invalid
+    if inscr_id in minted_inscription_ids: continue ## already used or invalid
     if sent_as_fee and old_satpoint == '': continue ## inscribed as fee
 
     # print("mint===transfer==", transfer)
     if delegate_id:
       print("mint=delegate====", delegate_id)
-      cur.execute('select tick, height, remaining_supply, limit_mint_count, limit_mint_block from brc6699_tickers where inscription_id = %s;', (delegate_id,))
-      if cur.rowcount == 0: continue # not deployed
-      ticker = cur.fetchone()
+      ticker = delegate_ticks.get(delegate_id)
+      if ticker is None: continue # not deployed
       tick, height_limit, remaining_supply, limit_mint_count, limit_mint_block = ticker
       mint_count = brc6699_minted_count_map.get(tick,0)
       if remaining_supply and remaining_supply <= 0: continue # mint ended
@@ -679,44 +620,38 @@ def index_block(block_height, current_block_hash):
         amount = remaining_supply
 
       mint_inscribe(block_height, inscr_id, new_pkScript,new_addr, tick, amount)
+      minted_inscription_ids.add(inscr_id)
+      if remaining_supply is not None: ticker[2] = remaining_supply - amount
       # print(brc6699_minted_count_map)
       brc6699_minted_count_map[tick] = mint_count + 1
+  work_stats.add_time("index_tm", st_tm)
 
-  update_event_hashes(block_height)
-  # end of block
-  cur.execute('''INSERT INTO brc6699_block_hashes (block_height, block_hash) VALUES (%s, %s);''', (block_height, current_block_hash))
-  conn.commit()
+  engine.commit_block(block_height, current_block_hash)
+  trim_caches()
   print("ALL DONE")
 
 
+## per-block work stats, stage timings are in ms, saved to brc6699_indexer_work_stats after each block
+work_stats_columns = ["transfer_count", "event_count", "fetch_tm", "balance_fetch_tm", "index_tm", "write_tm", "hash_tm", "commit_tm", "extra_tables_tm", "report_tm", "all_tm", "balance_cache_hits", "balance_cache_misses"]
+work_stats = WorkStats(cur, 'brc6699_indexer_work_stats', work_stats_columns)
+work_stats.track_cache("balance_cache", balance_cache)
 
-def check_for_reorg():
-  cur.execute('select block_height, block_hash from brc6699_block_hashes order by block_height desc limit 1;')
-  if cur.rowcount == 0: return None ## nothing indexed yet
-  last_block = cur.fetchone()
+## opt-in profiling of blocks PROFILE_START_HEIGHT - PROFILE_END_HEIGHT
+block_profiler = BlockRangeProfiler(profile_mode, profile_start_height, profile_end_height, profile_sample_interval_ms, profile_output_file)
 
-  cur_metaprotocol.execute('select block_height, block_hash from block_hashes where block_height = %s;', (last_block[0],))
-  last_block_ord = cur_metaprotocol.fetchone()
-  if last_block_ord[1] == last_block[1]: return None ## last block hashes are the same, no reorg
+## block loop, block-buffered writes (COPY or multi-row INSERT), commits and reorgs
+engine = ProtocolEngine('brc6699', conn, cur, conn_metaprotocol, cur_metaprotocol, bulk_writer, work_stats, block_profiler)
+engine.writes.add_table('brc6699_events', ['tick', 'event_type', 'block_height', 'inscription_id', 'event'], client_ids=True)
+engine.writes.add_table('brc6699_tickers', ['tick', 'delegate_id', 'inscription_id', 'height', 'max_supply', 'decimals', 'limit_mint_count', 'limit_mint_block', 'remaining_supply', 'block_height'])
+engine.writes.add_table('brc6699_historic_balances', ['pkscript', 'wallet', 'tick', 'overall_balance', 'available_balance', 'block_height', 'event_id'])
+engine.writes.add_table('brc6699_collections', ['tick', 'inscription_id', 'pkscript', 'wallet', 'block_height'])
+engine.writes.add_update('brc6699_tickers_remaining_supply', '''update brc6699_tickers set remaining_supply = remaining_supply - %s where tick = %s and max_supply is not null;''')
+engine.reorg_tables = ['brc6699_tickers', 'brc6699_historic_balances', 'brc6699_events', 'brc6699_collections']
 
-  print("REORG DETECTED!!")
-  cur.execute('select block_height, block_hash from brc6699_block_hashes order by block_height desc limit 10;')
-  hashes = cur.fetchall() ## get last 10 hashes
-  for h in hashes:
-    cur_metaprotocol.execute('select block_height, block_hash from block_hashes where block_height = %s;', (h[0],))
-    block = cur_metaprotocol.fetchone()
-    if block[1] == h[1]: ## found reorg height by a matching hash
-      print("REORG HEIGHT FOUND: " + str(h[0]))
-      return h[0]
-  
-  ## bigger than 10 block reorg is not supported by ord
-  print("CRITICAL ERROR!!")
-  sys.exit(1)
 
-def reorg_fix(reorg_height):
+## remaining_supply of tickers deployed before the reorg height, rows above it are deleted by the engine
+def revert_remaining_supply(reorg_height):
   global event_types
-  cur.execute('begin;')
-  cur.execute('delete from brc6699_tickers where block_height > %s;', (reorg_height,)) ## delete new tickers
   ## fetch mint events for reverting remaining_supply in other tickers
   cur.execute('''select event from brc6699_events where event_type = %s and block_height > %s;''', (event_types["mint-inscribe"], reorg_height,))
   rows = cur.fetchall()
@@ -730,46 +665,10 @@ def reorg_fix(reorg_height):
     tick_changes[tick] += amount
   for tick in tick_changes:
     cur.execute('''update brc6699_tickers set remaining_supply = remaining_supply + %s where tick = %s;''', (tick_changes[tick], tick))
-  cur.execute('delete from brc6699_historic_balances where block_height > %s;', (reorg_height,)) ## delete new balances
-  cur.execute('delete from brc6699_events where block_height > %s;', (reorg_height,)) ## delete new events
-  cur.execute('delete from brc6699_cumulative_event_hashes where block_height > %s;', (reorg_height,)) ## delete new bitmaps
-  cur.execute("SELECT setval('brc6699_cumulative_event_hashes_id_seq', max(id)) from brc6699_cumulative_event_hashes;") ## reset id sequence
-  cur.execute("SELECT setval('brc6699_tickers_id_seq', max(id)) from brc6699_tickers;") ## reset id sequence
-  cur.execute("SELECT setval('brc6699_historic_balances_id_seq', max(id)) from brc6699_historic_balances;") ## reset id sequence
-  cur.execute("SELECT setval('brc6699_events_id_seq', max(id)) from brc6699_events;") ## reset id sequence
-  cur.execute('delete from brc6699_block_hashes where block_height > %s;', (reorg_height,)) ## delete new block hashes
-  cur.execute("SELECT setval('brc6699_block_hashes_id_seq', max(id)) from brc6699_block_hashes;") ## reset id sequence
-  cur.execute('commit;')
-  reset_caches()
 
-def check_if_there_is_residue_from_last_run():
-  cur.execute('''select max(block_height) from brc6699_block_hashes;''')
-  row = cur.fetchone()
-  current_block = None
-  if row[0] is None: current_block = first_inscription_height
-  else: current_block = row[0] + 1
-  residue_found = False
-  cur.execute('''select coalesce(max(block_height), -1) from brc6699_events;''')
-  if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
-    residue_found = True
-    print("residue on brc6699_events")
-  cur.execute('''select coalesce(max(block_height), -1) from brc6699_historic_balances;''')
-  if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
-    residue_found = True
-    print("residue on historic balances")
-  cur.execute('''select coalesce(max(block_height), -1) from brc6699_tickers;''')
-  if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
-    residue_found = True
-    print("residue on tickers")
-  cur.execute('''select coalesce(max(block_height), -1) from brc6699_cumulative_event_hashes;''')
-  if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
-    residue_found = True
-    print("residue on cumulative hashes")
-  if residue_found:
-    print("There is residue from last run, rolling back to " + str(current_block - 1))
-    reorg_fix(current_block - 1)
-    print("Rolled back to " + str(current_block - 1))
-    return
+def reorg_fix(reorg_height):
+  engine.reorg_fix(reorg_height, revert_remaining_supply)
+  reset_caches()
 
 def check_if_there_is_residue_on_extra_tables_from_last_run():
   cur.execute('''select max(block_height) from brc6699_extras_block_hashes;''')
@@ -802,13 +701,39 @@ for key in event_types:
   event_types_rev[event_types[key]] = key
 
 
+## block event hashes of a range of blocks, runs in a worker process of reindex_cumulative_hashes with its own connection
+## events are streamed with a server-side cursor, ticks and event_types_rev are inherited from the parent process
+def get_block_event_hashes_of_range(block_range):
+  start_height, end_height = block_range
+  conn_worker = psycopg2.connect(
+    host=db_host,
+    port=db_port,
+    database=db_database,
+    user=db_user,
+    password=db_password)
+  cur_worker = conn_worker.cursor(name='reindex_events')
+  cur_worker.itersize = 10000
+  cur_worker.execute('''select block_height, event, event_type, inscription_id from brc6699_events
+                        where block_height >= %s and block_height <= %s
+                        order by block_height asc, id asc;''', (start_height, end_height))
+  hashers = {}
+  for row in cur_worker:
+    if row[0] not in hashers: hashers[row[0]] = BlockEventHasher()
+    hashers[row[0]].add(get_event_str(row[1], event_types_rev[row[2]], row[3]))
+  cur_worker.close()
+  conn_worker.close()
+  return [(block_height, (hashers.get(block_height) or BlockEventHasher()).hexdigest()) for block_height in range(start_height, end_height + 1)]
+
+## block event hashes are computed in parallel over block ranges, only the cumulative hash chain is sequential
 def reindex_cumulative_hashes():
   global event_types_rev, ticks
-  cur.execute('''delete from brc6699_cumulative_event_hashes;''')
   cur.execute('''select min(block_height), max(block_height) from brc6699_block_hashes;''')
   row = cur.fetchone()
   min_block = row[0]
   max_block = row[1]
+  if min_block is None:
+    cur.execute('''delete from brc6699_cumulative_event_hashes;''')
+    return
 
   sttm = time.time()
   cur.execute('''select tick, remaining_supply, limit_mint_count, decimals, limit_mint_block from brc6699_tickers;''')
@@ -818,18 +743,25 @@ def reindex_cumulative_hashes():
     ticks[t[0]] = [t[1], t[2], t[3]]
   print("Ticks refreshed in " + str(time.time() - sttm) + " seconds")
 
-  print("Reindexing cumulative hashes from " + str(min_block) + " to " + str(max_block))
-  for block_height in range(min_block, max_block + 1):
-    print("Reindexing block " + str(block_height))
-    block_events_str = ""
-    cur.execute('''select event, event_type, inscription_id from brc6699_events where block_height = %s order by id asc;''', (block_height,))
-    rows = cur.fetchall()
-    for row in rows:
-      event = row[0]
-      event_type = event_types_rev[row[1]]
-      inscription_id = row[2]
-      block_events_str += get_event_str(event, event_type, inscription_id) + EVENT_SEPARATOR
-    update_event_hashes(block_height)
+  print("Reindexing cumulative hashes from " + str(min_block) + " to " + str(max_block) + " with " + str(reindex_workers) + " workers")
+  block_ranges = [(start_height, min(start_height + 999, max_block)) for start_height in range(min_block, max_block + 1, 1000)]
+  hash_rows = []
+  last_cumulative_event_hash = None
+  with multiprocessing.get_context('fork').Pool(reindex_workers) as pool: ## fork, workers need the module state and must not re-run the module
+    for block_hashes in pool.imap(get_block_event_hashes_of_range, block_ranges): ## in order of block ranges
+      for block_height, block_event_hash in block_hashes:
+        last_cumulative_event_hash = get_cumulative_event_hash(last_cumulative_event_hash, block_event_hash)
+        hash_rows.append((block_height, block_event_hash, last_cumulative_event_hash))
+      print("Reindexed up to block " + str(hash_rows[-1][0]))
+
+  copy_buf = io.StringIO()
+  for hash_row in hash_rows:
+    copy_buf.write('%d\t%s\t%s\n' % hash_row)
+  copy_buf.seek(0)
+  cur.execute('BEGIN;')
+  cur.execute('''delete from brc6699_cumulative_event_hashes;''')
+  cur.copy_expert('''COPY brc6699_cumulative_event_hashes (block_height, block_event_hash, cumulative_event_hash) FROM STDIN''', copy_buf)
+  cur.execute('COMMIT;')
 
 cur.execute('select db_version from brc6699_indexer_version;')
 if cur.rowcount == 0:
@@ -850,46 +782,16 @@ else:
       cur.execute('update brc6699_indexer_version set indexer_version = %s, db_version = %s;', (INDEXER_VERSION, DB_VERSION,))
       print("Fixed.")
 
-def try_to_report_with_retries(to_send):
-  global report_url, report_retries
-  for _ in range(0, report_retries):
-    try:
-      r = requests.post(report_url, json=to_send)
-      if r.status_code == 200:
-        print("Reported hashes to metaprotocol indexer indexer.")
-        return
-      else:
-        print("Error while reporting hashes to metaprotocol indexer indexer, status code: " + str(r.status_code))
-    except:
-      print("Error while reporting hashes to metaprotocol indexer indexer, retrying...")
-    time.sleep(1)
-  print("Error while reporting hashes to metaprotocol indexer indexer, giving up.")
-
-def report_hashes(block_height):
-  global report_to_indexer
-  if not report_to_indexer:
-    print("Reporting to metaprotocol indexer is disabled.")
-    return
-  cur.execute('''select block_event_hash, cumulative_event_hash from brc6699_cumulative_event_hashes where block_height = %s;''', (block_height,))
-  row = cur.fetchone()
-  block_event_hash = row[0]
-  cumulative_event_hash = row[1]
-  cur.execute('''select block_hash from brc6699_block_hashes where block_height = %s;''', (block_height,))
-  block_hash = cur.fetchone()[0]
-  to_send = {
-    "name": report_name,
-    "type": "brc6699",
-    "node_type": "full_node",
-    "network_type": network_type,
-    "version": INDEXER_VERSION,
-    "db_version": DB_VERSION,
-    "block_height": block_height,
-    "block_hash": block_hash,
-    "block_event_hash": block_event_hash,
-    "cumulative_event_hash": cumulative_event_hash
-  }
-  print("Sending hashes to metaprotocol indexer indexer...")
-  try_to_report_with_retries(to_send)
+load_ticks()
+
+engine.configure_reporting(report_to_indexer, report_url, report_retries, {
+  "name": report_name,
+  "type": "brc6699",
+  "node_type": "full_node",
+  "network_type": network_type,
+  "version": INDEXER_VERSION,
+  "db_version": DB_VERSION
+})
 
 def reorg_on_extra_tables(reorg_height):
   cur.execute('begin;')
@@ -1132,51 +1034,21 @@ def check_extra_tables():
     traceback.print_exc()
     return
 
-check_if_there_is_residue_from_last_run()
+engine.check_residue(first_inscription_height, reorg_fix)
 if create_extra_tables:
   check_if_there_is_residue_on_extra_tables_from_last_run()
   print("checking extra tables")
   check_extra_tables()
 
-last_report_height = 0
-while True:
-  check_if_there_is_residue_from_last_run()
+def before_block():
   if create_extra_tables:
     check_if_there_is_residue_on_extra_tables_from_last_run()
-  ## check if a new block is indexed
-  cur_metaprotocol.execute('''SELECT coalesce(max(block_height), -1) as max_height from block_hashes;''')
-  max_block_of_metaprotocol_db = cur_metaprotocol.fetchone()[0]
-  cur.execute('''select max(block_height) from brc6699_block_hashes;''')
-  row = cur.fetchone()
-  current_block = None
-  if row[0] is None: current_block = first_inscription_height
-  else: current_block = row[0] + 1
-  if current_block > max_block_of_metaprotocol_db:
-    print("Waiting for new blocks...")
-    time.sleep(5)
-    continue
-  
-  print("Processing block %s" % current_block)
-  cur_metaprotocol.execute('select block_hash from block_hashes where block_height = %s;', (current_block,))
-  current_block_hash = cur_metaprotocol.fetchone()[0]
-  reorg_height = check_for_reorg()
-  if reorg_height is not None:
-    print("Rolling back to ", reorg_height)
-    reorg_fix(reorg_height)
-    print("Rolled back to " + str(reorg_height))
-    continue
-  try:
-    index_block(current_block, current_block_hash)
-    if create_extra_tables:
-      print("checking extra tables")
-      check_extra_tables()
-    if max_block_of_metaprotocol_db - current_block < 10 or current_block - last_report_height > 100: ## do not report if there are more than 10 blocks to index
-      report_hashes(current_block)
-      last_report_height = current_block
-  except:
-    traceback.print_exc()
-    if in_commit: ## rollback commit if any
-      print("rolling back")
-      cur.execute('''ROLLBACK;''')
-      in_commit = False
-    time.sleep(10)
+
+def after_block(block_height, max_block_of_metaprotocol_db):
+  if create_extra_tables:
+    print("checking extra tables")
+    st_tm = time.time()
+    check_extra_tables()
+    work_stats.add_time("extra_tables_tm", st_tm)
+
+engine.run(first_inscription_height, index_block, reorg_fix, reset_caches, listen_new_blocks, new_block_wait_timeout, before_block, after_block)
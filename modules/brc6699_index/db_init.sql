@@ -89,6 +89,27 @@ INSERT INTO public.brc6699_event_types (event_type_name, event_type_id) VALUES (
 INSERT INTO public.brc6699_event_types (event_type_name, event_type_id) VALUES ('transfer-inscribe', 2);
 INSERT INTO public.brc6699_event_types (event_type_name, event_type_id) VALUES ('transfer-transfer', 3);
 
+CREATE TABLE public.brc6699_indexer_work_stats (
+	id bigserial NOT NULL,
+	min_block_height int4 NOT NULL,
+	max_block_height int4 NOT NULL,
+	transfer_count int4 NOT NULL DEFAULT 0,
+	event_count int4 NOT NULL DEFAULT 0,
+	fetch_tm int4 NOT NULL DEFAULT 0,
+	balance_fetch_tm int4 NOT NULL DEFAULT 0,
+	index_tm int4 NOT NULL DEFAULT 0,
+	write_tm int4 NOT NULL DEFAULT 0,
+	hash_tm int4 NOT NULL DEFAULT 0,
+	commit_tm int4 NOT NULL DEFAULT 0,
+	extra_tables_tm int4 NOT NULL DEFAULT 0,
+	report_tm int4 NOT NULL DEFAULT 0,
+	all_tm int4 NOT NULL DEFAULT 0,
+	balance_cache_hits int8 NOT NULL DEFAULT 0,
+	balance_cache_misses int8 NOT NULL DEFAULT 0,
+	ts timestamptz NOT NULL DEFAULT now(),
+	CONSTRAINT brc6699_indexer_work_stats_pk PRIMARY KEY (id)
+);
+
 CREATE TABLE public.brc6699_indexer_version (
 	id bigserial NOT NULL,
 	indexer_version text NOT NULL,
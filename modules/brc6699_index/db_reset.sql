@@ -5,4 +5,5 @@ drop table if exists brc6699_collections;
 drop table if exists brc6699_event_types;
 drop table if exists brc6699_tickers;
 drop table if exists brc6699_cumulative_event_hashes;
+drop table if exists brc6699_indexer_work_stats;
 drop table if exists brc6699_indexer_version;
\ No newline at end of file
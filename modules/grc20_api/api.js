@@ -150,7 +150,7 @@ app.get('/v1/brc20/activity_on_block', async (request, response) => {
     })
 
     let query =  `select event, event_type, inscription_id
-                  from brc20_events
+                  from brc20_events_json
                   where block_height = $1
                   order by id asc;`
     let res = await query_db(query, [block_height])
@@ -489,7 +489,7 @@ app.get('/v1/brc20/event', async (request, response) => {
     }
 
     let query =  `select event, event_type, inscription_id block_height
-                  from brc20_events
+                  from brc20_events_json
                   where inscription_id = $1
                   order by id asc;`
     let res = await query_db(query, [inscription_id])
@@ -78,6 +78,24 @@ VALUES ('mint-inscribe',
 									0);
 
 
+CREATE TABLE public.grc20_indexer_work_stats (
+	id bigserial NOT NULL,
+	min_block_height int4 NOT NULL,
+	max_block_height int4 NOT NULL,
+	transfer_count int4 NOT NULL DEFAULT 0,
+	event_count int4 NOT NULL DEFAULT 0,
+	fetch_tm int4 NOT NULL DEFAULT 0,
+	index_tm int4 NOT NULL DEFAULT 0,
+	write_tm int4 NOT NULL DEFAULT 0,
+	hash_tm int4 NOT NULL DEFAULT 0,
+	commit_tm int4 NOT NULL DEFAULT 0,
+	extra_tables_tm int4 NOT NULL DEFAULT 0,
+	report_tm int4 NOT NULL DEFAULT 0,
+	all_tm int4 NOT NULL DEFAULT 0,
+	ts timestamptz NOT NULL DEFAULT now(),
+	CONSTRAINT grc20_indexer_work_stats_pk PRIMARY KEY (id)
+);
+
 CREATE TABLE public.grc20_indexer_version ( id bigserial NOT NULL,
 																																												indexer_version text NOT NULL,
 																																												db_version int4 NOT NULL,
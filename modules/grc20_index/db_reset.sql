@@ -4,4 +4,5 @@ drop table if exists grc20_event_types;
 drop table if exists grc20_collections;
 drop table if exists grc20_tickers;
 drop table if exists grc20_cumulative_event_hashes;
+drop table if exists grc20_indexer_work_stats;
 drop table if exists grc20_indexer_version;
\ No newline at end of file
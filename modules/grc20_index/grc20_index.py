@@ -1,11 +1,15 @@
 # pip install python-dotenv
 # pip install psycopg2-binary
 
-import os, sys, requests
+import os, sys
 from dotenv import load_dotenv
-import traceback, time, codecs, json
+import time, codecs, json
 import psycopg2
-import hashlib
+import io
+import multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) ## modules directory, for opi_common
+from opi_common.numeric import fix_numstr_decimals
+from opi_common.engine import get_cumulative_event_hash, BlockEventHasher, WorkStats, BlockRangeProfiler, ProtocolEngine
 
 if not os.path.isfile('.env'):
   print(".env file not found, please run \"python3 reset_init.py\" first")
@@ -13,9 +17,7 @@ if not os.path.isfile('.env'):
 
 ## global variables
 ticks = {}
-in_commit = False
-block_events_str = ""
-EVENT_SEPARATOR = "|"
+block_events_hasher = None ## BlockEventHasher of the block being indexed
 INDEXER_VERSION = "opi-grc20-full-node v0.4.0"
 RECOVERABLE_DB_VERSIONS = [  ]
 DB_VERSION = 4
@@ -48,6 +50,15 @@ report_retries = int(os.getenv("REPORT_RETRIES") or "10")
 report_name = os.getenv("REPORT_NAME") or "opi_grc20_indexer"
 create_extra_tables = (os.getenv("CREATE_EXTRA_TABLES") or "false") == "true"
 network_type = os.getenv("NETWORK_TYPE") or "mainnet"
+bulk_writer = os.getenv("BULK_WRITER") or "copy" ## copy or insert
+profile_mode = os.getenv("PROFILE_MODE") or "" ## cprofile, sampling or empty to disable
+profile_start_height = int(os.getenv("PROFILE_START_HEIGHT") or "0")
+profile_end_height = int(os.getenv("PROFILE_END_HEIGHT") or "0")
+profile_sample_interval_ms = int(os.getenv("PROFILE_SAMPLE_INTERVAL_MS") or "10")
+profile_output_file = os.getenv("PROFILE_OUTPUT_FILE") or "grc20_profile"
+listen_new_blocks = (os.getenv("LISTEN_NEW_BLOCKS") or "true") == "true"
+new_block_wait_timeout = int(os.getenv("NEW_BLOCK_WAIT_TIMEOUT") or "30")
+reindex_workers = int(os.getenv("REINDEX_WORKERS") or "4")
 
 first_inscription_heights = {
   'mainnet': 767430,
@@ -69,6 +80,10 @@ if network_type == 'regtest':
   report_to_indexer = False
   print("Network type is regtest, reporting to indexer is disabled.")
 
+if profile_mode not in ["", "cprofile", "sampling"]:
+  print("PROFILE_MODE must be cprofile, sampling or empty")
+  sys.exit(1)
+
 ## connect to db
 conn = psycopg2.connect(
   host=db_host,
@@ -88,6 +103,10 @@ conn_metaprotocol = psycopg2.connect(
 conn_metaprotocol.autocommit = True
 cur_metaprotocol = conn_metaprotocol.cursor()
 
+## main_index notifies opi_new_block when a new block_hashes row is committed (see check_db in main_index/index.js)
+if listen_new_blocks:
+  cur_metaprotocol.execute('''LISTEN opi_new_block;''')
+
 ## create tables if not exists
 ## does grc20_block_hashes table exist?
 cur.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = 'grc20_block_hashes') AS table_existence;''')
@@ -98,6 +117,15 @@ if cur.fetchone()[0] == False:
     cur.execute(sql)
   conn.commit()
 
+## work stats table was added later, create it on databases initialised before it
+cur.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = 'grc20_indexer_work_stats') AS table_existence;''')
+if cur.fetchone()[0] == False:
+  print("Creating grc20_indexer_work_stats...")
+  with open('db_init.sql', 'r') as f:
+    for statement in f.read().split(';'):
+      if 'CREATE TABLE public.grc20_indexer_work_stats' in statement:
+        cur.execute(statement.strip() + ';')
+
 if create_extra_tables:
   pass
 
@@ -130,75 +158,6 @@ if default_max_transfer_cnt < 2:
 
 ## helper functions
 
-def utf8len(s):
-  return len(s.encode('utf-8'))
-
-def is_positive_number(s, do_strip=False):
-  try:
-    if do_strip:
-      s = s.strip()
-    try:
-      if len(s) == 0: return False
-      for ch in s:
-        if ord(ch) > ord('9') or ord(ch) < ord('0'):
-          return False
-      return True
-    except KeyboardInterrupt:
-      raise KeyboardInterrupt
-    except: return False
-  except KeyboardInterrupt:
-    raise KeyboardInterrupt
-  except: return False ## has to be a string
-
-def is_positive_number_with_dot(s, do_strip=False):
-  try:
-    if do_strip:
-      s = s.strip()
-    try:
-      dotFound = False
-      if len(s) == 0: return False
-      if s[0] == '.': return False
-      if s[-1] == '.': return False
-      for ch in s:
-        if ord(ch) > ord('9') or ord(ch) < ord('0'):
-          if ch != '.': return False
-          if dotFound: return False
-          dotFound = True
-      return True
-    except KeyboardInterrupt:
-      raise KeyboardInterrupt
-    except: return False
-  except KeyboardInterrupt:
-    raise KeyboardInterrupt
-  except: return False ## has to be a string
-
-def get_number_extended_to_18_decimals(s, decimals, do_strip=False):
-  if do_strip:
-    s = s.strip()
-  
-  if '.' in s:
-    normal_part = s.split('.')[0]
-    if len(s.split('.')[1]) > decimals or len(s.split('.')[1]) == 0: ## more decimal digit than allowed or no decimal digit after dot
-      return None
-    decimals_part = s.split('.')[1][:decimals]
-    decimals_part += '0' * (18 - len(decimals_part))
-    return int(normal_part + decimals_part)
-  else:
-    return int(s) * 10 ** 18
-
-def fix_numstr_decimals(num_str, decimals):
-  if len(num_str) <= 18:
-    num_str = '0' * (18 - len(num_str)) + num_str
-    num_str = '0.' + num_str
-    if decimals < 18:
-      num_str = num_str[:-18+decimals]
-  else:
-    num_str = num_str[:-18] + '.' + num_str[-18:]
-    if decimals < 18:
-      num_str = num_str[:-18+decimals]
-  if num_str[-1] == '.': num_str = num_str[:-1] ## remove trailing dot
-  return num_str
-
 def get_event_str(event, event_type, inscription_id):
   global ticks
   if event_type == "mint-inscribe":
@@ -215,9 +174,6 @@ def get_event_str(event, event_type, inscription_id):
     print("EVENT TYPE ERROR!!")
     exit(1)
 
-def get_sha256_hash(s):
-  return hashlib.sha256(s.encode('utf-8')).hexdigest()
-
 
 def reset_caches():
   global  ticks
@@ -231,20 +187,9 @@ def reset_caches():
     ticks[t[0]][t[1]] = [t[2], t[3], t[4], t[5], t[6]]
   print("Ticks refreshed in " + str(time.time() - sttm) + " seconds")
 
-block_start_max_event_id = None
-grc20_events_insert_sql = '''insert into grc20_events (id, tick, event_type, block_height, inscription_id, event) values '''
-grc20_events_insert_cache = []
-grc20_tickers_insert_sql = '''insert into grc20_tickers (tick, original_tick, max_supply, decimals, limit_per_mint, remaining_supply, block_height, is_self_mint, deploy_inscription_id) values '''
-grc20_tickers_remaining_supply_update_sql = '''update grc20_tickers set tick_remaining_supply = tick_remaining_supply - %s  where tick = %s;'''
-grc20_tickers_remaining_supply_update_cache = {}
-grc20_tickers_code_remaining_supply_update_sql = '''update grc20_tickers set code_remaining_supply = code_remaining_supply - %s where tick = %s and code = %s;'''
-grc20_tickers_code_remaining_supply_update_cache = {}
-grc20_code_remaining_supply_update_cache = {}
-grc20_collection_insert_sql = '''insert into grc20_collections (tick, code, inscription_id, block_height) values '''
-grc20_collection_insert_cache = []
-
+## rows are buffered in engine.writes and written in a single transaction at the end of the block (tables are registered below)
 def mint_inscribe(block_height, inscription_id, minted_pkScript, minted_wallet, tick, code, amount, parent_id):
-  global ticks, in_commit, block_events_str, event_types
+  global ticks, block_events_hasher, event_types
 
   event = {
     "minted_pkScript": minted_pkScript,
@@ -254,43 +199,27 @@ def mint_inscribe(block_height, inscription_id, minted_pkScript, minted_wallet,
     "amount": str(amount),
     "parent_id": parent_id
   }
-  block_events_str += get_event_str(event, "mint-inscribe", inscription_id) + EVENT_SEPARATOR
-  event_id = block_start_max_event_id + len(grc20_events_insert_cache) + 1
-  grc20_events_insert_cache.append((event_id, tick, event_types["mint-inscribe"], block_height, inscription_id, json.dumps(event)))
-  grc20_tickers_remaining_supply_update_cache[tick] = grc20_tickers_remaining_supply_update_cache.get(tick,0) + amount
-  if tick not in grc20_code_remaining_supply_update_cache:
-    grc20_code_remaining_supply_update_cache[tick] = {}
-  if code not in grc20_code_remaining_supply_update_cache[tick]:
-    grc20_code_remaining_supply_update_cache[tick][code] = 0
-  grc20_code_remaining_supply_update_cache[tick][code] = grc20_code_remaining_supply_update_cache.get(tick, {}).get(code,0) + amount
-
-  grc20_collection_insert_cache.append((tick, code, inscription_id, block_height))
+  block_events_hasher.add(get_event_str(event, "mint-inscribe", inscription_id))
+  engine.writes.insert('grc20_events', (tick, event_types["mint-inscribe"], block_height, inscription_id, json.dumps(event)))
+  engine.writes.update('grc20_tickers_tick_remaining_supply', (tick,), amount)
+  engine.writes.update('grc20_tickers_code_remaining_supply', (tick, code), amount)
+
+  engine.writes.insert('grc20_collections', (tick, code, inscription_id, block_height))
   ticks[tick][code][2] -= amount
   ticks[tick][code][3] -= amount
 
-def update_event_hashes(block_height):
-  global block_events_str
-  if len(block_events_str) > 0 and block_events_str[-1] == EVENT_SEPARATOR: block_events_str = block_events_str[:-1] ## remove last separator
-  block_event_hash = get_sha256_hash(block_events_str)
-  cumulative_event_hash = None
-  cur.execute('''select cumulative_event_hash from grc20_cumulative_event_hashes where block_height = %s;''', (block_height - 1,))
-  if cur.rowcount == 0:
-    cumulative_event_hash = block_event_hash
-  else:
-    cumulative_event_hash = get_sha256_hash(cur.fetchone()[0] + block_event_hash)
-  cur.execute('''INSERT INTO grc20_cumulative_event_hashes (block_height, block_event_hash, cumulative_event_hash) VALUES (%s, %s, %s);''', (block_height, block_event_hash, cumulative_event_hash))
 
 def index_block(block_height, current_block_hash):
-  global ticks, block_events_str, block_start_max_event_id, grc20_events_insert_cache, grc20_collection_insert_cache, grc20_tickers_remaining_supply_update_cache, grc20_code_remaining_supply_update_cache, in_commit
+  global ticks, block_events_hasher
   print("Indexing block " + str(block_height))
-  block_events_str = ""
+  block_events_hasher = engine.start_block(block_height)
 
   if block_height < first_grc20_height:
     print("Block height is before first grc20 height, skipping")
-    update_event_hashes(block_height)
-    cur.execute('''INSERT INTO grc20_block_hashes (block_height, block_hash) VALUES (%s, %s);''', (block_height, current_block_hash))
+    engine.commit_block(block_height, current_block_hash)
     return
   
+  st_tm = time.time()
   cur_metaprotocol.execute('''SELECT ot.inscription_id, ot.old_satpoint, ot.new_pkscript, ot.new_wallet, ot.sent_as_fee, oc."content", oc.content_type, onti.parent_id
                               FROM ord_transfers ot
                               LEFT JOIN ord_content oc ON ot.inscription_id = oc.inscription_id
@@ -299,21 +228,15 @@ def index_block(block_height, current_block_hash):
                                  AND oc."content" is not null AND oc."content"->>'p'='grc-20'
                               ORDER BY ot.id asc;''', (block_height,))
   transfers = cur_metaprotocol.fetchall()
+  work_stats.add_time("fetch_tm", st_tm)
+  work_stats.add_count("transfer_count", len(transfers))
   if len(transfers) == 0:
     print("No transfers found for block " + str(block_height))
-    update_event_hashes(block_height)
-    cur.execute('''INSERT INTO grc20_block_hashes (block_height, block_hash) VALUES (%s, %s);''', (block_height, current_block_hash))
+    engine.commit_block(block_height, current_block_hash)
     return
   print("Transfer count: ", len(transfers))
 
-
-  cur.execute('''select COALESCE(max(id), -1) from grc20_events;''')
-  block_start_max_event_id = cur.fetchone()[0]
-  grc20_events_insert_cache = []
-  grc20_collection_insert_cache = []
-  grc20_tickers_remaining_supply_update_cache = {}
-  grc20_code_remaining_supply_update_cache = {}
-  
+  st_tm = time.time()
   idx = 0
   for transfer in transfers:
     idx += 1
@@ -362,65 +285,31 @@ def index_block(block_height, current_block_hash):
     if ticks[tick][code][2] <= 0: continue ## tick ended
     if ticks[tick][code][3] <= 0: continue ## code ended
     mint_inscribe(block_height, inscr_id, new_pkScript, new_addr, tick, code, amount, parent_id)
-    
+  work_stats.add_time("index_tm", st_tm)
   
-  cur.execute("BEGIN;")
-  in_commit = True
-  execute_batch_insert(grc20_events_insert_sql, grc20_events_insert_cache, 1000)
-  for tick in grc20_tickers_remaining_supply_update_cache:
-    cur.execute(grc20_tickers_remaining_supply_update_sql, (grc20_tickers_remaining_supply_update_cache[tick], tick))
-
-  for tick in grc20_code_remaining_supply_update_cache:
-    for code in grc20_code_remaining_supply_update_cache[tick]:
-      cur.execute(grc20_tickers_code_remaining_supply_update_sql, (grc20_code_remaining_supply_update_cache[tick][code], tick, code))
-
-  execute_batch_insert(grc20_collection_insert_sql, grc20_collection_insert_cache, 1000)
-  update_event_hashes(block_height)
-  # end of block
-  cur.execute('''INSERT INTO grc20_block_hashes (block_height, block_hash) VALUES (%s, %s);''', (block_height, current_block_hash))
-  print("committing...")
-  cur.execute("COMMIT;")
-  in_commit = False
-  conn.commit()
+  engine.commit_block(block_height, current_block_hash)
   print("ALL DONE")
 
-def execute_batch_insert(sql_start, cache, batch_size):
-  if len(cache) > 0:
-    single_elem_cnt = len(cache[0])
-    single_insert_sql_part = '(' + ','.join(['%s' for _ in range(single_elem_cnt)]) + ')'
-    for i in range(0, len(cache), batch_size):
-      elem_cnt = min(batch_size, len(cache) - i)
-      sql = sql_start + ','.join([single_insert_sql_part for _ in range(elem_cnt)]) + ';'
-      cur.execute(sql, [elem for sublist in cache[i:i+batch_size] for elem in sublist])
-
-
-def check_for_reorg():
-  cur.execute('select block_height, block_hash from grc20_block_hashes order by block_height desc limit 1;')
-  if cur.rowcount == 0: return None ## nothing indexed yet
-  last_block = cur.fetchone()
-
-  cur_metaprotocol.execute('select block_height, block_hash from block_hashes where block_height = %s;', (last_block[0],))
-  last_block_ord = cur_metaprotocol.fetchone()
-  if last_block_ord[1] == last_block[1]: return None ## last block hashes are the same, no reorg
-
-  print("REORG DETECTED!!")
-  cur.execute('select block_height, block_hash from grc20_block_hashes order by block_height desc limit 10;')
-  hashes = cur.fetchall() ## get last 10 hashes
-  for h in hashes:
-    cur_metaprotocol.execute('select block_height, block_hash from block_hashes where block_height = %s;', (h[0],))
-    block = cur_metaprotocol.fetchone()
-    if block[1] == h[1]: ## found reorg height by a matching hash
-      print("REORG HEIGHT FOUND: " + str(h[0]))
-      return h[0]
-  
-  ## bigger than 10 block reorg is not supported by ord
-  print("CRITICAL ERROR!!")
-  sys.exit(1)
 
-def reorg_fix(reorg_height):
+## per-block work stats, stage timings are in ms, saved to grc20_indexer_work_stats after each block
+work_stats_columns = ["transfer_count", "event_count", "fetch_tm", "index_tm", "write_tm", "hash_tm", "commit_tm", "extra_tables_tm", "report_tm", "all_tm"]
+work_stats = WorkStats(cur, 'grc20_indexer_work_stats', work_stats_columns)
+
+## opt-in profiling of blocks PROFILE_START_HEIGHT - PROFILE_END_HEIGHT
+block_profiler = BlockRangeProfiler(profile_mode, profile_start_height, profile_end_height, profile_sample_interval_ms, profile_output_file)
+
+## block loop, block-buffered writes (COPY or multi-row INSERT), commits and reorgs
+engine = ProtocolEngine('grc20', conn, cur, conn_metaprotocol, cur_metaprotocol, bulk_writer, work_stats, block_profiler)
+engine.writes.add_table('grc20_events', ['tick', 'event_type', 'block_height', 'inscription_id', 'event'], client_ids=True)
+engine.writes.add_table('grc20_collections', ['tick', 'code', 'inscription_id', 'block_height'])
+engine.writes.add_update('grc20_tickers_tick_remaining_supply', '''update grc20_tickers set tick_remaining_supply = tick_remaining_supply - %s where tick = %s;''')
+engine.writes.add_update('grc20_tickers_code_remaining_supply', '''update grc20_tickers set code_remaining_supply = code_remaining_supply - %s where tick = %s and code = %s;''')
+engine.reorg_tables = ['grc20_events', 'grc20_collections'] ## tickers are not created by the indexer, only their remaining supplies are reverted
+
+
+## remaining supplies of tickers, rows above the reorg height are deleted by the engine
+def revert_remaining_supply(reorg_height):
   global event_types
-  cur.execute('begin;')
-  # cur.execute('delete from grc20_tickers where block_height > %s;', (reorg_height,)) ## delete new tickers
   ## fetch mint events for reverting remaining_supply in other tickers
   cur.execute('''select event from grc20_events where event_type = %s and block_height > %s;''', (event_types["mint-inscribe"], reorg_height,))
   rows = cur.fetchall()
@@ -444,41 +333,11 @@ def reorg_fix(reorg_height):
     cur.execute('''update grc20_tickers set tick_remaining_supply = tick_remaining_supply + %s where tick = %s;''', (tick_changes[tick], tick))
   for tick in tick_changes:
     for code in code_changes[tick]:
-      cur.execute('''update grc20_tickers set code_remaining_supply = code_remaining_supply + %s where tick = %s and code = %s;''', (amount, tick,code))
-  cur.execute('delete from grc20_events where block_height > %s;', (reorg_height,)) ## delete new events
-  cur.execute('delete from grc20_cumulative_event_hashes where block_height > %s;', (reorg_height,)) ## delete new bitmaps
-  cur.execute("SELECT setval('grc20_cumulative_event_hashes_id_seq', max(id)) from grc20_cumulative_event_hashes;") ## reset id sequence
-  cur.execute("SELECT setval('grc20_tickers_id_seq', max(id)) from grc20_tickers;") ## reset id sequence
-  cur.execute("SELECT setval('grc20_events_id_seq', max(id)) from grc20_events;") ## reset id sequence
-  cur.execute('delete from grc20_block_hashes where block_height > %s;', (reorg_height,)) ## delete new block hashes
-  cur.execute("SELECT setval('grc20_block_hashes_id_seq', max(id)) from grc20_block_hashes;") ## reset id sequence
-  cur.execute('commit;')
-  reset_caches()
+      cur.execute('''update grc20_tickers set code_remaining_supply = code_remaining_supply + %s where tick = %s and code = %s;''', (code_changes[tick][code], tick, code))
 
-def check_if_there_is_residue_from_last_run():
-  cur.execute('''select max(block_height) from grc20_block_hashes;''')
-  row = cur.fetchone()
-  current_block = None
-  if row[0] is None: current_block = first_inscription_height
-  else: current_block = row[0] + 1
-  residue_found = False
-  cur.execute('''select coalesce(max(block_height), -1) from grc20_events;''')
-  if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
-    residue_found = True
-    print("residue on grc20_events")
-  cur.execute('''select coalesce(max(block_height), -1) from grc20_tickers;''')
-  if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
-    residue_found = True
-    print("residue on tickers")
-  cur.execute('''select coalesce(max(block_height), -1) from grc20_cumulative_event_hashes;''')
-  if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
-    residue_found = True
-    print("residue on cumulative hashes")
-  if residue_found:
-    print("There is residue from last run, rolling back to " + str(current_block - 1))
-    reorg_fix(current_block - 1)
-    print("Rolled back to " + str(current_block - 1))
-    return
+def reorg_fix(reorg_height):
+  engine.reorg_fix(reorg_height, revert_remaining_supply)
+  reset_caches()
 
 def check_if_there_is_residue_on_extra_tables_from_last_run():
   pass
@@ -503,13 +362,39 @@ for t in ticks_:
   ticks[t[0]][t[1]] = [t[2], t[3], t[4], t[5], t[6]]
 print("Ticks refreshed in " + str(time.time() - sttm) + " seconds")
 
+## block event hashes of a range of blocks, runs in a worker process of reindex_cumulative_hashes with its own connection
+## events are streamed with a server-side cursor, ticks and event_types_rev are inherited from the parent process
+def get_block_event_hashes_of_range(block_range):
+  start_height, end_height = block_range
+  conn_worker = psycopg2.connect(
+    host=db_host,
+    port=db_port,
+    database=db_database,
+    user=db_user,
+    password=db_password)
+  cur_worker = conn_worker.cursor(name='reindex_events')
+  cur_worker.itersize = 10000
+  cur_worker.execute('''select block_height, event, event_type, inscription_id from grc20_events
+                        where block_height >= %s and block_height <= %s
+                        order by block_height asc, id asc;''', (start_height, end_height))
+  hashers = {}
+  for row in cur_worker:
+    if row[0] not in hashers: hashers[row[0]] = BlockEventHasher()
+    hashers[row[0]].add(get_event_str(row[1], event_types_rev[row[2]], row[3]))
+  cur_worker.close()
+  conn_worker.close()
+  return [(block_height, (hashers.get(block_height) or BlockEventHasher()).hexdigest()) for block_height in range(start_height, end_height + 1)]
+
+## block event hashes are computed in parallel over block ranges, only the cumulative hash chain is sequential
 def reindex_cumulative_hashes():
   global event_types_rev, ticks
-  cur.execute('''delete from grc20_cumulative_event_hashes;''')
   cur.execute('''select min(block_height), max(block_height) from grc20_block_hashes;''')
   row = cur.fetchone()
   min_block = row[0]
   max_block = row[1]
+  if min_block is None:
+    cur.execute('''delete from grc20_cumulative_event_hashes;''')
+    return
 
 
   sttm = time.time()
@@ -522,18 +407,25 @@ def reindex_cumulative_hashes():
     ticks[t[0]][t[1]] = [t[2], t[3], t[4], t[5], t[6]]
   print("Ticks refreshed in " + str(time.time() - sttm) + " seconds")
 
-  print("Reindexing cumulative hashes from " + str(min_block) + " to " + str(max_block))
-  for block_height in range(min_block, max_block + 1):
-    print("Reindexing block " + str(block_height))
-    block_events_str = ""
-    cur.execute('''select event, event_type, inscription_id from grc20_events where block_height = %s order by id asc;''', (block_height,))
-    rows = cur.fetchall()
-    for row in rows:
-      event = row[0]
-      event_type = event_types_rev[row[1]]
-      inscription_id = row[2]
-      block_events_str += get_event_str(event, event_type, inscription_id) + EVENT_SEPARATOR
-    update_event_hashes(block_height)
+  print("Reindexing cumulative hashes from " + str(min_block) + " to " + str(max_block) + " with " + str(reindex_workers) + " workers")
+  block_ranges = [(start_height, min(start_height + 999, max_block)) for start_height in range(min_block, max_block + 1, 1000)]
+  hash_rows = []
+  last_cumulative_event_hash = None
+  with multiprocessing.get_context('fork').Pool(reindex_workers) as pool: ## fork, workers need the module state and must not re-run the module
+    for block_hashes in pool.imap(get_block_event_hashes_of_range, block_ranges): ## in order of block ranges
+      for block_height, block_event_hash in block_hashes:
+        last_cumulative_event_hash = get_cumulative_event_hash(last_cumulative_event_hash, block_event_hash)
+        hash_rows.append((block_height, block_event_hash, last_cumulative_event_hash))
+      print("Reindexed up to block " + str(hash_rows[-1][0]))
+
+  copy_buf = io.StringIO()
+  for hash_row in hash_rows:
+    copy_buf.write('%d\t%s\t%s\n' % hash_row)
+  copy_buf.seek(0)
+  cur.execute('BEGIN;')
+  cur.execute('''delete from grc20_cumulative_event_hashes;''')
+  cur.copy_expert('''COPY grc20_cumulative_event_hashes (block_height, block_event_hash, cumulative_event_hash) FROM STDIN''', copy_buf)
+  cur.execute('COMMIT;')
 
 cur.execute('select db_version from grc20_indexer_version;')
 if cur.rowcount == 0:
@@ -554,49 +446,16 @@ else:
       cur.execute('update grc20_indexer_version set indexer_version = %s, db_version = %s;', (INDEXER_VERSION, DB_VERSION,))
       print("Fixed.")
 
-def try_to_report_with_retries(to_send):
-  global report_url, report_retries
-  for _ in range(0, report_retries):
-    try:
-      r = requests.post(report_url, json=to_send)
-      if r.status_code == 200:
-        print("Reported hashes to metaprotocol indexer indexer.")
-        return
-      else:
-        print("Error while reporting hashes to metaprotocol indexer indexer, status code: " + str(r.status_code))
-    except KeyboardInterrupt:
-      raise KeyboardInterrupt
-    except:
-      print("Error while reporting hashes to metaprotocol indexer indexer, retrying...")
-    time.sleep(1)
-  print("Error while reporting hashes to metaprotocol indexer indexer, giving up.")
-
-def report_hashes(block_height):
-  global report_to_indexer
-  if not report_to_indexer:
-    print("Reporting to metaprotocol indexer is disabled.")
-    return
-  cur.execute('''select block_event_hash, cumulative_event_hash from grc20_cumulative_event_hashes where block_height = %s;''', (block_height,))
-  row = cur.fetchone()
-  block_event_hash = row[0]
-  cumulative_event_hash = row[1]
-  cur.execute('''select block_hash from grc20_block_hashes where block_height = %s;''', (block_height,))
-  block_hash = cur.fetchone()[0]
-  to_send = {
-    "name": report_name,
-    "type": "grc20",
-    "node_type": "full_node",
-    "network_type": network_type,
-    "version": INDEXER_VERSION,
-    "db_version": DB_VERSION,
-    "event_hash_version": EVENT_HASH_VERSION,
-    "block_height": block_height,
-    "block_hash": block_hash,
-    "block_event_hash": block_event_hash,
-    "cumulative_event_hash": cumulative_event_hash
-  }
-  print("Sending hashes to metaprotocol indexer indexer...")
-  try_to_report_with_retries(to_send)
+
+engine.configure_reporting(report_to_indexer, report_url, report_retries, {
+  "name": report_name,
+  "type": "grc20",
+  "node_type": "full_node",
+  "network_type": network_type,
+  "version": INDEXER_VERSION,
+  "db_version": DB_VERSION,
+  "event_hash_version": EVENT_HASH_VERSION
+})
 
 def reorg_on_extra_tables(reorg_height):
   pass
@@ -613,59 +472,21 @@ def check_extra_tables():
   pass
 
 
-check_if_there_is_residue_from_last_run()
+engine.check_residue(first_inscription_height, reorg_fix)
 if create_extra_tables:
   check_if_there_is_residue_on_extra_tables_from_last_run()
   print("checking extra tables")
   check_extra_tables()
 
-last_report_height = 0
-while True:
-  check_if_there_is_residue_from_last_run()
+def before_block():
   if create_extra_tables:
     check_if_there_is_residue_on_extra_tables_from_last_run()
-  ## check if a new block is indexed
-  cur_metaprotocol.execute('''SELECT coalesce(max(block_height), -1) as max_height from block_hashes;''')
-  max_block_of_metaprotocol_db = cur_metaprotocol.fetchone()[0]
-  cur.execute('''select max(block_height) from grc20_block_hashes;''')
-  row = cur.fetchone()
-  current_block = None
-  if row[0] is None: current_block = first_inscription_height
-  else: current_block = row[0] + 1
-  if current_block > max_block_of_metaprotocol_db:
-    print("Waiting for new blocks...")
-    time.sleep(5)
-    continue
-  
-  print("Processing block %s" % current_block)
-  cur_metaprotocol.execute('select block_hash from block_hashes where block_height = %s;', (current_block,))
-  current_block_hash = cur_metaprotocol.fetchone()[0]
-  reorg_height = check_for_reorg()
-  if reorg_height is not None:
-    print("Rolling back to ", reorg_height)
-    reorg_fix(reorg_height)
-    print("Rolled back to " + str(reorg_height))
-    continue
-  try:
-    index_block(current_block, current_block_hash)
-    if create_extra_tables and max_block_of_metaprotocol_db - current_block < 10: ## only update extra tables at the end of sync
-      print("checking extra tables")
-      check_extra_tables()
-    if max_block_of_metaprotocol_db - current_block < 10 or current_block - last_report_height > 100: ## do not report if there are more than 10 blocks to index
-      report_hashes(current_block)
-      last_report_height = current_block
-  except KeyboardInterrupt:
-    traceback.print_exc()
-    if in_commit: ## rollback commit if any
-      print("rolling back")
-      cur.execute('''ROLLBACK;''')
-      in_commit = False
-    print("Exiting...")
-    sys.exit(1)
-  except:
-    traceback.print_exc()
-    if in_commit: ## rollback commit if any
-      print("rolling back")
-      cur.execute('''ROLLBACK;''')
-      in_commit = False
-    time.sleep(10)
+
+def after_block(block_height, max_block_of_metaprotocol_db):
+  if create_extra_tables and max_block_of_metaprotocol_db - block_height < 10: ## only update extra tables at the end of sync
+    print("checking extra tables")
+    st_tm = time.time()
+    check_extra_tables()
+    work_stats.add_time("extra_tables_tm", st_tm)
+
+engine.run(first_inscription_height, index_block, reorg_fix, reset_caches, listen_new_blocks, new_block_wait_timeout, before_block, after_block)
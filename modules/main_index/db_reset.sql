@@ -2,6 +2,7 @@ drop table if exists ord_transfers;
 drop table if exists ord_number_to_id;
 drop table if exists ord_content;
 drop table if exists block_hashes;
+drop function if exists notify_new_block_hash;
 drop table if exists ord_indexer_reorg_stats;
 drop table if exists ord_indexer_work_stats;
 drop table if exists ord_indexer_version;
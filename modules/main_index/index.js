@@ -618,6 +618,19 @@ async function check_db() {
     process.exit(1)
   }
 
+  // python indexers LISTEN on opi_new_block, notify them as soon as a new block_hashes row is committed
+  await db_pool.query(`CREATE OR REPLACE FUNCTION notify_new_block_hash() RETURNS trigger AS $$
+    BEGIN
+      PERFORM pg_notify('opi_new_block', NEW.block_height::text);
+      RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;`)
+  let notify_trigger_q = await db_pool.query(`SELECT 1 from pg_trigger where tgname = 'block_hashes_notify_trigger';`)
+  if (notify_trigger_q.rows.length == 0) {
+    console.log("creating block_hashes notify trigger")
+    await db_pool.query(`CREATE TRIGGER block_hashes_notify_trigger AFTER INSERT ON block_hashes FOR EACH ROW EXECUTE FUNCTION notify_new_block_hash();`)
+  }
+
   let current_height_q = await db_pool.query(`SELECT coalesce(max(block_height), -1) as max_height from block_hashes;`)
   let current_height = current_height_q.rows[0].max_height
   console.log("current_height: " + current_height)
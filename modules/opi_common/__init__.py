@@ -0,0 +1,2 @@
+## code shared by the token indexers (brc20, brc6699, grc20, pow20)
+## indexers run from their own directories and add the modules directory to sys.path to import this package
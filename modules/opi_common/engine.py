@@ -0,0 +1,568 @@
+## protocol independent parts of the indexers (brc20, brc6699, grc20, pow20, bitmap, sns)
+## hashing, caches, bulk writes, work stats, profiling, new block notifications, reorg detection and reporting
+## ProtocolEngine runs the block loop, block-buffered writes, commits and reorgs of brc6699, grc20 and pow20,
+## which only supply their validation rules, event encoding and tables
+## brc20 runs the same loop with its own hooks (catch-up ranges, undo record reorgs, insert caches and partitions)
+## bitmap and sns keep their own loops and use the parts they need
+
+import os, sys, time, io, re, select, threading, hashlib, cProfile, traceback
+import requests
+from collections import OrderedDict
+
+EVENT_SEPARATOR = "|"
+
+def get_sha256_hash(s):
+  return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+def utf8len(s):
+  return len(s.encode('utf-8'))
+
+## streams event strings of a block into sha256, gives the same hash as sha256 of the events joined with EVENT_SEPARATOR
+class BlockEventHasher:
+  def __init__(self):
+    self.hasher = hashlib.sha256()
+    self.event_cnt = 0
+
+  def add(self, event_str):
+    if self.event_cnt > 0: self.hasher.update(EVENT_SEPARATOR.encode('utf-8'))
+    self.hasher.update(event_str.encode('utf-8'))
+    self.event_cnt += 1
+
+  def hexdigest(self):
+    return self.hasher.hexdigest()
+
+## tip of the cumulative event hash chain as (block_height, cumulative_event_hash)
+## resynced from db only when the requested block does not follow the tip (startup, reorg, failed block)
+class CumulativeHashChain:
+  def __init__(self, cur, table_name):
+    self.cur = cur
+    self.table_name = table_name
+    self.tip = (None, None)
+
+  def get_last(self, block_height):
+    if self.tip[0] != block_height - 1:
+      self.cur.execute('select cumulative_event_hash from ' + self.table_name + ' where block_height = %s;', (block_height - 1,))
+      if self.cur.rowcount == 0: self.tip = (block_height - 1, None)
+      else: self.tip = (block_height - 1, self.cur.fetchone()[0])
+    return self.tip[1]
+
+  def set_tip(self, block_height, cumulative_event_hash):
+    self.tip = (block_height, cumulative_event_hash)
+
+  def reset(self):
+    self.tip = (None, None)
+
+def get_cumulative_event_hash(last_cumulative_event_hash, block_event_hash):
+  if last_cumulative_event_hash is None: return block_event_hash
+  return get_sha256_hash(last_cumulative_event_hash + block_event_hash)
+
+
+## caches
+class Balance:
+  __slots__ = ("overall_balance", "available_balance")
+  def __init__(self, overall_balance, available_balance):
+    self.overall_balance = overall_balance
+    self.available_balance = available_balance
+
+def get_entry_size(obj):
+  if isinstance(obj, tuple):
+    return sys.getsizeof(obj) + sum(sys.getsizeof(x) for x in obj)
+  if isinstance(obj, Balance):
+    return sys.getsizeof(obj) + sys.getsizeof(obj.overall_balance) + sys.getsizeof(obj.available_balance)
+  return sys.getsizeof(obj)
+
+## bounded LRU cache with a memory budget, entry sizes are estimated with sys.getsizeof
+## entries are only evicted in trim(), which is called after the block is committed,
+## so entries modified by an uncommitted block are never dropped
+class LRUCache:
+  def __init__(self, name, max_bytes):
+    self.name = name
+    self.max_bytes = max_bytes
+    self.entries = OrderedDict()
+    self.entry_sizes = {}
+    self.total_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  ## membership test, does not count as a hit or miss and does not change the eviction order
+  def __contains__(self, key):
+    return key in self.entries
+
+  def get(self, key):
+    value = self.entries.get(key)
+    if value is None:
+      self.misses += 1
+      return None
+    self.entries.move_to_end(key)
+    self.hits += 1
+    return value
+
+  def set(self, key, value):
+    if key in self.entries:
+      self.total_bytes -= self.entry_sizes[key]
+    size = get_entry_size(key) + get_entry_size(value) + 100 ## approx. per entry overhead of the dicts
+    self.entries[key] = value
+    self.entries.move_to_end(key)
+    self.entry_sizes[key] = size
+    self.total_bytes += size
+
+  def pop(self, key):
+    value = self.entries.pop(key, None)
+    if value is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self.total_bytes -= self.entry_sizes.pop(key)
+    return value
+
+  ## drops a stale entry (reorg), does not count as a hit or miss
+  def discard(self, key):
+    if self.entries.pop(key, None) is not None:
+      self.total_bytes -= self.entry_sizes.pop(key)
+
+  def trim(self):
+    while self.total_bytes > self.max_bytes and len(self.entries) > 0:
+      key, _ = self.entries.popitem(last=False)
+      self.total_bytes -= self.entry_sizes.pop(key)
+      self.evictions += 1
+
+  def clear(self):
+    self.entries = OrderedDict()
+    self.entry_sizes = {}
+    self.total_bytes = 0
+
+  def stats_str(self):
+    return "%s: %d entries, %.1f/%.1f MB, hits: %d, misses: %d, evictions: %d" % (self.name, len(self.entries), self.total_bytes / 1024 / 1024, self.max_bytes / 1024 / 1024, self.hits, self.misses, self.evictions)
+
+
+## bulk writes of the per-block insert caches, "copy" (COPY FROM STDIN) or "insert" (multi-row INSERT)
+insert_sql_pattern = re.compile(r'^\s*insert into (\w+) \(([^)]*)\) values\s*$', re.IGNORECASE)
+
+def get_copy_csv_value(v):
+  if v is None: return '' ## unquoted empty value is NULL in csv format
+  if isinstance(v, bool): return 't' if v else 'f'
+  if isinstance(v, str): return '"' + v.replace('"', '""') + '"'
+  return str(v)
+
+class BulkWriter:
+  def __init__(self, cur, mode):
+    self.cur = cur
+    self.mode = mode
+
+  def insert(self, sql_start, cache, batch_size):
+    if self.mode == "copy":
+      self.copy_insert(sql_start, cache)
+    else:
+      self.multi_row_insert(sql_start, cache, batch_size)
+
+  def multi_row_insert(self, sql_start, cache, batch_size):
+    if len(cache) > 0:
+      single_elem_cnt = len(cache[0])
+      single_insert_sql_part = '(' + ','.join(['%s' for _ in range(single_elem_cnt)]) + ')'
+      for i in range(0, len(cache), batch_size):
+        elem_cnt = min(batch_size, len(cache) - i)
+        sql = sql_start + ','.join([single_insert_sql_part for _ in range(elem_cnt)]) + ';'
+        self.cur.execute(sql, [elem for sublist in cache[i:i+batch_size] for elem in sublist])
+
+  def copy_insert(self, sql_start, cache):
+    if len(cache) == 0: return
+    m = insert_sql_pattern.match(sql_start)
+    if m is None:
+      raise Exception("cannot parse insert sql for COPY: " + sql_start)
+    buf = io.StringIO()
+    for row in cache:
+      buf.write(','.join([get_copy_csv_value(v) for v in row]))
+      buf.write('\n')
+    buf.seek(0)
+    self.cur.copy_expert('COPY ' + m.group(1) + ' (' + m.group(2) + ') FROM STDIN WITH (FORMAT csv)', buf)
+
+## per-block write buffer, rows are kept in memory while a block is validated and written
+## with one bulk insert per table when the block is committed, additive updates are summed per key
+## ids of tables with client_ids are allocated here from max(id), so other rows can reference them before anything is written
+class BlockWriteBuffer:
+  def __init__(self, cur, writer, batch_size=1000):
+    self.cur = cur
+    self.writer = writer
+    self.batch_size = batch_size
+    self.tables = [] ## (table_name, insert_sql, client_ids), written in this order
+    self.updates = [] ## (name, sql)
+    self.rows = {}
+    self.next_ids = {}
+    self.update_amounts = {}
+
+  def add_table(self, table_name, columns, client_ids=False):
+    if client_ids: columns = ['id'] + columns
+    self.tables.append((table_name, 'insert into ' + table_name + ' (' + ', '.join(columns) + ') values ', client_ids))
+    self.rows[table_name] = []
+
+  ## sql gets the summed amount of a key first, then the values of the key
+  def add_update(self, name, sql):
+    self.updates.append((name, sql))
+    self.update_amounts[name] = {}
+
+  def reset(self):
+    for table_name in self.rows: self.rows[table_name] = []
+    for name in self.update_amounts: self.update_amounts[name] = {}
+    self.next_ids = {} ## loaded on the first insert of the block, blocks without rows need no query
+
+  ## returns the id of the row for tables with client_ids
+  def insert(self, table_name, row):
+    if table_name not in self.next_ids and self.is_client_id_table(table_name):
+      self.cur.execute('select coalesce(max(id), 0) from ' + table_name + ';')
+      self.next_ids[table_name] = self.cur.fetchone()[0] + 1
+    if table_name in self.next_ids:
+      row_id = self.next_ids[table_name]
+      self.next_ids[table_name] += 1
+      self.rows[table_name].append((row_id,) + row)
+      return row_id
+    self.rows[table_name].append(row)
+    return None
+
+  def is_client_id_table(self, table_name):
+    for t in self.tables:
+      if t[0] == table_name: return t[2]
+    raise Exception("unknown table: " + table_name)
+
+  def update(self, name, key, amount):
+    amounts = self.update_amounts[name]
+    amounts[key] = amounts.get(key, 0) + amount
+
+  ## only call inside the block transaction
+  def flush(self):
+    for table_name, insert_sql, client_ids in self.tables:
+      rows = self.rows[table_name]
+      if len(rows) == 0: continue
+      print("inserting " + str(len(rows)) + " rows into " + table_name + "...")
+      self.writer.insert(insert_sql, rows, self.batch_size)
+      if client_ids: ## keep the id sequence in step with the allocated ids
+        self.cur.execute("SELECT setval('" + table_name + "_id_seq', %s);", (self.next_ids[table_name] - 1,))
+    for name, sql in self.updates:
+      amounts = self.update_amounts[name]
+      for key in amounts:
+        self.cur.execute(sql, (amounts[key],) + key)
+
+
+## per-block work stats, stage timings are in ms, saved to <protocol>_indexer_work_stats after each block or catch-up batch
+class WorkStats:
+  def __init__(self, cur, table_name, columns):
+    self.cur = cur
+    self.table_name = table_name
+    self.columns = columns
+    self.stats = {}
+    self.st_tm = time.time()
+    self.caches = [] ## (name, LRUCache, hits at reset, misses at reset)
+
+  ## hits and misses of the cache since reset are saved as <name>_hits and <name>_misses
+  def track_cache(self, name, cache):
+    self.caches.append((name, cache, cache.hits, cache.misses))
+
+  def reset(self):
+    self.stats = {}
+    self.st_tm = time.time()
+    self.caches = [(name, cache, cache.hits, cache.misses) for name, cache, _, _ in self.caches]
+
+  def add_time(self, name, st_tm):
+    self.stats[name] = self.stats.get(name, 0) + (time.time() - st_tm) * 1000
+
+  def add_count(self, name, cnt):
+    self.stats[name] = self.stats.get(name, 0) + cnt
+
+  def set(self, name, value):
+    self.stats[name] = value
+
+  def save(self, min_block_height, max_block_height):
+    self.add_time("all_tm", self.st_tm)
+    for name, cache, hits, misses in self.caches:
+      self.stats[name + "_hits"] = cache.hits - hits
+      self.stats[name + "_misses"] = cache.misses - misses
+    self.cur.execute('''INSERT INTO ''' + self.table_name + ''' (min_block_height, max_block_height, ''' + ', '.join(self.columns) + ''')
+                        VALUES (%s, %s''' + ', %s' * len(self.columns) + ''');''', [min_block_height, max_block_height] + [int(self.stats.get(c, 0)) for c in self.columns])
+
+
+## opt-in profiling of blocks PROFILE_START_HEIGHT - PROFILE_END_HEIGHT
+## cprofile writes a pstats dump (<PROFILE_OUTPUT_FILE>.prof), sampling writes collapsed stacks
+## (<PROFILE_OUTPUT_FILE>.folded, one "frame;frame;frame count" line per stack) which flamegraph tools read directly
+class SamplingProfiler(threading.Thread):
+  def __init__(self, interval_ms):
+    super().__init__(daemon=True)
+    self.interval = interval_ms / 1000.0
+    self.target_thread_id = threading.get_ident()
+    self.stacks = {}
+    self.stop_event = threading.Event()
+
+  def run(self):
+    while not self.stop_event.wait(self.interval):
+      frame = sys._current_frames().get(self.target_thread_id)
+      frames = []
+      while frame is not None:
+        frames.append(frame.f_code.co_name + " (" + os.path.basename(frame.f_code.co_filename) + ":" + str(frame.f_code.co_firstlineno) + ")")
+        frame = frame.f_back
+      if len(frames) == 0: continue
+      stack = ';'.join(reversed(frames))
+      self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+  def stop(self, path):
+    self.stop_event.set()
+    self.join()
+    with open(path, 'w') as f:
+      for stack in self.stacks:
+        f.write(stack + " " + str(self.stacks[stack]) + "\n")
+
+class BlockRangeProfiler:
+  def __init__(self, mode, start_height, end_height, sample_interval_ms, output_file):
+    self.mode = mode
+    self.start_height = start_height
+    self.end_height = end_height
+    self.sample_interval_ms = sample_interval_ms
+    self.output_file = output_file
+    self.profiler = None
+
+  def start_if_needed(self, start_height, end_height):
+    if self.mode == "" or self.profiler is not None: return
+    if end_height < self.start_height or start_height > self.end_height: return
+    print("Starting " + self.mode + " profiler at block " + str(start_height))
+    if self.mode == "cprofile":
+      self.profiler = cProfile.Profile()
+      self.profiler.enable()
+    else:
+      self.profiler = SamplingProfiler(self.sample_interval_ms)
+      self.profiler.start()
+
+  def stop_if_needed(self, block_height):
+    if self.profiler is None or block_height < self.end_height: return
+    if self.mode == "cprofile":
+      self.profiler.disable()
+      self.profiler.dump_stats(self.output_file + ".prof")
+      print("Profile saved to " + self.output_file + ".prof")
+    else:
+      self.profiler.stop(self.output_file + ".folded")
+      print("Profile saved to " + self.output_file + ".folded")
+    self.profiler = None
+
+
+## main_index notifies opi_new_block when a new block_hashes row is committed, the connection has to LISTEN opi_new_block
+def wait_for_new_block(conn_metaprotocol, listen_new_blocks, timeout):
+  if not listen_new_blocks:
+    time.sleep(5)
+    return
+  if len(conn_metaprotocol.notifies) == 0: ## notifications which arrived during a query are already in notifies
+    select.select([conn_metaprotocol], [], [], timeout)
+    conn_metaprotocol.poll()
+  conn_metaprotocol.notifies.clear()
+
+## returns None if the last indexed block is still on the main chain, otherwise the height of the last common block
+def check_for_reorg(cur, cur_metaprotocol, block_hashes_table):
+  cur.execute('select block_height, block_hash from ' + block_hashes_table + ' order by block_height desc limit 1;')
+  if cur.rowcount == 0: return None ## nothing indexed yet
+  last_block = cur.fetchone()
+
+  cur_metaprotocol.execute('select block_height, block_hash from block_hashes where block_height = %s;', (last_block[0],))
+  last_block_ord = cur_metaprotocol.fetchone()
+  if last_block_ord[1] == last_block[1]: return None ## last block hashes are the same, no reorg
+
+  print("REORG DETECTED!!")
+  cur.execute('select block_height, block_hash from ' + block_hashes_table + ' order by block_height desc limit 10;')
+  hashes = cur.fetchall() ## get last 10 hashes
+  for h in hashes:
+    cur_metaprotocol.execute('select block_height, block_hash from block_hashes where block_height = %s;', (h[0],))
+    block = cur_metaprotocol.fetchone()
+    if block[1] == h[1]: ## found reorg height by a matching hash
+      print("REORG HEIGHT FOUND: " + str(h[0]))
+      return h[0]
+
+  ## bigger than 10 block reorg is not supported by ord
+  print("CRITICAL ERROR!!")
+  sys.exit(1)
+
+def try_to_report_with_retries(report_url, report_retries, to_send):
+  for _ in range(0, report_retries):
+    try:
+      r = requests.post(report_url, json=to_send)
+      if r.status_code == 200:
+        print("Reported hashes to metaprotocol indexer indexer.")
+        return
+      else:
+        print("Error while reporting hashes to metaprotocol indexer indexer, status code: " + str(r.status_code))
+    except KeyboardInterrupt:
+      raise KeyboardInterrupt
+    except:
+      print("Error while reporting hashes to metaprotocol indexer indexer, retrying...")
+    time.sleep(1)
+  print("Error while reporting hashes to metaprotocol indexer indexer, giving up.")
+
+
+## block loop of the token indexers, every block is validated in memory and written in a single transaction:
+## buffered rows, the cumulative event hash and the block hash
+## the protocol registers its tables on writes and reorg_tables and passes index_block, reorg_fix and reset_caches to run()
+class ProtocolEngine:
+  def __init__(self, protocol, conn, cur, conn_metaprotocol, cur_metaprotocol, bulk_writer_mode, work_stats, block_profiler):
+    self.protocol = protocol
+    self.conn = conn
+    self.cur = cur
+    self.conn_metaprotocol = conn_metaprotocol
+    self.cur_metaprotocol = cur_metaprotocol
+    self.work_stats = work_stats
+    self.block_profiler = block_profiler
+    self.writes = BlockWriteBuffer(cur, BulkWriter(cur, bulk_writer_mode))
+    self.block_hashes_table = protocol + '_block_hashes'
+    self.cumulative_hashes_table = protocol + '_cumulative_event_hashes'
+    self.hash_chain = CumulativeHashChain(cur, self.cumulative_hashes_table)
+    self.reorg_tables = [] ## tables with a block_height column, rows above the reorg height are deleted in this order
+    self.block_events_hasher = None
+    self.in_commit = False
+    self.report_to_indexer = False
+    self.report_url = None
+    self.report_retries = 0
+    self.report_fields = {}
+
+  ## report_fields are sent with the hashes of the block (name, type, versions...)
+  def configure_reporting(self, report_to_indexer, report_url, report_retries, report_fields):
+    self.report_to_indexer = report_to_indexer
+    self.report_url = report_url
+    self.report_retries = report_retries
+    self.report_fields = report_fields
+
+  def begin(self):
+    self.cur.execute("BEGIN;")
+    self.in_commit = True
+
+  def commit(self):
+    self.cur.execute("COMMIT;")
+    self.in_commit = False
+
+  def rollback_if_needed(self):
+    if not self.in_commit: return
+    print("rolling back")
+    self.cur.execute("ROLLBACK;")
+    self.in_commit = False
+
+  ## returns the BlockEventHasher of the block
+  def start_block(self, block_height):
+    self.block_events_hasher = BlockEventHasher()
+    self.writes.reset()
+    return self.block_events_hasher
+
+  def update_event_hashes(self, block_height):
+    st_tm = time.time()
+    self.work_stats.add_count("event_count", self.block_events_hasher.event_cnt)
+    block_event_hash = self.block_events_hasher.hexdigest()
+    cumulative_event_hash = get_cumulative_event_hash(self.hash_chain.get_last(block_height), block_event_hash)
+    self.cur.execute('INSERT INTO ' + self.cumulative_hashes_table + ' (block_height, block_event_hash, cumulative_event_hash) VALUES (%s, %s, %s);', (block_height, block_event_hash, cumulative_event_hash))
+    self.hash_chain.set_tip(block_height, cumulative_event_hash)
+    self.work_stats.add_time("hash_tm", st_tm)
+
+  ## write_block(block_height, block_hash) writes protocol rows which are not buffered in writes, in the block transaction before the hashes
+  def commit_block(self, block_height, block_hash, write_block=None):
+    self.begin()
+    st_tm = time.time()
+    self.writes.flush()
+    self.work_stats.add_time("write_tm", st_tm)
+    if write_block is not None: write_block(block_height, block_hash)
+    self.update_event_hashes(block_height)
+    self.cur.execute('INSERT INTO ' + self.block_hashes_table + ' (block_height, block_hash) VALUES (%s, %s);', (block_height, block_hash))
+    print("committing...")
+    st_tm = time.time()
+    self.commit()
+    self.work_stats.add_time("commit_tm", st_tm)
+
+  ## deletes the rows of blocks above reorg_height, revert_reorg undoes in-place updates (ticker supplies) in the same transaction
+  def reorg_fix(self, reorg_height, revert_reorg):
+    self.hash_chain.reset() ## resync hash chain from db on next block
+    self.begin()
+    revert_reorg(reorg_height)
+    for table_name in self.reorg_tables + [self.cumulative_hashes_table, self.block_hashes_table]:
+      self.cur.execute('delete from ' + table_name + ' where block_height > %s;', (reorg_height,))
+      self.cur.execute("SELECT setval('" + table_name + "_id_seq', max(id)) from " + table_name + ";") ## reset id sequence
+    self.commit()
+
+  def get_next_block_height(self, first_height):
+    self.cur.execute('select max(block_height) from ' + self.block_hashes_table + ';')
+    row = self.cur.fetchone()
+    if row[0] is None: return first_height
+    return row[0] + 1
+
+  ## rows above the last indexed block are left from an interrupted run, they are removed like a reorg
+  def check_residue(self, first_height, reorg_fix):
+    current_block = self.get_next_block_height(first_height)
+    residue_found = False
+    for table_name in self.reorg_tables + [self.cumulative_hashes_table]:
+      self.cur.execute('select coalesce(max(block_height), -1) from ' + table_name + ';')
+      if self.cur.fetchone()[0] >= current_block:
+        residue_found = True
+        print("residue on " + table_name)
+    if residue_found:
+      print("There is residue from last run, rolling back to " + str(current_block - 1))
+      reorg_fix(current_block - 1)
+      print("Rolled back to " + str(current_block - 1))
+
+  def report_hashes(self, block_height):
+    if not self.report_to_indexer:
+      print("Reporting to metaprotocol indexer is disabled.")
+      return
+    self.cur.execute('select block_event_hash, cumulative_event_hash from ' + self.cumulative_hashes_table + ' where block_height = %s;', (block_height,))
+    block_event_hash, cumulative_event_hash = self.cur.fetchone()
+    self.cur.execute('select block_hash from ' + self.block_hashes_table + ' where block_height = %s;', (block_height,))
+    block_hash = self.cur.fetchone()[0]
+    to_send = dict(self.report_fields)
+    to_send["block_height"] = block_height
+    to_send["block_hash"] = block_hash
+    to_send["block_event_hash"] = block_event_hash
+    to_send["cumulative_event_hash"] = cumulative_event_hash
+    print("Sending hashes to metaprotocol indexer indexer...")
+    try_to_report_with_retries(self.report_url, self.report_retries, to_send)
+
+  ## after_block runs after the block is committed (extra tables), before_block at the start of every iteration
+  ## a failed block is rolled back and reset_caches reloads the in-memory state changed by it
+  ## catch-up mode: get_batch_size(blocks_to_tip) > 1 indexes and commits that many blocks at once with index_block_range(start_height, end_height)
+  def run(self, first_height, index_block, reorg_fix, reset_caches, listen_new_blocks, new_block_wait_timeout, before_block=None, after_block=None, get_batch_size=None, index_block_range=None):
+    last_report_height = 0
+    while True:
+      self.check_residue(first_height, reorg_fix)
+      if before_block is not None: before_block()
+      ## check if a new block is indexed
+      self.cur_metaprotocol.execute('''SELECT coalesce(max(block_height), -1) as max_height from block_hashes;''')
+      max_block_of_metaprotocol_db = self.cur_metaprotocol.fetchone()[0]
+      print("max_block_of_metaprotocol_db: ", max_block_of_metaprotocol_db)
+      current_block = self.get_next_block_height(first_height)
+      if current_block > max_block_of_metaprotocol_db:
+        print("Waiting for new blocks...")
+        wait_for_new_block(self.conn_metaprotocol, listen_new_blocks, new_block_wait_timeout)
+        continue
+
+      print("Processing block %s" % current_block)
+      self.cur_metaprotocol.execute('select block_hash from block_hashes where block_height = %s;', (current_block,))
+      current_block_hash = self.cur_metaprotocol.fetchone()[0]
+      reorg_height = check_for_reorg(self.cur, self.cur_metaprotocol, self.block_hashes_table)
+      if reorg_height is not None:
+        print("Rolling back to ", reorg_height)
+        reorg_fix(reorg_height)
+        print("Rolled back to " + str(reorg_height))
+        continue
+      try:
+        self.work_stats.reset()
+        batch_size = 1
+        if get_batch_size is not None: batch_size = get_batch_size(max_block_of_metaprotocol_db - current_block + 1)
+        last_block = current_block + batch_size - 1
+        self.block_profiler.start_if_needed(current_block, last_block)
+        if batch_size > 1: index_block_range(current_block, last_block)
+        else: index_block(current_block, current_block_hash)
+        if after_block is not None: after_block(last_block, max_block_of_metaprotocol_db)
+        if max_block_of_metaprotocol_db - last_block < 10 or last_block - last_report_height > 100: ## do not report if there are more than 10 blocks to index
+          st_tm = time.time()
+          self.report_hashes(last_block)
+          self.work_stats.add_time("report_tm", st_tm)
+          last_report_height = last_block
+        self.work_stats.save(current_block, last_block)
+        self.block_profiler.stop_if_needed(last_block)
+      except KeyboardInterrupt:
+        traceback.print_exc()
+        self.rollback_if_needed()
+        print("Exiting...")
+        sys.exit(1)
+      except:
+        traceback.print_exc()
+        self.rollback_if_needed()
+        self.hash_chain.reset()
+        reset_caches()
+        time.sleep(10)
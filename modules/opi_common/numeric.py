@@ -0,0 +1,73 @@
+## numeric string validation and conversion shared by the token indexers
+## acceptance is identical to the previous per-indexer implementations, checked by numeric_fuzz.py
+## str values take the fast path, anything else (e.g. lists from json content) goes through the previous character loop
+
+TEN_POW_18 = 10 ** 18
+
+def is_positive_number(s, do_strip=False):
+  if type(s) is str:
+    if do_strip:
+      s = s.strip()
+    return s.isascii() and s.isdigit() ## isdigit of an ascii string only accepts 0-9, empty string is rejected
+  try:
+    if do_strip:
+      s = s.strip()
+    if len(s) == 0: return False
+    for ch in s:
+      if ord(ch) > ord('9') or ord(ch) < ord('0'):
+        return False
+    return True
+  except KeyboardInterrupt:
+    raise KeyboardInterrupt
+  except: return False ## has to be a string
+
+def is_positive_number_with_dot(s, do_strip=False):
+  if type(s) is str:
+    if do_strip:
+      s = s.strip()
+    if len(s) == 0 or s[0] == '.' or s[-1] == '.': return False
+    dot_idx = s.find('.')
+    if dot_idx != -1:
+      s = s[:dot_idx] + s[dot_idx + 1:] ## a second dot is rejected by isdigit
+    return s.isascii() and s.isdigit()
+  try:
+    if do_strip:
+      s = s.strip()
+    dotFound = False
+    if len(s) == 0: return False
+    if s[0] == '.': return False
+    if s[-1] == '.': return False
+    for ch in s:
+      if ord(ch) > ord('9') or ord(ch) < ord('0'):
+        if ch != '.': return False
+        if dotFound: return False
+        dotFound = True
+    return True
+  except KeyboardInterrupt:
+    raise KeyboardInterrupt
+  except: return False ## has to be a string
+
+def get_number_extended_to_18_decimals(s, decimals, do_strip=False):
+  if do_strip:
+    s = s.strip()
+  
+  if '.' in s:
+    parts = s.split('.')
+    decimals_part = parts[1]
+    if len(decimals_part) > decimals or len(decimals_part) == 0: ## more decimal digit than allowed or no decimal digit after dot
+      return None
+    decimals_part = decimals_part[:decimals]
+    decimals_part += '0' * (18 - len(decimals_part))
+    return int(parts[0] + decimals_part)
+  else:
+    return int(s) * TEN_POW_18
+
+def fix_numstr_decimals(num_str, decimals):
+  if len(num_str) <= 18:
+    num_str = '0.' + num_str.rjust(18, '0')
+  else:
+    num_str = num_str[:-18] + '.' + num_str[-18:]
+  if decimals < 18:
+    num_str = num_str[:-18+decimals]
+  if num_str[-1] == '.': num_str = num_str[:-1] ## remove trailing dot
+  return num_str
@@ -0,0 +1,52 @@
+## microbenchmark of the numeric validators and get_event_str, reports ns/op
+## previous implementations (from numeric_fuzz.py) are measured next to opi_common.numeric for comparison
+## usage: python3 numeric_bench.py [number of calls per case]
+
+import os, sys, ast, timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from opi_common import numeric
+from opi_common import numeric_fuzz as previous
+
+BRC20_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'brc20_index', 'brc20_index.py')
+
+## get_event_str is taken from brc20_index.py without importing it, importing the indexer connects to the databases
+def load_get_event_str():
+  with open(BRC20_INDEX_PATH, 'r') as f:
+    tree = ast.parse(f.read())
+  for node in tree.body:
+    if isinstance(node, ast.FunctionDef) and node.name == 'get_event_str':
+      namespace = { 'fix_numstr_decimals': numeric.fix_numstr_decimals, 'ticks': { 'ordi': [0, 0, 18, False, ''], 'sats': [0, 0, 8, False, ''] } }
+      exec(compile(ast.Module(body=[node], type_ignores=[]), BRC20_INDEX_PATH, 'exec'), namespace)
+      return namespace['get_event_str']
+  return None
+
+def bench(name, f, args_list, number):
+  per_call = number // len(args_list)
+  tm = timeit.timeit(lambda: [f(*args) for args in args_list], number=per_call)
+  print("%-60s %10.1f ns/op" % (name, tm * 1e9 / (per_call * len(args_list))))
+
+def main():
+  number = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+  amounts = [('1000',), ('21000000',), ('0.5',), ('123456789.123456789',), (' 42 ', True), ('1.2.3',), ('abc',), ('',)]
+  amounts_with_dot = [(a[0], True) for a in amounts]
+  extends = [('1000', 18), ('0.5', 18), ('123456789.123456789', 18), ('1.123', 2), ('77', 8)]
+  fixes = [('1000000000000000000000', 18), ('500000000000000000', 18), ('123456789123456789000000000', 8), ('0', 18)]
+  for fname, cases in [('is_positive_number', amounts), ('is_positive_number_with_dot', amounts_with_dot),
+                       ('get_number_extended_to_18_decimals', extends), ('fix_numstr_decimals', fixes)]:
+    bench('previous ' + fname, getattr(previous, fname), cases, number)
+    bench('opi_common.numeric ' + fname, getattr(numeric, fname), cases, number)
+
+  get_event_str = load_get_event_str()
+  if get_event_str is None:
+    print("get_event_str not found in " + BRC20_INDEX_PATH)
+    return
+  events = [
+    ({ "deployer_pkScript": "5120" + "ab" * 32, "tick": "ordi", "original_tick": "ordi", "max_supply": "21000000000000000000000000", "decimals": "18", "limit_per_mint": "1000000000000000000000", "is_self_mint": "false" }, "deploy-inscribe", "a" * 64 + "i0"),
+    ({ "minted_pkScript": "0014" + "cd" * 20, "tick": "ordi", "original_tick": "ordi", "amount": "1000000000000000000000", "parent_id": "" }, "mint-inscribe", "b" * 64 + "i0"),
+    ({ "source_pkScript": "0014" + "cd" * 20, "tick": "sats", "original_tick": "sats", "amount": "123456789000000000000" }, "transfer-inscribe", "c" * 64 + "i0"),
+    ({ "source_pkScript": "0014" + "cd" * 20, "spent_pkScript": "5120" + "ef" * 32, "tick": "sats", "original_tick": "sats", "amount": "123456789000000000000" }, "transfer-transfer", "c" * 64 + "i0"),
+  ]
+  bench('brc20 get_event_str', get_event_str, events, number)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,128 @@
+## differential fuzz test of opi_common.numeric against the previous per-indexer implementations
+## usage: python3 numeric_fuzz.py [iterations] [seed]
+
+import os, sys, random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from opi_common import numeric
+
+## previous implementations, copied from brc20_index.py
+def is_positive_number(s, do_strip=False):
+  try:
+    if do_strip:
+      s = s.strip()
+    try:
+      if len(s) == 0: return False
+      for ch in s:
+        if ord(ch) > ord('9') or ord(ch) < ord('0'):
+          return False
+      return True
+    except KeyboardInterrupt:
+      raise KeyboardInterrupt
+    except: return False
+  except KeyboardInterrupt:
+    raise KeyboardInterrupt
+  except: return False ## has to be a string
+
+def is_positive_number_with_dot(s, do_strip=False):
+  try:
+    if do_strip:
+      s = s.strip()
+    try:
+      dotFound = False
+      if len(s) == 0: return False
+      if s[0] == '.': return False
+      if s[-1] == '.': return False
+      for ch in s:
+        if ord(ch) > ord('9') or ord(ch) < ord('0'):
+          if ch != '.': return False
+          if dotFound: return False
+          dotFound = True
+      return True
+    except KeyboardInterrupt:
+      raise KeyboardInterrupt
+    except: return False
+  except KeyboardInterrupt:
+    raise KeyboardInterrupt
+  except: return False ## has to be a string
+
+def get_number_extended_to_18_decimals(s, decimals, do_strip=False):
+  if do_strip:
+    s = s.strip()
+  
+  if '.' in s:
+    normal_part = s.split('.')[0]
+    if len(s.split('.')[1]) > decimals or len(s.split('.')[1]) == 0: ## more decimal digit than allowed or no decimal digit after dot
+      return None
+    decimals_part = s.split('.')[1][:decimals]
+    decimals_part += '0' * (18 - len(decimals_part))
+    return int(normal_part + decimals_part)
+  else:
+    return int(s) * 10 ** 18
+
+def fix_numstr_decimals(num_str, decimals):
+  if len(num_str) <= 18:
+    num_str = '0' * (18 - len(num_str)) + num_str
+    num_str = '0.' + num_str
+    if decimals < 18:
+      num_str = num_str[:-18+decimals]
+  else:
+    num_str = num_str[:-18] + '.' + num_str[-18:]
+    if decimals < 18:
+      num_str = num_str[:-18+decimals]
+  if num_str[-1] == '.': num_str = num_str[:-1] ## remove trailing dot
+  return num_str
+
+ALPHABET = '0123456789' * 4 + '....  \t\n _+-eExa٣²०１'
+
+def random_str(rnd):
+  n = rnd.choice([0, 1, 1, 2, 3, 5, 8, 18, 19, 20, 30, 45])
+  if rnd.random() < 0.5: ## mostly well formed numbers
+    s = ''.join(rnd.choice('0123456789') for _ in range(n))
+    if rnd.random() < 0.5 and n > 0:
+      pos = rnd.randint(0, n)
+      s = s[:pos] + '.' + s[pos:]
+    if rnd.random() < 0.2:
+      s = rnd.choice([' ', '\t', ' ', '\n']) + s + rnd.choice(['', ' ', '\n'])
+    return s
+  return ''.join(rnd.choice(ALPHABET) for _ in range(n))
+
+def random_value(rnd):
+  r = rnd.random()
+  if r < 0.9: return random_str(rnd)
+  return rnd.choice([None, 0, 12, 1.5, True, [], ['1'], ['1', '2'], ['.', '1'], ('7',), {}, {'1': 1}, b'12', ['1', 'a']])
+
+def call(f, *args):
+  try:
+    return ('ok', f(*args))
+  except Exception as e:
+    return ('err', type(e))
+
+def check(name, expected, actual, args):
+  if expected != actual:
+    print("MISMATCH in " + name + " for " + repr(args) + ": expected " + repr(expected) + ", got " + repr(actual))
+    return 1
+  return 0
+
+def main():
+  iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+  seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+  rnd = random.Random(seed)
+  mismatches = 0
+  for _ in range(iterations):
+    v = random_value(rnd)
+    do_strip = rnd.random() < 0.5
+    decimals = rnd.choice([0, 1, 2, 8, 17, 18, 19, 25, -1])
+    mismatches += check('is_positive_number', call(is_positive_number, v, do_strip), call(numeric.is_positive_number, v, do_strip), (v, do_strip))
+    mismatches += check('is_positive_number_with_dot', call(is_positive_number_with_dot, v, do_strip), call(numeric.is_positive_number_with_dot, v, do_strip), (v, do_strip))
+    mismatches += check('get_number_extended_to_18_decimals', call(get_number_extended_to_18_decimals, v, decimals, do_strip), call(numeric.get_number_extended_to_18_decimals, v, decimals, do_strip), (v, decimals, do_strip))
+    if type(v) is str:
+      num_str = v if rnd.random() < 0.5 else ''.join(rnd.choice('0123456789') for _ in range(rnd.randint(1, 45)))
+      mismatches += check('fix_numstr_decimals', call(fix_numstr_decimals, num_str, decimals), call(numeric.fix_numstr_decimals, num_str, decimals), (num_str, decimals))
+    if mismatches > 20: break
+  if mismatches > 0:
+    print(str(mismatches) + " mismatches")
+    sys.exit(1)
+  print("OK, " + str(iterations) + " iterations with seed " + str(seed))
+
+if __name__ == '__main__':
+  main()
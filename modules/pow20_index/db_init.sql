@@ -53,6 +53,15 @@ CREATE TABLE public.pow20_tickers (
 CREATE UNIQUE INDEX pow20_tickers_tick_idx ON public.pow20_tickers USING btree (tick);
 CREATE INDEX pow20_tickers_starting_block_height_idx ON public.pow20_tickers USING btree (starting_block_height);
 
+CREATE TABLE public.pow20_mint_solutions (
+	id bigserial NOT NULL,
+	solution_hash text NOT NULL, -- sha256 of the solution of a valid mint
+	block_height int4 NOT NULL,
+	CONSTRAINT pow20_mint_solutions_pk PRIMARY KEY (id)
+);
+CREATE UNIQUE INDEX pow20_mint_solutions_solution_hash_idx ON public.pow20_mint_solutions USING btree (solution_hash);
+CREATE INDEX pow20_mint_solutions_block_height_idx ON public.pow20_mint_solutions USING btree (block_height);
+
 CREATE TABLE public.pow20_cumulative_event_hashes (
 	id bigserial NOT NULL,
 	block_height int4 NOT NULL,
@@ -73,6 +82,27 @@ INSERT INTO public.pow20_event_types (event_type_name, event_type_id) VALUES ('m
 INSERT INTO public.pow20_event_types (event_type_name, event_type_id) VALUES ('transfer-inscribe', 2);
 INSERT INTO public.pow20_event_types (event_type_name, event_type_id) VALUES ('transfer-transfer', 3);
 
+CREATE TABLE public.pow20_indexer_work_stats (
+	id bigserial NOT NULL,
+	min_block_height int4 NOT NULL,
+	max_block_height int4 NOT NULL,
+	transfer_count int4 NOT NULL DEFAULT 0,
+	event_count int4 NOT NULL DEFAULT 0,
+	fetch_tm int4 NOT NULL DEFAULT 0,
+	balance_fetch_tm int4 NOT NULL DEFAULT 0,
+	index_tm int4 NOT NULL DEFAULT 0,
+	write_tm int4 NOT NULL DEFAULT 0,
+	hash_tm int4 NOT NULL DEFAULT 0,
+	commit_tm int4 NOT NULL DEFAULT 0,
+	extra_tables_tm int4 NOT NULL DEFAULT 0,
+	report_tm int4 NOT NULL DEFAULT 0,
+	all_tm int4 NOT NULL DEFAULT 0,
+	balance_cache_hits int8 NOT NULL DEFAULT 0,
+	balance_cache_misses int8 NOT NULL DEFAULT 0,
+	ts timestamptz NOT NULL DEFAULT now(),
+	CONSTRAINT pow20_indexer_work_stats_pk PRIMARY KEY (id)
+);
+
 CREATE TABLE public.pow20_indexer_version (
 	id bigserial NOT NULL,
 	indexer_version text NOT NULL,
@@ -3,5 +3,7 @@ drop table if exists pow20_historic_balances;
 drop table if exists pow20_events;
 drop table if exists pow20_event_types;
 drop table if exists pow20_tickers;
+drop table if exists pow20_mint_solutions;
 drop table if exists pow20_cumulative_event_hashes;
+drop table if exists pow20_indexer_work_stats;
 drop table if exists pow20_indexer_version;
@@ -1,11 +1,15 @@
 # pip install python-dotenv
 # pip install psycopg2-binary
 
-import os, sys, requests
+import os, sys
 from dotenv import load_dotenv
 import traceback, time, codecs, json
 import psycopg2
-import hashlib
+import io, hashlib
+import multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) ## modules directory, for opi_common
+from opi_common.numeric import is_positive_number, is_positive_number_with_dot, get_number_extended_to_18_decimals, fix_numstr_decimals
+from opi_common.engine import get_sha256_hash, get_cumulative_event_hash, utf8len, BlockEventHasher, Balance, LRUCache, WorkStats, BlockRangeProfiler, ProtocolEngine
 
 if not os.path.isfile('.env'):
   print(".env file not found, please run \"python3 reset_init.py\" first")
@@ -13,9 +17,7 @@ if not os.path.isfile('.env'):
 
 ## global variables
 ticks = {}
-in_commit = False
-block_events_str = ""
-EVENT_SEPARATOR = "|"
+block_events_hasher = None ## BlockEventHasher of the block being indexed
 INDEXER_VERSION = "opi-pow20-full-node v0.3.0"
 CAN_BE_FIXED_DB_VERSIONS = [  ]
 DB_VERSION = 3
@@ -45,6 +47,18 @@ report_retries = int(os.getenv("REPORT_RETRIES") or "10")
 report_name = os.getenv("REPORT_NAME") or "opi_pow20_indexer"
 create_extra_tables = (os.getenv("CREATE_EXTRA_TABLES") or "false") == "true"
 network_type = os.getenv("NETWORK_TYPE") or "mainnet"
+balance_cache_max_mb = int(os.getenv("BALANCE_CACHE_MAX_MB") or "512")
+bulk_writer = os.getenv("BULK_WRITER") or "copy" ## copy or insert
+profile_mode = os.getenv("PROFILE_MODE") or "" ## cprofile, sampling or empty to disable
+profile_start_height = int(os.getenv("PROFILE_START_HEIGHT") or "0")
+profile_end_height = int(os.getenv("PROFILE_END_HEIGHT") or "0")
+profile_sample_interval_ms = int(os.getenv("PROFILE_SAMPLE_INTERVAL_MS") or "10")
+profile_output_file = os.getenv("PROFILE_OUTPUT_FILE") or "pow20_profile"
+listen_new_blocks = (os.getenv("LISTEN_NEW_BLOCKS") or "true") == "true"
+new_block_wait_timeout = int(os.getenv("NEW_BLOCK_WAIT_TIMEOUT") or "30")
+reindex_workers = int(os.getenv("REINDEX_WORKERS") or "4")
+pow_verify_workers = min(int(os.getenv("POW_VERIFY_WORKERS") or "4"), os.cpu_count() or 1) ## no fan-out on a single core
+pow_verify_min_batch = int(os.getenv("POW_VERIFY_MIN_BATCH") or "50000")
 
 first_inscription_heights = {
   'mainnet': 832486,
@@ -58,6 +72,10 @@ if network_type == 'regtest':
   report_to_indexer = False
   print("Network type is regtest, reporting to indexer is disabled.")
 
+if profile_mode not in ["", "cprofile", "sampling"]:
+  print("PROFILE_MODE must be cprofile, sampling or empty")
+  sys.exit(1)
+
 ## connect to db
 conn = psycopg2.connect(
   host=db_host,
@@ -77,6 +95,10 @@ conn_metaprotocol = psycopg2.connect(
 conn_metaprotocol.autocommit = True
 cur_metaprotocol = conn_metaprotocol.cursor()
 
+## main_index notifies opi_new_block when a new block_hashes row is committed (see check_db in main_index/index.js)
+if listen_new_blocks:
+  cur_metaprotocol.execute('''LISTEN opi_new_block;''')
+
 ## create tables if not exists
 ## does pow20_block_hashes table exist?
 cur.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = 'pow20_block_hashes') AS table_existence;''')
@@ -87,6 +109,25 @@ if cur.fetchone()[0] == False:
     cur.execute(sql)
   conn.commit()
 
+## these tables were added later, create them on databases initialised before them
+for table_name in ['pow20_indexer_work_stats', 'pow20_mint_solutions']:
+  cur.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = %s) AS table_existence;''', (table_name,))
+  if cur.fetchone()[0] == False:
+    print("Creating " + table_name + "...")
+    with open('db_init.sql', 'r') as f:
+      for statement in f.read().split(';'):
+        if 'public.' + table_name + ' ' in statement: ## table and its indexes
+          cur.execute(statement.strip() + ';')
+    if table_name == 'pow20_mint_solutions': ## fill from existing mint events
+      cur.execute('''insert into pow20_mint_solutions (solution_hash, block_height)
+                     select encode(sha256(convert_to(e.event->>'solution', 'UTF8')), 'hex'), e.block_height
+                     from pow20_events e
+                     where e.event_type = (select event_type_id from pow20_event_types where event_type_name = 'mint-inscribe')
+                     order by e.id asc;''')
+
+## write_tm and commit_tm were added when block writes moved to opi_common.engine
+cur.execute('''alter table pow20_indexer_work_stats add column if not exists write_tm int4 NOT NULL DEFAULT 0, add column if not exists commit_tm int4 NOT NULL DEFAULT 0;''')
+
 if create_extra_tables:
   cur.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = 'pow20_extras_block_hashes') AS table_existence;''')
   if cur.fetchone()[0] == False:
@@ -108,75 +149,6 @@ if network_type_db != network_type:
 
 ## helper functions
 
-def utf8len(s):
-  return len(s.encode('utf-8'))
-
-def is_positive_number(s, do_strip=False):
-  try:
-    if do_strip:
-      s = s.strip()
-    try:
-      if len(s) == 0: return False
-      for ch in s:
-        if ord(ch) > ord('9') or ord(ch) < ord('0'):
-          return False
-      return True
-    except: return False
-  except: return False ## has to be a string
-
-def is_positive_number_with_dot(s, do_strip=False):
-  try:
-    if do_strip:
-      s = s.strip()
-    try:
-      dotFound = False
-      if len(s) == 0: return False
-      if s[0] == '.': return False
-      if s[-1] == '.': return False
-      for ch in s:
-        if ord(ch) > ord('9') or ord(ch) < ord('0'):
-          if ch != '.': return False
-          if dotFound: return False
-          dotFound = True
-      return True
-    except: return False
-  except: return False ## has to be a string
-
-def get_number_extended_to_18_decimals(s, decimals, do_strip=False):
-  if do_strip:
-    s = s.strip()
-  
-  if '.' in s:
-    normal_part = s.split('.')[0]
-    if len(s.split('.')[1]) > decimals or len(s.split('.')[1]) == 0: ## more decimal digit than allowed or no decimal digit after dot
-      return None
-    decimals_part = s.split('.')[1][:decimals]
-    decimals_part += '0' * (18 - len(decimals_part))
-    return int(normal_part + decimals_part)
-  else:
-    return int(s) * 10 ** 18
-
-def is_used_or_invalid(inscription_id):
-  global event_types
-  cur.execute('''select coalesce(sum(case when event_type = %s then 1 else 0 end), 0) as inscr_cnt,
-                        coalesce(sum(case when event_type = %s then 1 else 0 end), 0) as transfer_cnt
-                        from pow20_events where inscription_id = %s;''', (event_types["transfer-inscribe"], event_types["transfer-transfer"], inscription_id,))
-  row = cur.fetchall()[0]
-  return (row[0] != 1) or (row[1] != 0)
-
-def fix_numstr_decimals(num_str, decimals):
-  if len(num_str) <= 18:
-    num_str = '0' * (18 - len(num_str)) + num_str
-    num_str = '0.' + num_str
-    if decimals < 18:
-      num_str = num_str[:-18+decimals]
-  else:
-    num_str = num_str[:-18] + '.' + num_str[-18:]
-    if decimals < 18:
-      num_str = num_str[:-18+decimals]
-  if num_str[-1] == '.': num_str = num_str[:-1] ## remove trailing dot
-  return num_str
-
 def get_event_str(event, event_type, inscription_id):
   global ticks
   if event_type == "deploy-inscribe":
@@ -224,76 +196,187 @@ def get_event_str(event, event_type, inscription_id):
     print("EVENT TYPE ERROR!!")
     exit(1)
 
-def get_sha256_hash(s):
-  return hashlib.sha256(s.encode('utf-8')).hexdigest()
 
-def get_double_sha256_hash(s):
-  return get_sha256_hash(get_sha256_hash(s))
+## number of leading zero hex digits of sha256(sha256(solution).hexdigest()), the second hash is over the hex string of the first
+## the digest is compared as an integer, a solution meets difficulty d if it has at least d leading zero nibbles
+def get_pow_zero_nibbles(solution):
+  digest = hashlib.sha256(hashlib.sha256(solution.encode('utf-8')).hexdigest().encode('utf-8')).digest()
+  n = int.from_bytes(digest, 'big')
+  if n == 0: return 64
+  return (256 - n.bit_length()) // 4
 
 def meets_difficulty(solution, difficulty):
-    hash_result = get_double_sha256_hash(solution)
-    return hash_result.startswith('0' * difficulty)
+  return get_pow_zero_nibbles(solution) >= difficulty
 
-def has_solution_been_used(cur, event_types, solution):
-    # Prepare the query
-    query = '''SELECT EXISTS(SELECT 1 FROM pow20_events 
-                             WHERE event_type = %s AND event ->> 'solution' = %s);'''
-    cur.execute(query, (event_types["mint-inscribe"], solution))
-    return cur.fetchone()[0]
+## solutions of the mint inscriptions of a block, checked in one batch before the validation loop
+def get_block_solutions(transfers):
+  solutions = set()
+  for transfer in transfers:
+    old_satpoint, js = transfer[2], transfer[6]
+    if old_satpoint != '' or not isinstance(js, dict): continue
+    if js.get("op") != 'mint': continue
+    solution = js.get("solution")
+    if isinstance(solution, str): solutions.add(solution)
+  return list(solutions)
+
+## solution -> leading zero nibbles, big batches are split over a process pool which is kept for later blocks
+pow_verify_pool = None
+def verify_block_solutions(solutions):
+  global pow_verify_pool
+  if len(solutions) == 0: return {}
+  sttm = time.time()
+  if pow_verify_workers > 1 and len(solutions) >= pow_verify_min_batch:
+    if pow_verify_pool is None:
+      pow_verify_pool = multiprocessing.get_context('fork').Pool(pow_verify_workers) ## fork, workers only need get_pow_zero_nibbles
+    zero_nibbles = pow_verify_pool.map(get_pow_zero_nibbles, solutions, chunksize=max(1, len(solutions) // (pow_verify_workers * 4)))
+  else:
+    zero_nibbles = [get_pow_zero_nibbles(solution) for solution in solutions]
+  elapsed = time.time() - sttm
+  print("PoW verified " + str(len(solutions)) + " solutions in " + str(round(elapsed, 3)) + " seconds (" + str(int(len(solutions) / max(elapsed, 1e-6))) + " hashes/s)")
+  return dict(zip(solutions, zero_nibbles))
+
+## solution registry, sha256 hashes of the solutions of all valid mints
+## mirrors pow20_mint_solutions, solutions of the current block are added before they are written
+## loaded once at startup, reorgs and failed blocks only remove the solutions of the rolled back blocks
+used_solutions = set()
+def load_used_solutions():
+  global used_solutions
+  sttm = time.time()
+  cur.execute('''select solution_hash from pow20_mint_solutions;''')
+  used_solutions = set([row[0] for row in cur.fetchall()])
+  print("Used solutions loaded (" + str(len(used_solutions)) + ") in " + str(time.time() - sttm) + " seconds")
 
+def has_solution_been_used(solution):
+  return get_sha256_hash(solution) in used_solutions
 
+def add_used_solution(solution_hash):
+  used_solutions.add(solution_hash)
+  block_new_solutions.append(solution_hash)
 
 ## caches
-transfer_inscribe_event_cache = {} ## single use cache for transfer inscribe events
+## transfer inscriptions which are not spent yet, values are (source_pkScript, source_wallet)
+## loaded once at startup, updated on transfer inscribe and transfer transfer
+## reorgs roll back only the entries of the reorged blocks (revert_unused_transfers), failed blocks undo their own changes (undo_block_changes)
+unused_transfers = {}
+def load_unused_transfers():
+  global unused_transfers
+  sttm = time.time()
+  cur.execute('''select i.inscription_id, i.event->>'source_pkScript', i.event->>'source_wallet'
+                 from pow20_events i
+                 where i.event_type = %s
+                   and not exists (select 1 from pow20_events t where t.event_type = %s and t.inscription_id = i.inscription_id);''', (event_types["transfer-inscribe"], event_types["transfer-transfer"]))
+  unused_transfers = {}
+  for row in cur.fetchall():
+    unused_transfers[row[0]] = (sys.intern(row[1]), row[2])
+  print("Unused transfers loaded (" + str(len(unused_transfers)) + ") in " + str(time.time() - sttm) + " seconds")
+
+def add_unused_transfer(inscription_id, event):
+  block_unused_transfers_undo.append((inscription_id, unused_transfers.get(inscription_id)))
+  unused_transfers[inscription_id] = (sys.intern(event["source_pkScript"]), event["source_wallet"])
+
+def is_used_or_invalid(inscription_id):
+  return inscription_id not in unused_transfers
+
+## single use, removes the transfer from unused transfers
 def get_transfer_inscribe_event(inscription_id):
-  global transfer_inscribe_event_cache, event_types
-  if inscription_id in transfer_inscribe_event_cache:
-    event = transfer_inscribe_event_cache[inscription_id]
-    del transfer_inscribe_event_cache[inscription_id]
-    return event
-  cur.execute('''select event from pow20_events where event_type = %s and inscription_id = %s;''', (event_types["transfer-inscribe"], inscription_id,))
-  return cur.fetchall()[0][0]
-
-def save_transfer_inscribe_event(inscription_id, event):
-  transfer_inscribe_event_cache[inscription_id] = event
-
-balance_cache = {}
+  transfer = unused_transfers.pop(inscription_id)
+  block_unused_transfers_undo.append((inscription_id, transfer))
+  return transfer
+
+## changes of the block being indexed to unused_transfers and used_solutions, dropped once the block is committed
+block_unused_transfers_undo = [] ## (inscription_id, previous value or None)
+block_new_solutions = []
+def clear_block_changes():
+  global block_unused_transfers_undo, block_new_solutions
+  block_unused_transfers_undo = []
+  block_new_solutions = []
+
+## the block was not committed, restores the resident maps to the last committed block
+def undo_block_changes():
+  for inscription_id, transfer in reversed(block_unused_transfers_undo):
+    if transfer is None: unused_transfers.pop(inscription_id, None)
+    else: unused_transfers[inscription_id] = transfer
+  for solution_hash in block_new_solutions:
+    used_solutions.discard(solution_hash)
+  clear_block_changes()
+
+## transfer inscriptions of blocks above reorg_height are dropped, transfers spent above reorg_height and inscribed at or below it are unused again
+## only call before the events above reorg_height are deleted, returns the changes which are applied after the reorg is committed
+def get_reorged_unused_transfers(reorg_height):
+  cur.execute('''select inscription_id, event->>'source_pkScript', event->>'source_wallet', true
+                 from pow20_events
+                 where event_type = %s and block_height > %s
+                 union all
+                 select i.inscription_id, i.event->>'source_pkScript', i.event->>'source_wallet', false
+                 from pow20_events t
+                 join pow20_events i on i.event_type = %s and i.inscription_id = t.inscription_id and i.block_height <= %s
+                 where t.event_type = %s and t.block_height > %s;''', (event_types["transfer-inscribe"], reorg_height, event_types["transfer-inscribe"], reorg_height, event_types["transfer-transfer"], reorg_height))
+  return cur.fetchall()
+
+def revert_unused_transfers(reorged_transfers):
+  for inscription_id, source_pkScript, source_wallet, is_reorged in reorged_transfers:
+    if is_reorged: unused_transfers.pop(inscription_id, None)
+    else: unused_transfers[inscription_id] = (sys.intern(source_pkScript), source_wallet)
+
+balance_cache = LRUCache("balance cache", balance_cache_max_mb * 1024 * 1024) ## keys are (pkscript, tick), values are Balance records
 def get_last_balance(pkscript, tick):
   global balance_cache
-  cache_key = pkscript + tick
-  if cache_key in balance_cache:
-    return balance_cache[cache_key]
+  cache_key = (sys.intern(pkscript), sys.intern(tick))
+  balance_obj = balance_cache.get(cache_key)
+  if balance_obj is not None:
+    return balance_obj
+  st_tm = time.time()
   cur.execute('''select overall_balance, available_balance from pow20_historic_balances where pkscript = %s and tick = %s order by block_height desc, id desc limit 1;''', (pkscript, tick))
   row = cur.fetchone()
-  balance_obj = None
+  work_stats.add_time("balance_fetch_tm", st_tm)
   if row is None:
-    balance_obj = {
-      "overall_balance": 0,
-      "available_balance": 0
-    }
+    balance_obj = Balance(0, 0)
   else:
-    balance_obj = {
-      "overall_balance": row[0],
-      "available_balance": row[1]
-    }
-  balance_cache[cache_key] = balance_obj
+    balance_obj = Balance(row[0], row[1])
+  balance_cache.set(cache_key, balance_obj)
   return balance_obj
 
 def check_available_balance(pkScript, tick, amount):
   last_balance = get_last_balance(pkScript, tick)
-  available_balance = last_balance["available_balance"]
+  available_balance = last_balance.available_balance
   if available_balance < amount: return False
   return True
 
+## after a failed block, unused_transfers and used_solutions are restored from the block's own changes instead of being reloaded
 def reset_caches():
-  global balance_cache, transfer_inscribe_event_cache
-  balance_cache = {}
-  transfer_inscribe_event_cache = {}
+  global balance_cache
+  balance_cache.clear()
+  undo_block_changes()
+  load_ticks()
+
+## ticks are kept in memory and updated on deploy and mint, they are only reloaded at startup and after a reorg
+## values are [remaining_supply, limit_per_mint, decimals, difficulty, starting_block_height, starting_block_hash]
+ticks_waiting_for_starting_block = {} ## starting_block_height -> ticks whose starting block is not indexed yet
+def load_ticks():
+  global ticks, ticks_waiting_for_starting_block
+  sttm = time.time()
+  cur.execute("SELECT t.tick, t.remaining_supply, t.limit_per_mint, t.decimals, t.difficulty, t.starting_block_height, b.block_hash FROM public.pow20_tickers t LEFT JOIN public.pow20_block_hashes b ON t.starting_block_height = b.block_height;")
+  ticks = {}
+  ticks_waiting_for_starting_block = {}
+  for t in cur.fetchall():
+    ticks[t[0]] = [t[1], t[2], t[3], t[4], t[5], t[6]]
+    if t[6] is None: ticks_waiting_for_starting_block.setdefault(t[5], []).append(t[0])
+  print("Ticks loaded (" + str(len(ticks)) + ") in " + str(time.time() - sttm) + " seconds")
 
+## called after a block is committed, mints of later blocks reference the hash of the starting block
+def resolve_starting_block_hashes(block_height, block_hash):
+  for tick in ticks_waiting_for_starting_block.pop(block_height, []):
+    ticks[tick][5] = block_hash
+
+## evicts least recently used entries over the memory budget, only call after commit
+def trim_caches():
+  for cache in [balance_cache]:
+    cache.trim()
+    print(cache.stats_str())
+
+## rows are buffered in engine.writes and written in a single transaction at the end of the block (tables are registered below)
 def deploy_inscribe(block_height, inscription_id, deployer_pkScript, deployer_wallet, tick, max_supply, decimals, limit_per_mint, difficulty, starting_block_height):
-  global ticks, in_commit, block_events_str, event_types
-  cur.execute("BEGIN;")
-  in_commit = True
+  global ticks, block_events_hasher, event_types
 
   event = {
     "deployer_pkScript": deployer_pkScript,
@@ -305,21 +388,16 @@ def deploy_inscribe(block_height, inscription_id, deployer_pkScript, deployer_wa
     "difficulty": str(difficulty),
     "starting_block_height": str(starting_block_height)
   }
-  block_events_str += get_event_str(event, "deploy-inscribe", inscription_id) + EVENT_SEPARATOR
-  cur.execute('''insert into pow20_events (event_type, block_height, inscription_id, event)
-    values (%s, %s, %s, %s);''', (event_types["deploy-inscribe"], block_height, inscription_id, json.dumps(event)))
+  block_events_hasher.add(get_event_str(event, "deploy-inscribe", inscription_id))
+  engine.writes.insert('pow20_events', (event_types["deploy-inscribe"], block_height, inscription_id, json.dumps(event)))
   
-  cur.execute('''insert into pow20_tickers (tick, max_supply, decimals, limit_per_mint, remaining_supply, block_height, starting_block_height, difficulty)
-    values (%s, %s, %s, %s, %s, %s, %s, %s);''', (tick, max_supply, decimals, limit_per_mint, max_supply, block_height, starting_block_height, difficulty))
+  engine.writes.insert('pow20_tickers', (tick, max_supply, decimals, limit_per_mint, max_supply, block_height, starting_block_height, difficulty))
   
-  cur.execute("COMMIT;")
-  in_commit = False
-  ticks[tick] = [max_supply, limit_per_mint, decimals]
+  ticks[tick] = [max_supply, limit_per_mint, decimals, difficulty, starting_block_height, None] ## starting block is not indexed yet
+  ticks_waiting_for_starting_block.setdefault(starting_block_height, []).append(tick)
 
 def mint_inscribe(block_height, inscription_id, minted_pkScript, minted_wallet, tick, amount, solution):
-  global ticks, in_commit, block_events_str, event_types
-  cur.execute("BEGIN;")
-  in_commit = True
+  global ticks, block_events_hasher, event_types
 
   event = {
     "minted_pkScript": minted_pkScript,
@@ -328,27 +406,22 @@ def mint_inscribe(block_height, inscription_id, minted_pkScript, minted_wallet,
     "amount": str(amount),
     "solution": solution
   }
-  block_events_str += get_event_str(event, "mint-inscribe", inscription_id) + EVENT_SEPARATOR
-  cur.execute('''insert into pow20_events (event_type, block_height, inscription_id, event)
-    values (%s, %s, %s, %s) returning id;''', (event_types["mint-inscribe"], block_height, inscription_id, json.dumps(event)))
-  event_id = cur.fetchone()[0]
-  cur.execute('''update pow20_tickers set remaining_supply = remaining_supply - %s where tick = %s;''', (amount, tick))
+  block_events_hasher.add(get_event_str(event, "mint-inscribe", inscription_id))
+  event_id = engine.writes.insert('pow20_events', (event_types["mint-inscribe"], block_height, inscription_id, json.dumps(event)))
+  engine.writes.update('pow20_tickers_remaining_supply', (tick,), amount)
+  solution_hash = get_sha256_hash(solution)
+  add_used_solution(solution_hash)
+  engine.writes.insert('pow20_mint_solutions', (solution_hash, block_height))
 
   last_balance = get_last_balance(minted_pkScript, tick)
-  last_balance["overall_balance"] += amount
-  last_balance["available_balance"] += amount
-  cur.execute('''insert into pow20_historic_balances (pkscript, wallet, tick, overall_balance, available_balance, block_height, event_id) 
-                values (%s, %s, %s, %s, %s, %s, %s);''', 
-                (minted_pkScript, minted_wallet, tick, last_balance["overall_balance"], last_balance["available_balance"], block_height, event_id))
+  last_balance.overall_balance += amount
+  last_balance.available_balance += amount
+  engine.writes.insert('pow20_historic_balances', (minted_pkScript, minted_wallet, tick, last_balance.overall_balance, last_balance.available_balance, block_height, event_id))
   
-  cur.execute("COMMIT;")
-  in_commit = False
   ticks[tick][0] -= amount
 
 def transfer_inscribe(block_height, inscription_id, source_pkScript, source_wallet, tick, amount):
-  global in_commit, block_events_str, event_types
-  cur.execute("BEGIN;")
-  in_commit = True
+  global block_events_hasher, event_types
 
   event = {
     "source_pkScript": source_pkScript,
@@ -356,29 +429,20 @@ def transfer_inscribe(block_height, inscription_id, source_pkScript, source_wall
     "tick": tick,
     "amount": str(amount)
   }
-  block_events_str += get_event_str(event, "transfer-inscribe", inscription_id) + EVENT_SEPARATOR
-  cur.execute('''insert into pow20_events (event_type, block_height, inscription_id, event)
-    values (%s, %s, %s, %s) returning id;''', (event_types["transfer-inscribe"], block_height, inscription_id, json.dumps(event)))
-  event_id = cur.fetchone()[0]
+  block_events_hasher.add(get_event_str(event, "transfer-inscribe", inscription_id))
+  event_id = engine.writes.insert('pow20_events', (event_types["transfer-inscribe"], block_height, inscription_id, json.dumps(event)))
   
   last_balance = get_last_balance(source_pkScript, tick)
-  last_balance["available_balance"] -= amount
-  cur.execute('''insert into pow20_historic_balances (pkscript, wallet, tick, overall_balance, available_balance, block_height, event_id)
-                values (%s, %s, %s, %s, %s, %s, %s);''', 
-                (source_pkScript, source_wallet, tick, last_balance["overall_balance"], last_balance["available_balance"], block_height, event_id))
+  last_balance.available_balance -= amount
+  engine.writes.insert('pow20_historic_balances', (source_pkScript, source_wallet, tick, last_balance.overall_balance, last_balance.available_balance, block_height, event_id))
   
-  cur.execute("COMMIT;")
-  in_commit = False
-  save_transfer_inscribe_event(inscription_id, event)
+  add_unused_transfer(inscription_id, event)
 
 def transfer_transfer_normal(block_height, inscription_id, spent_pkScript, spent_wallet, tick, amount, using_tx_id):
-  global in_commit, block_events_str, event_types
-  cur.execute("BEGIN;")
-  in_commit = True
+  global block_events_hasher, event_types
 
   inscribe_event = get_transfer_inscribe_event(inscription_id)
-  source_pkScript = inscribe_event["source_pkScript"]
-  source_wallet = inscribe_event["source_wallet"]
+  source_pkScript, source_wallet = inscribe_event
   event = {
     "source_pkScript": source_pkScript,
     "source_wallet": source_wallet,
@@ -388,36 +452,24 @@ def transfer_transfer_normal(block_height, inscription_id, spent_pkScript, spent
     "amount": str(amount),
     "using_tx_id": str(using_tx_id)
   }
-  block_events_str += get_event_str(event, "transfer-transfer", inscription_id) + EVENT_SEPARATOR
-  cur.execute('''insert into pow20_events (event_type, block_height, inscription_id, event)
-    values (%s, %s, %s, %s) returning id;''', (event_types["transfer-transfer"], block_height, inscription_id, json.dumps(event)))
-  event_id = cur.fetchone()[0]
+  block_events_hasher.add(get_event_str(event, "transfer-transfer", inscription_id))
+  event_id = engine.writes.insert('pow20_events', (event_types["transfer-transfer"], block_height, inscription_id, json.dumps(event)))
   
   last_balance = get_last_balance(source_pkScript, tick)
-  last_balance["overall_balance"] -= amount
-  cur.execute('''insert into pow20_historic_balances (pkscript, wallet, tick, overall_balance, available_balance, block_height, event_id)
-                values (%s, %s, %s, %s, %s, %s, %s);''', 
-                (source_pkScript, source_wallet, tick, last_balance["overall_balance"], last_balance["available_balance"], block_height, event_id))
+  last_balance.overall_balance -= amount
+  engine.writes.insert('pow20_historic_balances', (source_pkScript, source_wallet, tick, last_balance.overall_balance, last_balance.available_balance, block_height, event_id))
   
   if spent_pkScript != source_pkScript:
     last_balance = get_last_balance(spent_pkScript, tick)
-  last_balance["overall_balance"] += amount
-  last_balance["available_balance"] += amount
-  cur.execute('''insert into pow20_historic_balances (pkscript, wallet, tick, overall_balance, available_balance, block_height, event_id) 
-                values (%s, %s, %s, %s, %s, %s, %s);''', 
-                (spent_pkScript, spent_wallet, tick, last_balance["overall_balance"], last_balance["available_balance"], block_height, -1 * event_id)) ## negated to make a unique event_id
-  
-  cur.execute("COMMIT;")
-  in_commit = False
+  last_balance.overall_balance += amount
+  last_balance.available_balance += amount
+  engine.writes.insert('pow20_historic_balances', (spent_pkScript, spent_wallet, tick, last_balance.overall_balance, last_balance.available_balance, block_height, -1 * event_id)) ## negated to make a unique event_id
 
 def transfer_transfer_spend_to_fee(block_height, inscription_id, tick, amount, using_tx_id):
-  global in_commit, block_events_str, event_types
-  cur.execute("BEGIN;")
-  in_commit = True
+  global block_events_hasher, event_types
 
   inscribe_event = get_transfer_inscribe_event(inscription_id)
-  source_pkScript = inscribe_event["source_pkScript"]
-  source_wallet = inscribe_event["source_wallet"]
+  source_pkScript, source_wallet = inscribe_event
   event = {
     "source_pkScript": source_pkScript,
     "source_wallet": source_wallet,
@@ -427,39 +479,20 @@ def transfer_transfer_spend_to_fee(block_height, inscription_id, tick, amount, u
     "amount": str(amount),
     "using_tx_id": str(using_tx_id)
   }
-  block_events_str += get_event_str(event, "transfer-transfer", inscription_id) + EVENT_SEPARATOR
-  cur.execute('''insert into pow20_events (event_type, block_height, inscription_id, event)
-    values (%s, %s, %s, %s) returning id;''', (event_types["transfer-transfer"], block_height, inscription_id, json.dumps(event)))
-  event_id = cur.fetchone()[0]
+  block_events_hasher.add(get_event_str(event, "transfer-transfer", inscription_id))
+  event_id = engine.writes.insert('pow20_events', (event_types["transfer-transfer"], block_height, inscription_id, json.dumps(event)))
   
   last_balance = get_last_balance(source_pkScript, tick)
-  last_balance["available_balance"] += amount
-  cur.execute('''insert into pow20_historic_balances (pkscript, wallet, tick, overall_balance, available_balance, block_height, event_id) 
-                values (%s, %s, %s, %s, %s, %s, %s);''', 
-                (source_pkScript, source_wallet, tick, last_balance["overall_balance"], last_balance["available_balance"], block_height, event_id))
-  
-  cur.execute("COMMIT;")
-  in_commit = False
-
-
-def update_event_hashes(block_height):
-  global block_events_str
-  if len(block_events_str) > 0 and block_events_str[-1] == EVENT_SEPARATOR: block_events_str = block_events_str[:-1] ## remove last separator
-  block_event_hash = get_sha256_hash(block_events_str)
-  cumulative_event_hash = None
-  cur.execute('''select cumulative_event_hash from pow20_cumulative_event_hashes where block_height = %s;''', (block_height - 1,))
-  if cur.rowcount == 0:
-    cumulative_event_hash = block_event_hash
-  else:
-    cumulative_event_hash = get_sha256_hash(cur.fetchone()[0] + block_event_hash)
-  cur.execute('''INSERT INTO pow20_cumulative_event_hashes (block_height, block_event_hash, cumulative_event_hash) VALUES (%s, %s, %s);''', (block_height, block_event_hash, cumulative_event_hash))
-    
+  last_balance.available_balance += amount
+  engine.writes.insert('pow20_historic_balances', (source_pkScript, source_wallet, tick, last_balance.overall_balance, last_balance.available_balance, block_height, event_id))
 
 def index_block(block_height, current_block_hash):
-  global ticks, block_events_str
+  global block_events_hasher
   print("Indexing block " + str(block_height))
-  block_events_str = ""
+  block_events_hasher = engine.start_block(block_height)
+  clear_block_changes()
   
+  st_tm = time.time()
   cur_metaprotocol.execute('''SELECT ot.id, ot.inscription_id, ot.old_satpoint, ot.new_pkscript, ot.new_wallet, ot.sent_as_fee, oc."content", oc.content_type
                               FROM ord_transfers ot
                               LEFT JOIN ord_content oc ON ot.inscription_id = oc.inscription_id
@@ -469,23 +502,19 @@ def index_block(block_height, current_block_hash):
                                  AND oc."content" is not null AND oc."content"->>'p'='pow-20'
                               ORDER BY ot.id asc;''', (block_height,))
   transfers = cur_metaprotocol.fetchall()
+  work_stats.add_time("fetch_tm", st_tm)
+  work_stats.add_count("transfer_count", len(transfers))
   print("Transfer count: ", len(transfers))
   if len(transfers) == 0:
     print("No transfers found for block " + str(block_height))
-    update_event_hashes(block_height)
-    cur.execute('''INSERT INTO pow20_block_hashes (block_height, block_hash) VALUES (%s, %s);''', (block_height, current_block_hash))
+    engine.commit_block(block_height, current_block_hash)
+    clear_block_changes()
+    resolve_starting_block_hashes(block_height, current_block_hash)
     return
   print("Transfer count: ", len(transfers))
 
-  ## refresh ticks
-  sttm = time.time()
-  cur.execute("SELECT t.tick, t.remaining_supply, t.limit_per_mint, t.decimals, t.difficulty, t.starting_block_height, b.block_hash FROM public.pow20_tickers t LEFT JOIN public.pow20_block_hashes b ON t.starting_block_height = b.block_height;")
-  ticks_ = cur.fetchall()
-  ticks = {}
-  for t in ticks_:
-    ticks[t[0]] = [t[1], t[2], t[3], t[4], t[5], t[6]]
-  print("Ticks refreshed in " + str(time.time() - sttm) + " seconds")
-  
+  st_tm = time.time()
+  solution_zero_nibbles = verify_block_solutions(get_block_solutions(transfers))
   idx = 0
   for transfer in transfers:
     idx += 1
@@ -566,8 +595,10 @@ def index_block(block_height, current_block_hash):
       if solution_components[0] != tick.upper(): continue
       if solution_components[1] != new_addr: continue
       if solution_components[2] != ticks[tick][5]: continue
-      if not meets_difficulty(solution, ticks[tick][3]): continue
-      if has_solution_been_used(cur, event_types, solution): continue
+      if solution in solution_zero_nibbles:
+        if solution_zero_nibbles[solution] < ticks[tick][3]: continue
+      elif not meets_difficulty(solution, ticks[tick][3]): continue
+      if has_solution_been_used(solution): continue
 
       mint_inscribe(block_height, inscr_id, new_pkScript, new_addr, tick, amount, solution)
     
@@ -589,42 +620,36 @@ def index_block(block_height, current_block_hash):
         if is_used_or_invalid(inscr_id): continue ## already used or invalid
         if sent_as_fee: transfer_transfer_spend_to_fee(block_height, inscr_id, tick, amount, tx_id)
         else: transfer_transfer_normal(block_height, inscr_id, new_pkScript, new_addr, tick, amount, tx_id)
+  work_stats.add_time("index_tm", st_tm)
   
-  update_event_hashes(block_height)
-  # end of block
-  cur.execute('''INSERT INTO pow20_block_hashes (block_height, block_hash) VALUES (%s, %s);''', (block_height, current_block_hash))
-  conn.commit()
+  engine.commit_block(block_height, current_block_hash)
+  clear_block_changes()
+  resolve_starting_block_hashes(block_height, current_block_hash)
+  trim_caches()
   print("ALL DONE")
 
 
+## per-block work stats, stage timings are in ms, saved to pow20_indexer_work_stats after each block
+work_stats_columns = ["transfer_count", "event_count", "fetch_tm", "balance_fetch_tm", "index_tm", "write_tm", "hash_tm", "commit_tm", "extra_tables_tm", "report_tm", "all_tm", "balance_cache_hits", "balance_cache_misses"]
+work_stats = WorkStats(cur, 'pow20_indexer_work_stats', work_stats_columns)
+work_stats.track_cache("balance_cache", balance_cache)
 
-def check_for_reorg():
-  cur.execute('select block_height, block_hash from pow20_block_hashes order by block_height desc limit 1;')
-  if cur.rowcount == 0: return None ## nothing indexed yet
-  last_block = cur.fetchone()
+## opt-in profiling of blocks PROFILE_START_HEIGHT - PROFILE_END_HEIGHT
+block_profiler = BlockRangeProfiler(profile_mode, profile_start_height, profile_end_height, profile_sample_interval_ms, profile_output_file)
 
-  cur_metaprotocol.execute('select block_height, block_hash from block_hashes where block_height = %s;', (last_block[0],))
-  last_block_ord = cur_metaprotocol.fetchone()
-  if last_block_ord[1] == last_block[1]: return None ## last block hashes are the same, no reorg
+## block loop, block-buffered writes (COPY or multi-row INSERT), commits and reorgs
+engine = ProtocolEngine('pow20', conn, cur, conn_metaprotocol, cur_metaprotocol, bulk_writer, work_stats, block_profiler)
+engine.writes.add_table('pow20_events', ['event_type', 'block_height', 'inscription_id', 'event'], client_ids=True)
+engine.writes.add_table('pow20_tickers', ['tick', 'max_supply', 'decimals', 'limit_per_mint', 'remaining_supply', 'block_height', 'starting_block_height', 'difficulty'])
+engine.writes.add_table('pow20_historic_balances', ['pkscript', 'wallet', 'tick', 'overall_balance', 'available_balance', 'block_height', 'event_id'])
+engine.writes.add_table('pow20_mint_solutions', ['solution_hash', 'block_height'])
+engine.writes.add_update('pow20_tickers_remaining_supply', '''update pow20_tickers set remaining_supply = remaining_supply - %s where tick = %s;''')
+engine.reorg_tables = ['pow20_tickers', 'pow20_historic_balances', 'pow20_events', 'pow20_mint_solutions']
 
-  print("REORG DETECTED!!")
-  cur.execute('select block_height, block_hash from pow20_block_hashes order by block_height desc limit 10;')
-  hashes = cur.fetchall() ## get last 10 hashes
-  for h in hashes:
-    cur_metaprotocol.execute('select block_height, block_hash from block_hashes where block_height = %s;', (h[0],))
-    block = cur_metaprotocol.fetchone()
-    if block[1] == h[1]: ## found reorg height by a matching hash
-      print("REORG HEIGHT FOUND: " + str(h[0]))
-      return h[0]
-  
-  ## bigger than 10 block reorg is not supported by ord
-  print("CRITICAL ERROR!!")
-  sys.exit(1)
 
-def reorg_fix(reorg_height):
+## remaining_supply of tickers deployed before the reorg height, rows above it are deleted by the engine
+def revert_remaining_supply(reorg_height):
   global event_types
-  cur.execute('begin;')
-  cur.execute('delete from pow20_tickers where block_height > %s;', (reorg_height,)) ## delete new tickers
   ## fetch mint events for reverting remaining_supply in other tickers
   cur.execute('''select event from pow20_events where event_type = %s and block_height > %s;''', (event_types["mint-inscribe"], reorg_height,))
   rows = cur.fetchall()
@@ -638,46 +663,18 @@ def reorg_fix(reorg_height):
     tick_changes[tick] += amount
   for tick in tick_changes:
     cur.execute('''update pow20_tickers set remaining_supply = remaining_supply + %s where tick = %s;''', (tick_changes[tick], tick))
-  cur.execute('delete from pow20_historic_balances where block_height > %s;', (reorg_height,)) ## delete new balances
-  cur.execute('delete from pow20_events where block_height > %s;', (reorg_height,)) ## delete new events
-  cur.execute('delete from pow20_cumulative_event_hashes where block_height > %s;', (reorg_height,)) ## delete new bitmaps
-  cur.execute("SELECT setval('pow20_cumulative_event_hashes_id_seq', max(id)) from pow20_cumulative_event_hashes;") ## reset id sequence
-  cur.execute("SELECT setval('pow20_tickers_id_seq', max(id)) from pow20_tickers;") ## reset id sequence
-  cur.execute("SELECT setval('pow20_historic_balances_id_seq', max(id)) from pow20_historic_balances;") ## reset id sequence
-  cur.execute("SELECT setval('pow20_events_id_seq', max(id)) from pow20_events;") ## reset id sequence
-  cur.execute('delete from pow20_block_hashes where block_height > %s;', (reorg_height,)) ## delete new block hashes
-  cur.execute("SELECT setval('pow20_block_hashes_id_seq', max(id)) from pow20_block_hashes;") ## reset id sequence
-  cur.execute('commit;')
-  reset_caches()
 
-def check_if_there_is_residue_from_last_run():
-  cur.execute('''select max(block_height) from pow20_block_hashes;''')
-  row = cur.fetchone()
-  current_block = None
-  if row[0] is None: current_block = first_inscription_height
-  else: current_block = row[0] + 1
-  residue_found = False
-  cur.execute('''select coalesce(max(block_height), -1) from pow20_events;''')
-  if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
-    residue_found = True
-    print("residue on pow20_events")
-  cur.execute('''select coalesce(max(block_height), -1) from pow20_historic_balances;''')
-  if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
-    residue_found = True
-    print("residue on historic balances")
-  cur.execute('''select coalesce(max(block_height), -1) from pow20_tickers;''')
-  if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
-    residue_found = True
-    print("residue on tickers")
-  cur.execute('''select coalesce(max(block_height), -1) from pow20_cumulative_event_hashes;''')
-  if cur.rowcount != 0 and cur.fetchone()[0] >= current_block:
-    residue_found = True
-    print("residue on cumulative hashes")
-  if residue_found:
-    print("There is residue from last run, rolling back to " + str(current_block - 1))
-    reorg_fix(current_block - 1)
-    print("Rolled back to " + str(current_block - 1))
-    return
+def reorg_fix(reorg_height):
+  global balance_cache
+  reorged_transfers = get_reorged_unused_transfers(reorg_height)
+  cur.execute('''select solution_hash from pow20_mint_solutions where block_height > %s;''', (reorg_height,))
+  reorged_solutions = [row[0] for row in cur.fetchall()]
+  engine.reorg_fix(reorg_height, revert_remaining_supply)
+  revert_unused_transfers(reorged_transfers)
+  used_solutions.difference_update(reorged_solutions)
+  clear_block_changes()
+  balance_cache.clear()
+  load_ticks()
 
 def check_if_there_is_residue_on_extra_tables_from_last_run():
   cur.execute('''select max(block_height) from pow20_extras_block_hashes;''')
@@ -710,13 +707,39 @@ for key in event_types:
   event_types_rev[event_types[key]] = key
 
 
+## block event hashes of a range of blocks, runs in a worker process of reindex_cumulative_hashes with its own connection
+## events are streamed with a server-side cursor, ticks and event_types_rev are inherited from the parent process
+def get_block_event_hashes_of_range(block_range):
+  start_height, end_height = block_range
+  conn_worker = psycopg2.connect(
+    host=db_host,
+    port=db_port,
+    database=db_database,
+    user=db_user,
+    password=db_password)
+  cur_worker = conn_worker.cursor(name='reindex_events')
+  cur_worker.itersize = 10000
+  cur_worker.execute('''select block_height, event, event_type, inscription_id from pow20_events
+                        where block_height >= %s and block_height <= %s
+                        order by block_height asc, id asc;''', (start_height, end_height))
+  hashers = {}
+  for row in cur_worker:
+    if row[0] not in hashers: hashers[row[0]] = BlockEventHasher()
+    hashers[row[0]].add(get_event_str(row[1], event_types_rev[row[2]], row[3]))
+  cur_worker.close()
+  conn_worker.close()
+  return [(block_height, (hashers.get(block_height) or BlockEventHasher()).hexdigest()) for block_height in range(start_height, end_height + 1)]
+
+## block event hashes are computed in parallel over block ranges, only the cumulative hash chain is sequential
 def reindex_cumulative_hashes():
   global event_types_rev, ticks
-  cur.execute('''delete from pow20_cumulative_event_hashes;''')
   cur.execute('''select min(block_height), max(block_height) from pow20_block_hashes;''')
   row = cur.fetchone()
   min_block = row[0]
   max_block = row[1]
+  if min_block is None:
+    cur.execute('''delete from pow20_cumulative_event_hashes;''')
+    return
 
   sttm = time.time()
   cur.execute('''select tick, remaining_supply, limit_per_mint, decimals from pow20_tickers;''')
@@ -726,18 +749,25 @@ def reindex_cumulative_hashes():
     ticks[t[0]] = [t[1], t[2], t[3]]
   print("Ticks refreshed in " + str(time.time() - sttm) + " seconds")
 
-  print("Reindexing cumulative hashes from " + str(min_block) + " to " + str(max_block))
-  for block_height in range(min_block, max_block + 1):
-    print("Reindexing block " + str(block_height))
-    block_events_str = ""
-    cur.execute('''select event, event_type, inscription_id from pow20_events where block_height = %s order by id asc;''', (block_height,))
-    rows = cur.fetchall()
-    for row in rows:
-      event = row[0]
-      event_type = event_types_rev[row[1]]
-      inscription_id = row[2]
-      block_events_str += get_event_str(event, event_type, inscription_id) + EVENT_SEPARATOR
-    update_event_hashes(block_height)
+  print("Reindexing cumulative hashes from " + str(min_block) + " to " + str(max_block) + " with " + str(reindex_workers) + " workers")
+  block_ranges = [(start_height, min(start_height + 999, max_block)) for start_height in range(min_block, max_block + 1, 1000)]
+  hash_rows = []
+  last_cumulative_event_hash = None
+  with multiprocessing.get_context('fork').Pool(reindex_workers) as pool: ## fork, workers need the module state and must not re-run the module
+    for block_hashes in pool.imap(get_block_event_hashes_of_range, block_ranges): ## in order of block ranges
+      for block_height, block_event_hash in block_hashes:
+        last_cumulative_event_hash = get_cumulative_event_hash(last_cumulative_event_hash, block_event_hash)
+        hash_rows.append((block_height, block_event_hash, last_cumulative_event_hash))
+      print("Reindexed up to block " + str(hash_rows[-1][0]))
+
+  copy_buf = io.StringIO()
+  for hash_row in hash_rows:
+    copy_buf.write('%d\t%s\t%s\n' % hash_row)
+  copy_buf.seek(0)
+  cur.execute('BEGIN;')
+  cur.execute('''delete from pow20_cumulative_event_hashes;''')
+  cur.copy_expert('''COPY pow20_cumulative_event_hashes (block_height, block_event_hash, cumulative_event_hash) FROM STDIN''', copy_buf)
+  cur.execute('COMMIT;')
 
 cur.execute('select db_version from pow20_indexer_version;')
 if cur.rowcount == 0:
@@ -758,46 +788,18 @@ else:
       cur.execute('update pow20_indexer_version set indexer_version = %s, db_version = %s;', (INDEXER_VERSION, DB_VERSION,))
       print("Fixed.")
 
-def try_to_report_with_retries(to_send):
-  global report_url, report_retries
-  for _ in range(0, report_retries):
-    try:
-      r = requests.post(report_url, json=to_send)
-      if r.status_code == 200:
-        print("Reported hashes to metaprotocol indexer indexer.")
-        return
-      else:
-        print("Error while reporting hashes to metaprotocol indexer indexer, status code: " + str(r.status_code))
-    except:
-      print("Error while reporting hashes to metaprotocol indexer indexer, retrying...")
-    time.sleep(1)
-  print("Error while reporting hashes to metaprotocol indexer indexer, giving up.")
-
-def report_hashes(block_height):
-  global report_to_indexer
-  if not report_to_indexer:
-    print("Reporting to metaprotocol indexer is disabled.")
-    return
-  cur.execute('''select block_event_hash, cumulative_event_hash from pow20_cumulative_event_hashes where block_height = %s;''', (block_height,))
-  row = cur.fetchone()
-  block_event_hash = row[0]
-  cumulative_event_hash = row[1]
-  cur.execute('''select block_hash from pow20_block_hashes where block_height = %s;''', (block_height,))
-  block_hash = cur.fetchone()[0]
-  to_send = {
-    "name": report_name,
-    "type": "pow20",
-    "node_type": "full_node",
-    "network_type": network_type,
-    "version": INDEXER_VERSION,
-    "db_version": DB_VERSION,
-    "block_height": block_height,
-    "block_hash": block_hash,
-    "block_event_hash": block_event_hash,
-    "cumulative_event_hash": cumulative_event_hash
-  }
-  print("Sending hashes to metaprotocol indexer indexer...")
-  try_to_report_with_retries(to_send)
+load_unused_transfers()
+load_used_solutions()
+load_ticks()
+
+engine.configure_reporting(report_to_indexer, report_url, report_retries, {
+  "name": report_name,
+  "type": "pow20",
+  "node_type": "full_node",
+  "network_type": network_type,
+  "version": INDEXER_VERSION,
+  "db_version": DB_VERSION
+})
 
 def reorg_on_extra_tables(reorg_height):
   cur.execute('begin;')
@@ -1037,53 +1039,21 @@ def check_extra_tables():
     traceback.print_exc()
     return
 
-check_if_there_is_residue_from_last_run()
+engine.check_residue(first_inscription_height, reorg_fix)
 if create_extra_tables:
   check_if_there_is_residue_on_extra_tables_from_last_run()
   print("checking extra tables")
   check_extra_tables()
 
-last_report_height = 0
-while True:
-  check_if_there_is_residue_from_last_run()
+def before_block():
   if create_extra_tables:
     check_if_there_is_residue_on_extra_tables_from_last_run()
-  ## check if a new block is indexed
-  cur_metaprotocol.execute('''SELECT coalesce(max(block_height), -1) as max_height from block_hashes;''')
-  max_block_of_metaprotocol_db = cur_metaprotocol.fetchone()[0]
-  print("max_block_of_metaprotocol_db: ", max_block_of_metaprotocol_db)
-  cur.execute('''select max(block_height) from pow20_block_hashes;''')
-  row = cur.fetchone()
-  current_block = None
-  if row[0] is None: current_block = first_inscription_height
-  else: current_block = row[0] + 1
-  if current_block > max_block_of_metaprotocol_db:
-    print("Waiting for new blocks...")
-    time.sleep(5)
-    continue
-  
-  print("Processing block %s" % current_block)
-  cur_metaprotocol.execute('select block_hash from block_hashes where block_height = %s;', (current_block,))
-  current_block_hash = cur_metaprotocol.fetchone()[0]
-  reorg_height = check_for_reorg()
-  if reorg_height is not None:
-    print("Rolling back to ", reorg_height)
-    reorg_fix(reorg_height)
-    print("Rolled back to " + str(reorg_height))
-    continue
-  try:
-    index_block(current_block, current_block_hash)
-    if create_extra_tables:
-      print("checking extra tables")
-      check_extra_tables()
-    if max_block_of_metaprotocol_db - current_block < 10 or current_block - last_report_height > 100: ## do not report if there are more than 10 blocks to index
-      report_hashes(current_block)
-      last_report_height = current_block
-  except:
-    traceback.print_exc()
-    if in_commit: ## rollback commit if any
-      print("rolling back")
-      cur.execute('''ROLLBACK;''')
-      in_commit = False
-    time.sleep(10)
-    break
+
+def after_block(block_height, max_block_of_metaprotocol_db):
+  if create_extra_tables:
+    print("checking extra tables")
+    st_tm = time.time()
+    check_extra_tables()
+    work_stats.add_time("extra_tables_tm", st_tm)
+
+engine.run(first_inscription_height, index_block, reorg_fix, reset_caches, listen_new_blocks, new_block_wait_timeout, before_block, after_block)
@@ -0,0 +1,294 @@
+## replays a synthetic chain into a local postgres and measures an indexer over it
+## the main db and the protocol db are dropped and recreated for every run, use a dedicated postgres instance
+## metrics: blocks/s and events/s (wall clock and indexer busy time from <protocol>_indexer_work_stats),
+## p50/p99 per block latency (per batch average when the indexer batches blocks in catch-up mode), peak RSS of the indexer process
+## cumulative event hashes at checkpoints are compared with (or recorded into) a golden file
+##
+## usage: python3 replay_bench.py --protocols brc20 --blocks 1000 --ops-per-block 200 --golden golden.json
+##        python3 replay_bench.py --protocols brc20 --env CATCHUP_MODE=false --golden golden.json
+
+import os, sys, time, json, argparse, tempfile, signal, subprocess, io
+import psycopg2
+from synthetic_chain import SyntheticChain, DEFAULT_MIX
+
+MODULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+## the generated traffic is brc-20 shaped, other token indexers parse it with their own rules if --content-protocol is set to their "p"
+PROTOCOLS = {
+  'brc20': { 'dir': 'brc20_index', 'script': 'brc20_index.py', 'block_hashes': 'brc20_block_hashes', 'cumulative_hashes': 'brc20_cumulative_event_hashes', 'work_stats': 'brc20_indexer_work_stats' },
+  'brc6699': { 'dir': 'brc6699_index', 'script': 'brc6699_index.py', 'block_hashes': 'brc6699_block_hashes', 'cumulative_hashes': 'brc6699_cumulative_event_hashes', 'work_stats': 'brc6699_indexer_work_stats' },
+  'grc20': { 'dir': 'grc20_index', 'script': 'grc20_index.py', 'block_hashes': 'grc20_block_hashes', 'cumulative_hashes': 'grc20_cumulative_event_hashes', 'work_stats': 'grc20_indexer_work_stats' },
+  'pow20': { 'dir': 'pow20_index', 'script': 'pow20_index.py', 'block_hashes': 'pow20_block_hashes', 'cumulative_hashes': 'pow20_cumulative_event_hashes', 'work_stats': 'pow20_indexer_work_stats' },
+  'bitmap': { 'dir': 'bitmap_index', 'script': 'bitmap_index.py', 'block_hashes': 'bitmap_block_hashes', 'cumulative_hashes': 'bitmap_cumulative_event_hashes', 'work_stats': 'bitmap_indexer_work_stats' },
+  'sns': { 'dir': 'sns_index', 'script': 'sns_index.py', 'block_hashes': 'sns_block_hashes', 'cumulative_hashes': 'sns_names_cumulative_event_hashes', 'work_stats': 'sns_indexer_work_stats' },
+}
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='synthetic chain replay benchmark for the OPI indexers')
+  parser.add_argument('--protocols', default='brc20', help='comma separated indexers to run: ' + ', '.join(PROTOCOLS.keys()))
+  parser.add_argument('--blocks', type=int, default=1000)
+  parser.add_argument('--ops-per-block', type=int, default=200, help='average inscriptions and transfers per block')
+  parser.add_argument('--mix', default=DEFAULT_MIX, help='weights of deploy, mint, transfer (inscribe), spend (transfer-transfer) and fee (spend to fee)')
+  parser.add_argument('--hot-tickers', type=int, default=5, help='number of earliest tickers receiving --hot-share of the traffic')
+  parser.add_argument('--hot-share', type=float, default=0.8)
+  parser.add_argument('--wallets', type=int, default=5000)
+  parser.add_argument('--reorg-every', type=int, default=0, help='orphan a branch every N blocks, 0 disables reorgs')
+  parser.add_argument('--reorg-depth', type=int, default=3)
+  parser.add_argument('--content-protocol', default='brc-20', help='"p" field of the generated content')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--env', action='append', default=[], help='KEY=VALUE passed to the indexer, can be repeated')
+  parser.add_argument('--golden', default='', help='json file of golden cumulative hashes, missing scenarios are recorded')
+  parser.add_argument('--update-golden', action='store_true', help='overwrite golden hashes of the scenario instead of checking them')
+  parser.add_argument('--checkpoint-every', type=int, default=100)
+  parser.add_argument('--timeout', type=int, default=3600, help='seconds to wait for the indexer to reach a block')
+  parser.add_argument('--db-host', default=os.getenv("BENCH_DB_HOST") or "localhost")
+  parser.add_argument('--db-port', type=int, default=int(os.getenv("BENCH_DB_PORT") or "5432"))
+  parser.add_argument('--db-user', default=os.getenv("BENCH_DB_USER") or "postgres")
+  parser.add_argument('--db-password', default=os.getenv("BENCH_DB_PASSWD") or "")
+  parser.add_argument('--db-prefix', default='opi_bench', help='databases <prefix>_main and <prefix>_<protocol> are recreated')
+  return parser.parse_args()
+
+def connect(args, database):
+  conn = psycopg2.connect(host=args.db_host, port=args.db_port, database=database, user=args.db_user, password=args.db_password)
+  conn.autocommit = True
+  return conn
+
+def recreate_database(args, database):
+  conn = connect(args, 'postgres')
+  cur = conn.cursor()
+  cur.execute('DROP DATABASE IF EXISTS ' + database + ';')
+  cur.execute('CREATE DATABASE ' + database + ';')
+  conn.close()
+
+def init_main_db(args, database):
+  recreate_database(args, database)
+  conn = connect(args, database)
+  cur = conn.cursor()
+  with open(os.path.join(MODULES_DIR, 'main_index', 'db_init.sql'), 'r') as f:
+    cur.execute(f.read())
+  cur.execute('''INSERT INTO ord_network_type (network_type) VALUES ('regtest');''')
+  cur.execute('''INSERT INTO ord_transfer_counts (event_type, max_transfer_cnt) VALUES ('default', 2);''')
+  return conn
+
+def get_copy_csv_value(v):
+  if v is None: return '' ## unquoted empty value is NULL in csv format
+  if isinstance(v, bool): return 't' if v else 'f'
+  if isinstance(v, str): return '"' + v.replace('"', '""') + '"'
+  return str(v)
+
+def copy_rows(cur, table, columns, rows):
+  if len(rows) == 0: return
+  buf = io.StringIO()
+  for row in rows:
+    buf.write(','.join([get_copy_csv_value(v) for v in row]) + '\n')
+  buf.seek(0)
+  cur.copy_expert('COPY ' + table + ' (' + ', '.join(columns) + ') FROM STDIN WITH (FORMAT csv)', buf)
+
+## writes blocks to the main db in one transaction, blocks above delete_above are removed first (reorg)
+def feed_blocks(conn, blocks, delete_above=None):
+  cur = conn.cursor()
+  cur.execute('BEGIN;')
+  if delete_above is not None:
+    for table in ['ord_transfers', 'ord_number_to_id', 'ord_content', 'block_hashes']:
+      cur.execute('delete from ' + table + ' where block_height > %s;', (delete_above,))
+  copy_rows(cur, 'ord_number_to_id', ['inscription_number', 'inscription_id', 'cursed_for_brc20', 'parent_id', 'new_wallet', 'block_height'], [r for b in blocks for r in b['number_to_id']])
+  copy_rows(cur, 'ord_content', ['inscription_id', 'content', 'text_content', 'content_type', 'metaprotocol', 'block_height', 'delegate_id'], [r for b in blocks for r in b['content']])
+  copy_rows(cur, 'ord_transfers', ['inscription_id', 'block_height', 'old_satpoint', 'new_satpoint', 'new_pkscript', 'new_wallet', 'sent_as_fee', 'new_output_value'], [r for b in blocks for r in b['transfers']])
+  copy_rows(cur, 'block_hashes', ['block_height', 'block_hash'], [(b['block_height'], b['block_hash']) for b in blocks])
+  cur.execute('COMMIT;')
+  if len(blocks) > 0:
+    cur.execute('''SELECT pg_notify('opi_new_block', %s);''', (str(blocks[-1]['block_height']),)) ## same channel as main_index
+
+## indexers read .env and sql files from the working directory, a temporary directory keeps the real .env untouched
+def prepare_run_dir(protocol, env):
+  module_dir = os.path.join(MODULES_DIR, PROTOCOLS[protocol]['dir'])
+  run_dir = tempfile.mkdtemp(prefix='opi_bench_' + protocol + '_')
+  for name in os.listdir(module_dir):
+    if name.startswith('.env') or name == '__pycache__': continue
+    os.symlink(os.path.join(module_dir, name), os.path.join(run_dir, name))
+  with open(os.path.join(run_dir, '.env'), 'w') as f:
+    for key in env:
+      f.write(key + '="' + env[key] + '"\n')
+  return run_dir
+
+def get_indexer_env(args, protocol, protocol_db, main_db):
+  env = {
+    'DB_USER': args.db_user, 'DB_HOST': args.db_host, 'DB_PORT': str(args.db_port), 'DB_DATABASE': protocol_db, 'DB_PASSWD': args.db_password,
+    'DB_METAPROTOCOL_USER': args.db_user, 'DB_METAPROTOCOL_HOST': args.db_host, 'DB_METAPROTOCOL_PORT': str(args.db_port),
+    'DB_METAPROTOCOL_DATABASE': main_db, 'DB_METAPROTOCOL_PASSWD': args.db_password,
+    'NETWORK_TYPE': 'regtest', 'REPORT_TO_INDEXER': 'false', 'LISTEN_NEW_BLOCKS': 'true', 'NEW_BLOCK_WAIT_TIMEOUT': '1',
+  }
+  for kv in args.env:
+    key, value = kv.split('=', 1)
+    env[key] = value
+  return env
+
+def get_peak_rss_mb(pid):
+  try:
+    with open('/proc/' + str(pid) + '/status', 'r') as f:
+      for line in f:
+        if line.startswith('VmHWM:'): return int(line.split()[1]) / 1024
+  except OSError: pass
+  return None
+
+def get_indexed_block_hash(conn, protocol, block_height):
+  cur = conn.cursor()
+  cur.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = %s);''', (PROTOCOLS[protocol]['block_hashes'],))
+  if not cur.fetchone()[0]: return None
+  cur.execute('select block_hash from ' + PROTOCOLS[protocol]['block_hashes'] + ' where block_height = %s;', (block_height,))
+  row = cur.fetchone()
+  return row[0] if row is not None else None
+
+def wait_for_block(args, conn, protocol, proc, block, log_path):
+  st_tm = time.time()
+  while get_indexed_block_hash(conn, protocol, block['block_height']) != block['block_hash']:
+    if proc.poll() is not None:
+      raise Exception(protocol + " indexer exited with code " + str(proc.returncode) + ", see " + log_path)
+    if time.time() - st_tm > args.timeout:
+      raise Exception(protocol + " indexer did not reach block " + str(block['block_height']) + " in " + str(args.timeout) + " seconds, see " + log_path)
+    time.sleep(0.1)
+
+def wait_for_tables(args, conn, protocol, proc, log_path):
+  st_tm = time.time()
+  cur = conn.cursor()
+  while True:
+    cur.execute('''SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = %s);''', (PROTOCOLS[protocol]['work_stats'],))
+    if cur.fetchone()[0]: return
+    if proc.poll() is not None:
+      raise Exception(protocol + " indexer exited with code " + str(proc.returncode) + ", see " + log_path)
+    if time.time() - st_tm > args.timeout:
+      raise Exception(protocol + " indexer did not initialise its database, see " + log_path)
+    time.sleep(0.1)
+
+def weighted_percentile(values_with_weights, p):
+  values_with_weights = sorted(values_with_weights)
+  total = sum([w for _, w in values_with_weights])
+  if total == 0: return 0
+  acc = 0
+  for v, w in values_with_weights:
+    acc += w
+    if acc >= total * p: return v
+  return values_with_weights[-1][0]
+
+def get_scenario_key(args):
+  return 'seed=%d,blocks=%d,ops=%d,mix=%s,hot=%d/%s,wallets=%d,reorg=%d/%d,p=%s' % (args.seed, args.blocks, args.ops_per_block, args.mix, args.hot_tickers, args.hot_share,
+                                                                                   args.wallets, args.reorg_every, args.reorg_depth, args.content_protocol)
+
+def run_protocol(args, protocol):
+  main_db = args.db_prefix + '_main'
+  protocol_db = args.db_prefix + '_' + protocol
+  print("== " + protocol + ": preparing databases")
+  main_conn = init_main_db(args, main_db)
+  recreate_database(args, protocol_db)
+  protocol_conn = connect(args, protocol_db)
+
+  run_dir = prepare_run_dir(protocol, get_indexer_env(args, protocol, protocol_db, main_db))
+  log_path = os.path.join(run_dir, 'indexer.log')
+  log_file = open(log_path, 'w')
+  proc = subprocess.Popen([sys.executable, '-u', os.path.join(MODULES_DIR, PROTOCOLS[protocol]['dir'], PROTOCOLS[protocol]['script'])],
+                          cwd=run_dir, stdout=log_file, stderr=subprocess.STDOUT)
+  print("indexer started, log: " + log_path)
+  try:
+    wait_for_tables(args, protocol_conn, protocol, proc, log_path)
+    chain = SyntheticChain(args.seed, args.ops_per_block, args.mix, args.hot_tickers, args.hot_share, args.wallets, args.content_protocol)
+    reorg_heights = []
+    if args.reorg_every > 0:
+      reorg_heights = [h for h in range(args.reorg_every, args.blocks - 1, args.reorg_every) if h >= args.reorg_depth]
+    feed_tm = 0
+    st_tm = time.time()
+    delete_above = None
+    for reorg_height in reorg_heights:
+      fork_height = reorg_height - args.reorg_depth
+      f_tm = time.time()
+      blocks = [chain.next_block() for _ in range(chain.next_height, fork_height + 1)]
+      orphans = chain.orphan_blocks(args.reorg_depth)
+      feed_blocks(main_conn, blocks + orphans, delete_above)
+      feed_tm += time.time() - f_tm
+      wait_for_block(args, protocol_conn, protocol, proc, orphans[-1], log_path)
+      print("orphaned blocks " + str(fork_height + 1) + " - " + str(reorg_height))
+      delete_above = fork_height
+    f_tm = time.time()
+    blocks = [chain.next_block() for _ in range(chain.next_height, args.blocks)]
+    feed_blocks(main_conn, blocks, delete_above)
+    feed_tm += time.time() - f_tm
+    wait_for_block(args, protocol_conn, protocol, proc, blocks[-1], log_path)
+    wall_tm = time.time() - st_tm
+    peak_rss_mb = get_peak_rss_mb(proc.pid)
+  finally:
+    if proc.poll() is None:
+      proc.send_signal(signal.SIGINT)
+      try: proc.wait(timeout=30)
+      except subprocess.TimeoutExpired: proc.kill()
+    log_file.close()
+
+  cur = protocol_conn.cursor()
+  cur.execute('select min_block_height, max_block_height, event_count, all_tm from ' + PROTOCOLS[protocol]['work_stats'] + ' order by id asc;')
+  work_rows = cur.fetchall()
+  indexed_blocks = sum([r[1] - r[0] + 1 for r in work_rows])
+  event_cnt = sum([r[2] for r in work_rows])
+  busy_tm = sum([r[3] for r in work_rows]) / 1000.0
+  block_latencies = [(r[3] / (r[1] - r[0] + 1), r[1] - r[0] + 1) for r in work_rows] ## per block share of each indexing step, weighted by its block count
+  batched = any([r[1] > r[0] for r in work_rows]) ## rows of multi block steps only give the batch average, slow blocks are hidden
+  checkpoints = [h for h in range(0, args.blocks, args.checkpoint_every)] + [args.blocks - 1]
+  cur.execute('select block_height, cumulative_event_hash from ' + PROTOCOLS[protocol]['cumulative_hashes'] + ' where block_height = any(%s);', (checkpoints,))
+  hashes = dict([(str(r[0]), r[1]) for r in cur.fetchall()])
+  main_conn.close()
+  protocol_conn.close()
+
+  wall_indexer_tm = max(wall_tm - feed_tm, 0.001)
+  print("blocks indexed (incl. reorged): " + str(indexed_blocks) + ", events: " + str(event_cnt))
+  print("wall: %.1f s (%.1f s feeding), %.1f blocks/s, %.1f events/s" % (wall_tm, feed_tm, args.blocks / wall_indexer_tm, event_cnt / wall_indexer_tm))
+  if busy_tm > 0:
+    print("indexer busy: %.1f s, %.1f blocks/s, %.1f events/s" % (busy_tm, indexed_blocks / busy_tm, event_cnt / busy_tm))
+  if batched:
+    print("per batch average block time: p50 %.1f ms, p99 %.1f ms (%d batches, run with --env CATCHUP_MODE=false for per block latency)" % (weighted_percentile(block_latencies, 0.5), weighted_percentile(block_latencies, 0.99), len(work_rows)))
+  else:
+    print("block latency: p50 %.1f ms, p99 %.1f ms" % (weighted_percentile(block_latencies, 0.5), weighted_percentile(block_latencies, 0.99)))
+  print("peak RSS: " + ("%.1f MB" % peak_rss_mb if peak_rss_mb is not None else "n/a"))
+  return hashes
+
+def check_golden(args, results):
+  golden = {}
+  if os.path.isfile(args.golden):
+    with open(args.golden, 'r') as f:
+      golden = json.load(f)
+  scenario = golden.setdefault(get_scenario_key(args), {})
+  ok = True
+  changed = False
+  for protocol in results:
+    if protocol not in scenario or args.update_golden:
+      scenario[protocol] = results[protocol]
+      changed = True
+      print(protocol + ": golden hashes recorded")
+      continue
+    mismatch_height = None
+    for height in sorted(scenario[protocol].keys(), key=int):
+      if results[protocol].get(height) != scenario[protocol][height]:
+        mismatch_height = height
+        break
+    if mismatch_height is None:
+      print(protocol + ": golden hashes match")
+    else:
+      print(protocol + ": cumulative hash mismatch at block " + mismatch_height + ", expected " + scenario[protocol][mismatch_height] + ", got " + str(results[protocol].get(mismatch_height)))
+      ok = False
+  if changed:
+    with open(args.golden, 'w') as f:
+      json.dump(golden, f, indent=2, sort_keys=True)
+  return ok
+
+def main():
+  args = parse_args()
+  if args.reorg_every > 0 and args.reorg_every <= args.reorg_depth:
+    print("--reorg-every has to be larger than --reorg-depth")
+    sys.exit(1)
+  results = {}
+  for protocol in args.protocols.split(','):
+    if protocol not in PROTOCOLS:
+      print("unknown protocol: " + protocol)
+      sys.exit(1)
+    results[protocol] = run_protocol(args, protocol)
+  if args.golden != '' and not check_golden(args, results):
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
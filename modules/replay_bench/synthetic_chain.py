@@ -0,0 +1,145 @@
+## deterministic synthetic chain of brc-20 style inscriptions for replay benchmarks
+## blocks are generated lazily in height order, the same seed and parameters always give the same chain
+## rows follow the main_index schema: ord_transfers, ord_number_to_id, ord_content and block_hashes
+
+import copy, hashlib, json, random
+
+OP_TYPES = ['deploy', 'mint', 'transfer', 'spend', 'fee']
+DEFAULT_MIX = 'deploy=1,mint=60,transfer=20,spend=15,fee=4'
+CONTENT_TYPE_HEX = 'text/plain;charset=utf-8'.encode('utf-8').hex()
+TICK_CHARS = 'abcdefghijklmnopqrstuvwxyz0123456789'
+
+def parse_mix(mix_str):
+  mix = {}
+  for part in mix_str.split(','):
+    name, weight = part.split('=')
+    if name not in OP_TYPES:
+      raise ValueError("unknown op type in mix: " + name)
+    mix[name] = float(weight)
+  return [mix.get(op_type, 0) for op_type in OP_TYPES]
+
+class ChainState:
+  def __init__(self):
+    self.ticks = [] ## deploy order, first ones are the hot tickers
+    self.tick_info = {} ## tick -> [limit, remaining]
+    self.balances = {} ## (wallet_idx, tick) -> available amount
+    self.pending_transfers = [] ## [inscription_id, tick, amount, wallet_idx, satpoint]
+    self.inscription_number = 0
+
+class SyntheticChain:
+  def __init__(self, seed, ops_per_block, mix, hot_tickers, hot_share, wallet_cnt, content_protocol='brc-20'):
+    self.seed = seed
+    self.ops_per_block = ops_per_block
+    self.mix = parse_mix(mix)
+    self.hot_tickers = hot_tickers
+    self.hot_share = hot_share
+    self.wallet_cnt = wallet_cnt
+    self.content_protocol = content_protocol
+    self.state = ChainState()
+    self.next_height = 0
+
+  def block_rng(self, branch, block_height):
+    return random.Random(hashlib.sha256(('%s:%d:%d' % (branch, self.seed, block_height)).encode('utf-8')).digest())
+
+  def next_block(self):
+    block = self.generate_block(self.state, 'canonical', self.next_height)
+    self.next_height += 1
+    return block
+
+  ## blocks of a branch forking off after the last generated canonical block, canonical state is not changed
+  def orphan_blocks(self, count):
+    state = copy.deepcopy(self.state)
+    return [self.generate_block(state, 'orphan', self.next_height + i) for i in range(count)]
+
+  def generate_block(self, state, branch, block_height):
+    rng = self.block_rng(branch, block_height)
+    block = {
+      'block_height': block_height,
+      'block_hash': hashlib.sha256(('%s:%d:%d:hash' % (branch, self.seed, block_height)).encode('utf-8')).hexdigest(),
+      'transfers': [],
+      'number_to_id': [],
+      'content': [],
+    }
+    op_cnt = max(0, int(self.ops_per_block * rng.uniform(0.5, 1.5)))
+    for _ in range(op_cnt):
+      op_type = rng.choices(OP_TYPES, weights=self.mix)[0]
+      if op_type != 'deploy' and len(state.ticks) == 0: op_type = 'deploy'
+      if op_type == 'deploy': self.add_deploy(state, rng, block)
+      elif op_type == 'mint': self.add_mint(state, rng, block)
+      elif op_type == 'transfer': self.add_transfer_inscribe(state, rng, block)
+      else: self.add_transfer_spend(state, rng, block, op_type == 'fee')
+    return block
+
+  def wallet(self, wallet_idx):
+    pkscript = '0014' + hashlib.sha256(('wallet:%d' % wallet_idx).encode('utf-8')).hexdigest()[:40]
+    return pkscript, 'bcrt1q' + pkscript[4:36]
+
+  def pick_tick(self, state, rng):
+    hot_cnt = min(self.hot_tickers, len(state.ticks))
+    if hot_cnt > 0 and rng.random() < self.hot_share:
+      return state.ticks[rng.randrange(hot_cnt)]
+    return state.ticks[rng.randrange(len(state.ticks))]
+
+  def add_inscription(self, state, rng, block, wallet_idx, content):
+    inscription_id = '%064x' % rng.getrandbits(256) + 'i0'
+    pkscript, wallet = self.wallet(wallet_idx)
+    satpoint = inscription_id[:64] + ':0:0'
+    block['number_to_id'].append((state.inscription_number, inscription_id, False, None, wallet, block['block_height']))
+    block['content'].append((inscription_id, json.dumps(content), None, CONTENT_TYPE_HEX, None, block['block_height'], None))
+    block['transfers'].append((inscription_id, block['block_height'], '', satpoint, pkscript, wallet, False, 546))
+    state.inscription_number += 1
+    return inscription_id, satpoint
+
+  def add_deploy(self, state, rng, block):
+    tick = ''.join(rng.choice(TICK_CHARS) for _ in range(4))
+    limit = rng.choice([1000, 5000, 21000, 100000])
+    max_supply = limit * rng.randint(1000, 100000)
+    content = { 'p': self.content_protocol, 'op': 'deploy', 'tick': tick, 'max': str(max_supply), 'lim': str(limit) }
+    if rng.random() < 0.3: content['dec'] = str(rng.choice([0, 8, 18]))
+    self.add_inscription(state, rng, block, rng.randrange(self.wallet_cnt), content)
+    if tick not in state.tick_info: ## duplicate deploys are kept as invalid traffic
+      state.ticks.append(tick)
+      state.tick_info[tick] = [limit, max_supply]
+
+  def add_mint(self, state, rng, block):
+    tick = self.pick_tick(state, rng)
+    wallet_idx = rng.randrange(self.wallet_cnt)
+    limit, remaining = state.tick_info[tick]
+    self.add_inscription(state, rng, block, wallet_idx, { 'p': self.content_protocol, 'op': 'mint', 'tick': tick, 'amt': str(limit) })
+    amount = min(limit, remaining)
+    if amount > 0:
+      state.tick_info[tick][1] -= amount
+      state.balances[(wallet_idx, tick)] = state.balances.get((wallet_idx, tick), 0) + amount
+
+  def add_transfer_inscribe(self, state, rng, block):
+    if len(state.balances) == 0 or rng.random() < 0.05: ## some transfers without balance
+      tick = self.pick_tick(state, rng)
+      wallet_idx = rng.randrange(self.wallet_cnt)
+      available = 0
+    else:
+      wallet_idx, tick = rng.choice(list(state.balances.keys())) if len(state.balances) < 1000 else self.pick_balance_key(state, rng)
+      available = state.balances[(wallet_idx, tick)]
+    amount = rng.randint(1, max(1, available))
+    inscription_id, satpoint = self.add_inscription(state, rng, block, wallet_idx, { 'p': self.content_protocol, 'op': 'transfer', 'tick': tick, 'amt': str(amount) })
+    if amount <= available:
+      state.balances[(wallet_idx, tick)] = available - amount
+      if state.balances[(wallet_idx, tick)] == 0: del state.balances[(wallet_idx, tick)]
+      state.pending_transfers.append([inscription_id, tick, amount, wallet_idx, satpoint])
+
+  ## random balance key without building the key list of a large balance map
+  def pick_balance_key(self, state, rng):
+    for _ in range(10):
+      key = (rng.randrange(self.wallet_cnt), self.pick_tick(state, rng))
+      if key in state.balances: return key
+    return next(iter(state.balances))
+
+  def add_transfer_spend(self, state, rng, block, sent_as_fee):
+    if len(state.pending_transfers) == 0:
+      self.add_transfer_inscribe(state, rng, block)
+      return
+    inscription_id, tick, amount, wallet_idx, satpoint = state.pending_transfers.pop(rng.randrange(len(state.pending_transfers)))
+    receiver_idx = wallet_idx if sent_as_fee else rng.randrange(self.wallet_cnt) ## spend to fee returns the amount to the sender
+    pkscript, wallet = self.wallet(receiver_idx)
+    new_satpoint = '%064x' % rng.getrandbits(256) + ':0:0'
+    block['transfers'].append((inscription_id, block['block_height'], satpoint, new_satpoint, pkscript, wallet, sent_as_fee, 546))
+    state.balances[(receiver_idx, tick)] = state.balances.get((receiver_idx, tick), 0) + amount
@@ -2,4 +2,5 @@ drop table if exists sns_block_hashes;
 drop table if exists sns_names;
 drop table if exists sns_namespaces;
 drop table if exists sns_names_cumulative_event_hashes;
+drop table if exists sns_indexer_work_stats;
 drop table if exists sns_names_indexer_version;